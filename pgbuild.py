@@ -2,10 +2,9 @@ import sys
 import os
 from optparse import OptionParser
 import traceback
-import psycopg2
 import pgbuild
-from pgbuild import builder
-import yaml
+# modules used by a single command and database driver are imported by the commands,
+# so local commands like ddl start without loading them
 
 
 def green(text):
@@ -16,27 +15,290 @@ def red(text):
     return '\033[91m'+text+'\033[0m'
 
 
-def deploy(src, dest):
-    """ Deploy table to destination """
+def connect(dsn):
+    import psycopg2
+    return psycopg2.connect(dsn)
+
+
+def is_table_file(path):
+    """ Check if the file describes a table rather than an application, a database location is a table """
+    if path.startswith('postgresql://'):
+        return True
+    import yaml
+    content = yaml.load(file(path).read())
+    return isinstance(content, dict) and 'table' in content
+
+
+def log(message):
+    print message
+
+
+def start_monitor(conn, dsn, monitor, cancel_after):
+    """ Start monitor of the connection session if asked for, return it or None """
+    if not monitor and cancel_after is None:
+        return None
+    from pgbuild import monitor as monitor_module
+    ret = monitor_module.Monitor(dsn, conn.get_backend_pid(), log, cancel_after=cancel_after)
+    ret.start()
+    return ret
+
+
+def deploy(src, dest, skip_unchanged=True, lock_timeout=None, retries=0, defer_validation=False,
+           only_roles=None, only_types=None, monitor=False, cancel_after=None, swap=False, jobs=None):
+    """
+    Deploy table or application roles to destination.
+    With swap an existing table is rebuilt next to itself and swapped in, keeping its data.
+    jobs - number of connections loading copy items of a role at once
+    """
+    from pgbuild import executor
+    if not is_table_file(src):
+        deploy_roles(src, dest, skip_unchanged, lock_timeout, retries, defer_validation, only_roles, only_types,
+                     monitor, cancel_after, jobs)
+        return
     table = pgbuild.Table.load_from_location(src)
     conn_uri = dest.rstrip('/')
-    conn = psycopg2.connect(conn_uri)
-    table.drop_on_connection(conn)
-    table.create_on_connection(conn)
-    conn.commit()
+    conn = connect(conn_uri)
+    session_monitor = start_monitor(conn, conn_uri, monitor, cancel_after)
+    try:
+        table_executor = executor.Executor(conn, log=log, lock_timeout=lock_timeout, retries=retries,
+                                           monitor=session_monitor)
+        if swap:
+            from pgbuild import swap as swap_module
+            swap_module.deploy(table_executor, table)
+        else:
+            table_executor.execute(table.drop_clause() + table.create_clause())
+    finally:
+        if session_monitor is not None:
+            session_monitor.stop()
     print green('OK'), 'deployed at %s' % conn_uri + '/' + table.name
 
 
-def build(src, dest, build_format='psql'):
-    """ Build sql scripts for roles """
+def deploy_roles(src, dest, skip_unchanged=True, lock_timeout=None, retries=0, defer_validation=False,
+                 only_roles=None, only_types=None, monitor=False, cancel_after=None, jobs=None):
+    """ Deploy application roles to destination """
+    from pgbuild import executor
+    roles = pgbuild.roles.load_from_file(src, only_roles=only_roles, only_types=only_types)
+    conn_uri = dest.rstrip('/')
+    conn = connect(conn_uri)
+    session_monitor = start_monitor(conn, conn_uri, monitor, cancel_after)
+    try:
+        executor.Executor(conn, skip_unchanged, log, lock_timeout, retries,
+                          defer_validation=defer_validation, monitor=session_monitor,
+                          copy_jobs=jobs or 1, dsn=conn_uri).deploy_roles(roles)
+    finally:
+        if session_monitor is not None:
+            session_monitor.stop()
+    conn.close()
+    print green('OK'), 'deployed at %s' % conn_uri
+
+
+def load_tables(src):
+    """ Load a table or all tables of application roles """
+    if is_table_file(src):
+        return [pgbuild.Table.load_from_location(src)]
+    ret = []
+    for role in pgbuild.roles.load_from_file(src):
+        ret += [task.definition for task in role.tasks if task.task_type == 'table']
+    return ret
+
+
+def layout(src, dsn=None):
+    """ Report padding bytes wasted per row by column order of tables """
+    from pgbuild import layout as columns_layout
+    tables = load_tables(src)
+    layouts = None
+    if dsn:
+        conn = connect(dsn)
+        layouts = columns_layout.load_layouts(conn, tables)
+        conn.close()
+
+    total = 0.0
+    for table in tables:
+        current, optimal, order = columns_layout.analyze(table, layouts)
+        total += current - optimal
+        if current > optimal:
+            print red('%s' % table.name), '%g bytes of padding per row, %g with columns order: %s' % (
+                current, optimal, ', '.join(c.name for c in order))
+        else:
+            print green('%s' % table.name), '%g bytes of padding per row' % current
+    print 'Total %g bytes per row can be saved' % total
+
+
+def indexes(src, dsn=None):
+    """ Report redundant indexes of tables and unused indexes if a database is given """
+    from pgbuild import indexes as indexes_analysis
+    tables = load_tables(src)
+    found = False
+    for table in tables:
+        for index, other, reason in indexes_analysis.redundant_indexes(table):
+            found = True
+            if reason == 'duplicate':
+                print red(table.name), 'index %s duplicates %s' % (index.name, other.name)
+            else:
+                print red(table.name), 'index %s is a prefix of %s' % (index.name, other.name)
+
+    if dsn:
+        conn = connect(dsn)
+        for table_name, index_name, size, writes in indexes_analysis.unused_indexes(conn, tables):
+            found = True
+            print red(table_name), 'index %s is never scanned, takes %s and was updated by %s writes' % (
+                index_name, indexes_analysis.pretty_size(size), writes)
+        conn.close()
+
+    if not found:
+        print green('OK'), 'no redundant indexes found'
+
 
+def drift(src, dsns, shards=None, jobs=None):
+    """ Report tables of databases differing from their definitions, return True if all are in sync """
+    from pgbuild import drift as tables_drift
+    tables = load_tables(src)
+    if shards:
+        labels, dsns = zip(*tables_drift.shard_dsns(dsns[0], shards))
+    elif len(dsns) > 1:
+        labels = [str(n) for n in range(1, len(dsns) + 1)]
+    else:
+        conn = connect(dsns[0])
+        drifted = tables_drift.drift(conn, tables)
+        conn.close()
+        for table, existing, sql in drifted:
+            if existing is None:
+                print red(table.name), 'is missing'
+            else:
+                print red(table.name), 'differs:'
+                print sql
+        if not drifted:
+            print green('OK'), '%s tables are in sync' % len(tables)
+        return not drifted
+
+    results = tables_drift.drift_matrix(dsns, tables, jobs)
+    lines = tables_drift.format_matrix(tables, labels, results)
+    for line in lines:
+        print line
+    if not shards:
+        for label, dsn in zip(labels, dsns):
+            print '%s: %s' % (label, dsn)
+    for label, (states, error) in zip(labels, results):
+        if error is not None:
+            print red('Error'), '%s: %s' % (label, error)
+    if not lines:
+        print green('OK'), '%s tables are in sync in %s databases' % (len(tables), len(dsns))
+    return not lines
+
+
+def validate(src, jobs=None, only_roles=None):
+    """ Validate CSV files of copy items, return True if no errors found """
+    from pgbuild import validate as csv_validate
+    # tables of the roles give column types the values are checked against
+    roles = pgbuild.roles.load_from_file(src, only_roles=only_roles, only_types=['copy', 'table'])
+    errors = csv_validate.validate_roles(roles, jobs)
+    for error in errors:
+        print red('Error'), error
+    if not errors:
+        print green('OK'), 'data files are valid'
+    return not errors
+
+
+def watch_build(src, dest, build_format='psql', optimize_layout=False, only_roles=None, only_types=None):
+    """ Build roles, then rebuild only tasks of changed files until interrupted """
+    from pgbuild import builder
+    from pgbuild import migrations
+    from pgbuild import watch
+    dest = os.path.abspath(dest)
+    descriptor = pgbuild.roles.full_path(src)
+    roles = None
+    changed = None
+    watcher = None
+    paths = set([descriptor])
+    try:
+        while True:
+            try:
+                descriptors = set([descriptor] + [r.descriptor_path for r in roles or []])
+                if roles is None or changed & descriptors:
+                    roles = None
+                    roles = pgbuild.roles.load_from_file(src, optimize_layout, only_roles, only_types)
+                    for role in roles:
+                        builder.builders.get(build_format)(role, dest)
+                        migrations.Snapshot.from_role(role).write(
+                            os.path.join(dest, role.name, migrations.SNAPSHOT_FILE))
+                    print green('OK'), 'build created at %s' % dest
+                else:
+                    for role in roles:
+                        tasks = role.rebuild(changed)
+                        if tasks:
+                            builder.update_build(role, tasks, dest, build_format)
+                            migrations.Snapshot.from_role(role).write(
+                                os.path.join(dest, role.name, migrations.SNAPSHOT_FILE))
+                    print green('OK'), 'build updated at %s' % dest
+            except Exception, e:
+                print red('Error'), e
+
+            if roles is None:
+                # files of the last loaded roles stay watched, new ones are taken from the descriptor
+                paths.update(pgbuild.roles.referenced_paths(descriptor))
+            else:
+                paths = set([descriptor])
+                for role in roles:
+                    paths.update(role.sources)
+            if watcher is None:
+                watcher = watch.watcher(paths)
+            else:
+                watcher.watch(paths)
+            print 'watching %s files' % len(paths)
+            changed = watcher.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def ddl(src, only_roles=None, only_types=None, out=sys.stdout):
+    """ Stream DDL of a table or of all tasks of application roles """
+    if is_table_file(src):
+        print >> out, pgbuild.Table.load_from_location(src).create_clause()
+        return
+    from pgbuild import builder
+    for role in pgbuild.roles.iter_roles(src, only_roles=only_roles, only_types=only_types):
+        out.write('-- %s\n' % role.name)
+        for task in role.tasks:
+            builder.write_task_script(task, out)
+
+
+def location(path):
+    """ Absolute location of a file for the daemon, database locations are kept as is """
+    if path.startswith('postgresql://'):
+        return path
+    return os.path.abspath(path)
+
+
+def build(src, dest, build_format='psql', validate_data=False, jobs=None, since=None, safe_not_null=False,
+          optimize_layout=False, only_roles=None, only_types=None):
+    """ Build sql scripts for roles, only changes since a previous build if since is given """
+    from pgbuild import builder
+    from pgbuild import migrations
+
+    # roles are built one by one, so only one of them is in memory at a time
+    roles = pgbuild.roles.iter_roles(src, optimize_layout, only_roles, only_types)
+    if validate_data:
+        from pgbuild import validate as csv_validate
+        roles = list(roles)
+        errors = csv_validate.validate_roles(roles, jobs)
+        if errors:
+            for error in errors:
+                print red('Error'), error
+            sys.exit(-1)
     dest = os.path.abspath(dest)
     if not os.path.exists(dest):
         os.makedirs(dest)
-    roles = pgbuild.roles.load_from_file(src)
+    snapshots = migrations.load_snapshots(since) if since else {}
     for role in roles:
+        snapshot = migrations.Snapshot.from_role(role)
+        if since:
+            role.tasks = migrations.migration_tasks(role, snapshots.get(role.name), safe_not_null)
         build_func = builder.builders.get(build_format)
         build_func(role, dest)
+        snapshot.write(os.path.join(dest, role.name, migrations.SNAPSHOT_FILE))
 
     print green('OK'), 'build created at %s' % dest
 
@@ -48,31 +310,65 @@ if __name__ == '__main__':
 Commands:
     build - make a build of application
     deploy - deploy application to database
+    serve - run daemon answering ddl, diff and build requests of --server clients
     diff - diff two tables
-    ddl - print out a DDL of a table
+    drift - report tables of databases differing from their definitions
+    ddl - print out a DDL of a table or an application
+    layout - report padding wasted by column order of tables
+    indexes - report redundant and unused indexes
+    validate - check CSV files of copy items before deployment
     yaml - print out yaml definition of a table"""
 
     parser = OptionParser(usage=usage)
     parser.add_option('--format', dest='build_format', default='psql')
     parser.add_option('-o', '--overwrite', action="store_true", dest='overwrite', default=False)
+    parser.add_option('--replace-all', action="store_false", dest='skip_unchanged', default=True)
+    parser.add_option('--lock-timeout', dest='lock_timeout', default=None)
+    parser.add_option('--retries', type='int', dest='retries', default=0)
+    parser.add_option('--safe-not-null', action="store_true", dest='safe_not_null', default=False)
+    parser.add_option('--defer-validation', action="store_true", dest='defer_validation', default=False)
+    parser.add_option('--optimize-layout', action="store_true", dest='optimize_layout', default=False)
+    parser.add_option('--since', dest='since', default=None)
+    parser.add_option('--validate', action="store_true", dest='validate', default=False)
+    parser.add_option('-j', '--jobs', type='int', dest='jobs', default=None)
+    parser.add_option('--shards', dest='shards', default=None)
+    parser.add_option('--server', dest='server', default=None)
+    parser.add_option('--watch', action="store_true", dest='watch', default=False)
+    parser.add_option('--swap', action="store_true", dest='swap', default=False)
+    parser.add_option('--monitor', action="store_true", dest='monitor', default=False)
+    parser.add_option('--cancel-after', type='float', dest='cancel_after', default=None)
+    parser.add_option('--role', action="append", dest='roles', default=None)
+    parser.add_option('--only', dest='only', default=None)
     parser.add_option('-t', '--traceback', action="store_true", dest='show_traceback', default=False)
     (options, args) = parser.parse_args()
+    only_types = options.only.split(',') if options.only else None
 
     try:
 
         if args[0] == 'ddl':  # show yaml table DDL
-                table = pgbuild.Table.load_from_location(args[1])
-                print table.create_clause()
+            if options.server:
+                from pgbuild import server
+                print server.request(options.server, 'ddl', [location(args[1])])
+            elif args[1].startswith('postgresql://'):
+                print pgbuild.Table.load_from_location(args[1]).create_clause()
+            else:
+                ddl(args[1], options.roles, only_types)
 
         elif args[0] == 'diff':  # shows ALTER 1st to 2nd
 
-            if len(args) == 3:
+            if len(args) == 3 and options.server:
+                from pgbuild import server
+                print server.request(options.server, 'diff', [location(args[1]), location(args[2])],
+                                     safe_not_null=options.safe_not_null)
+            elif len(args) == 3:
                 table1 = pgbuild.Table.load_from_location(args[1])
                 table2 = pgbuild.Table.load_from_location(args[2])
-                print table1.alter_to(table2)
+                print table1.diff_to(table2, safe_not_null=options.safe_not_null)
 
         elif args[0] == 'deploy':
-            deploy(args[1], args[2])
+            deploy(args[1], args[2], options.skip_unchanged, options.lock_timeout, options.retries,
+                   options.defer_validation, options.roles, only_types, options.monitor, options.cancel_after,
+                   options.swap, options.jobs)
 
         elif args[0] == 'build':
             if len(args) < 3:
@@ -81,9 +377,42 @@ Commands:
             if os.path.exists(args[2]) and not options.overwrite:
                 print red("Destination path already exists. To overwrite use -o (--overwrite) option:\nUsage:\n  pgbuild build %s %s --overwrite" % (args[1], args[2]))
                 sys.exit(-1)
-            build(args[1], args[2], options.build_format)
+            if options.server:
+                from pgbuild import server
+                since = location(options.since) if options.since else None
+                print server.request(options.server, 'build', [location(args[1]), location(args[2])],
+                                     build_format=options.build_format, validate_data=options.validate,
+                                     jobs=options.jobs, since=since, safe_not_null=options.safe_not_null,
+                                     optimize_layout=options.optimize_layout, only_roles=options.roles,
+                                     only_types=only_types),
+                print green('OK'), 'build created at %s' % location(args[2])
+            elif options.watch:
+                watch_build(args[1], args[2], options.build_format, options.optimize_layout, options.roles,
+                            only_types)
+            else:
+                build(args[1], args[2], options.build_format, options.validate, options.jobs, options.since,
+                      options.safe_not_null, options.optimize_layout, options.roles, only_types)
+
+        elif args[0] == 'serve':
+            from pgbuild import server
+            server.Server(args[1] if len(args) > 1 else server.DEFAULT_SOCKET, log).serve_forever()
+
+        elif args[0] == 'layout':
+            layout(args[1], args[2] if len(args) > 2 else None)
+
+        elif args[0] == 'indexes':
+            indexes(args[1], args[2] if len(args) > 2 else None)
+
+        elif args[0] == 'drift':
+            if not drift(args[1], args[2:], options.shards, options.jobs):
+                sys.exit(-1)
+
+        elif args[0] == 'validate':
+            if not validate(args[1], options.jobs, options.roles):
+                sys.exit(-1)
 
         elif args[0] == 'yaml':
+            import yaml
             table = pgbuild.Table.load_from_location(args[1])
             print yaml.dump(yaml.load(str(table)), default_flow_style=False)
 
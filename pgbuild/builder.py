@@ -1,6 +1,7 @@
 import os
 import shutil
 import sys
+import hashlib
 role_tasks = """
 
 - name: create .pgbuild/run directory
@@ -12,24 +13,56 @@ role_tasks = """
   file: path=/tmp/.pgbuild state=absent
 """
 
-def ansible_build(role, dest):
-    if os.path.exists(os.path.join(dest, role.name)):
-        shutil.rmtree(os.path.join(dest, role.name))
-    os.makedirs(os.path.join(dest, role.name, 'templates'))
-    os.makedirs(os.path.join(dest, role.name, 'files'))
-    os.makedirs(os.path.join(dest, role.name, 'tasks'))
+def iter_task_script(task):
+    """ Generate content of a task file, lock waits are limited by lock_timeout of the task """
+    if task.lock_timeout:
+        yield "SET lock_timeout = '%s';\n" % task.lock_timeout
+    for chunk in task.iter_sql():
+        yield chunk
+    if task.lock_timeout:
+        yield "RESET lock_timeout;\n"
+
+
+def task_script(task):
+    return ''.join(iter_task_script(task))
+
+
+def write_task_script(task, out):
+    """ Stream content of a task file to a file-like object, return sha1 of the content """
+    digest = hashlib.sha1()
+    for chunk in iter_task_script(task):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        digest.update(chunk)
+        out.write(chunk)
+    return digest.hexdigest()
+
 
+def write_task_file(role, task, path):
+    """ Write the task script to a file, byte-identical files of the build become hard links """
+    if os.path.exists(path):
+        # file may be a link shared with another role, it's replaced instead of being rewritten in place
+        os.remove(path)
+    with open(path, 'w') as out:
+        digest = write_task_script(task, out)
+    registry = getattr(role, 'registry', None)
+    if registry is not None:
+        registry.link_artifact(path, digest)
+
+
+def ansible_task_file(role, task, dest):
+    if task.task_type == 'copy':
+        install_path = os.path.join(dest, role.name, 'files', str(task.number)+'.csv')
+        shutil.copyfile(task.copy_from, install_path)
+    else:
+        install_path = os.path.join(dest, role.name, 'files', str(task.number)+'.sql')
+        write_task_file(role, task, install_path)
+    return install_path
+
+
+def ansible_index(role, dest):
     entries = []
     for task in role.tasks:
-        if task.task_type == 'copy':
-            install_path = os.path.join(dest, role.name, 'files', str(task.number)+'.csv')
-            shutil.copyfile(task.copy_from, install_path)
-        else:
-            install_path = os.path.join(dest, role.name, 'files', str(task.number)+'.sql')
-            install_file = file(install_path, 'w')
-            install_file.write(task.sql_content.encode('utf8'))
-            install_file.close()
-
         entries.append(task.transfer_entry)
         if role.name.endswith('_shard'):
             entries.append(task.shards_entry)
@@ -43,21 +76,64 @@ def ansible_build(role, dest):
     tasks_file.close()
 
 
-def psql_build(role, dest):
+def ansible_build(role, dest):
     if os.path.exists(os.path.join(dest, role.name)):
         shutil.rmtree(os.path.join(dest, role.name))
     os.makedirs(os.path.join(dest, role.name, 'templates'))
     os.makedirs(os.path.join(dest, role.name, 'files'))
+    os.makedirs(os.path.join(dest, role.name, 'tasks'))
+
+    for task in role.tasks:
+        ansible_task_file(role, task, dest)
+    ansible_index(role, dest)
+
+
+def psql_task_path(role, task, dest):
+    return os.path.join(dest, role.name, 'files', '{}.sql'.format(task.number))
+
+
+def psql_task_file(role, task, dest):
+    fpath = psql_task_path(role, task, dest)
+    print fpath
+    write_task_file(role, task, fpath)
+    return fpath
+
+
+def psql_index(role, dest):
     entries = []
+    validations = []  # validation of constraints can be scheduled separately with validate.sql
     for task in role.tasks:
-        fpath = os.path.join(dest, role.name, 'files', '{}.sql'.format(task.number))
-        print fpath
-        open(fpath, 'w').write(task.sql_content.encode('utf-8'))
-        entries.append(fpath)
+        if task.task_type == 'validate':
+            validations.append(psql_task_path(role, task, dest))
+        else:
+            entries.append(psql_task_path(role, task, dest))
     install_sql = os.path.join(dest, role.name, 'install.sql')
     install_yaml = os.path.join(dest, role.name, 'install.yaml')
     open(install_sql, 'w').write(';\n'.join(["\i '{}'".format(e) for e in entries]) + ';\n')
     open(install_yaml, 'w').write('\n'.join([" - '{}'".format(e) for e in entries]))
+    validate_sql = os.path.join(dest, role.name, 'validate.sql')
+    if validations:
+        open(validate_sql, 'w').write(';\n'.join(["\i '{}'".format(e) for e in validations]) + ';\n')
+    elif os.path.exists(validate_sql):
+        os.remove(validate_sql)
+
+
+def psql_build(role, dest):
+    if os.path.exists(os.path.join(dest, role.name)):
+        shutil.rmtree(os.path.join(dest, role.name))
+    os.makedirs(os.path.join(dest, role.name, 'templates'))
+    os.makedirs(os.path.join(dest, role.name, 'files'))
+    for task in role.tasks:
+        psql_task_file(role, task, dest)
+    psql_index(role, dest)
+
+
+def update_build(role, tasks, dest, build_format='psql'):
+    """ Rewrite files of the given tasks and the list of tasks of an existing role build """
+    task_file, index = task_writers[build_format]
+    for task in tasks:
+        task_file(role, task, dest)
+    index(role, dest)
 
 def inject_jobs(tasks, jobs, shards):
     if shards:
@@ -82,3 +158,9 @@ builders = {
     'ansible': ansible_build,
     'psql': psql_build
 }
+
+# writers of a single task file and of the list of tasks of a role
+task_writers = {
+    'ansible': (ansible_task_file, ansible_index),
+    'psql': (psql_task_file, psql_index)
+}
@@ -0,0 +1,89 @@
+"""
+Stand-ins of a database connection and a role shared by tests of modules talking to the server.
+"""
+
+
+class LockNotAvailable(Exception):
+    pgcode = '55P03'
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.rowcount = -1
+
+    def execute(self, sql, params=None):
+        self.connection.executed.append(sql)
+        self.connection.params.append(params)
+        self.connection.fail(sql)
+        self.rows = self.connection.rows(sql)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def copy_expert(self, sql, f):
+        sql = sql.split(' (')[0]
+        self.connection.executed.append(sql)
+        self.connection.params.append(None)
+        self.connection.fail(sql)
+        self.rowcount = len(f.readlines())
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """
+    Executed statements are recorded along with commits and rollbacks.
+    results - dict of a part of statements to rows they return, other statements return no rows
+    errors - dict of a part of statements to exception they raise, or list of exceptions raised one by one
+    """
+
+    def __init__(self, results=None, errors=None):
+        self.results = results or {}
+        self.errors = errors or {}
+        self.executed = []
+        self.params = []
+        self.autocommit = False
+
+    def rows(self, sql):
+        if sql in self.results:
+            return self.results[sql]
+        for part, rows in self.results.items():
+            if part in sql:
+                return rows
+        return []
+
+    def fail(self, sql):
+        for part, error in self.errors.items():
+            if part not in sql:
+                continue
+            if isinstance(error, list):
+                if error:
+                    raise error.pop(0)
+            else:
+                raise error
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.executed.append('COMMIT')
+
+    def rollback(self):
+        self.executed.append('ROLLBACK')
+
+    def close(self):
+        pass
+
+
+class FakeRole(object):
+
+    def __init__(self, tasks):
+        self.name = 'myrole'
+        self.tasks = tasks
@@ -0,0 +1,170 @@
+"""
+Drift of existing tables from their definitions.
+
+Fingerprints of all tables are computed by the server in one query and
+compared with fingerprints of the definitions. Only tables with different
+fingerprints are introspected and diffed, so checking an application in
+sync costs a single query regardless of the number of its tables.
+
+Several databases (replicas, shards) are checked concurrently and their
+drift is reported as a matrix of tables and indexes by databases:
+
+    .  in sync
+    X  differs
+    M  missing
+    E  check of the database or table failed
+"""
+from multiprocessing.pool import ThreadPool
+import tables
+
+IN_SYNC = '.'
+DIFFERS = 'X'
+MISSING = 'M'
+FAILED = 'E'
+
+
+def load_fingerprints(connection, names):
+    """ Return dict of table name to fingerprint of the existing table, None for missing tables """
+    cur = connection.cursor()
+    cur.execute(tables.query_tables_fingerprints, (list(names),))
+    ret = dict(cur.fetchall())
+    cur.close()
+    return ret
+
+
+def drift(connection, tables_list):
+    """
+    Return list of (table, existing table, alter script) of tables differing from their definitions,
+    existing table and alter script are None for missing tables
+    """
+    fingerprints = load_fingerprints(connection, [t.name for t in tables_list])
+    introspector = tables.Introspector(connection)
+    ret = []
+    try:
+        for table in tables_list:
+            existing, sql = table_drift(connection, table, fingerprints.get(table.name), introspector)
+            if existing is None or sql:
+                ret.append((table, existing, sql))
+    finally:
+        # prepared statements outlive transactions, they are deallocated after a failed one is rolled back
+        connection.rollback()
+        introspector.close()
+        connection.rollback()
+    return ret
+
+
+def table_drift(connection, table, fingerprint, introspector):
+    """ Return tuple of existing table and alter script of a table, both None for a missing table """
+    if fingerprint is None:
+        return None, None
+    if fingerprint == table.fingerprint():
+        return table, ''
+    existing = tables.Table.load_from_connection(connection, table.name, introspector)
+    return existing, existing.alter_to(table)
+
+
+def drifted_indexes(existing, table):
+    """ Names of indexes missing, extra or different in the existing table """
+    own = dict((i.name, i) for i in existing.indexes)
+    other = dict((i.name, i) for i in table.indexes)
+    ret = []
+    for name in sorted(set(own) | set(other)):
+        if name not in own or name not in other or own[name] != other[name]:
+            ret.append(name)
+    return ret
+
+
+def database_drift(dsn, tables_list):
+    """
+    Return tuple of states and error of a database.
+    States are a dict of (table name, index name or None) to DIFFERS, MISSING or FAILED, in sync objects are left out.
+    A failed table doesn't stop the check of others, any other failure is the error of the whole database.
+    """
+    import psycopg2
+    try:
+        conn = psycopg2.connect(dsn)
+        try:
+            fingerprints = load_fingerprints(conn, [t.name for t in tables_list])
+            introspector = tables.Introspector(conn)
+            states = {}
+            for table in tables_list:
+                try:
+                    existing, sql = table_drift(conn, table, fingerprints.get(table.name), introspector)
+                except Exception:
+                    conn.rollback()
+                    states[(table.name, None)] = FAILED
+                    continue
+                if existing is None:
+                    states[(table.name, None)] = MISSING
+                elif sql:
+                    states[(table.name, None)] = DIFFERS
+                    for index_name in drifted_indexes(existing, table):
+                        states[(table.name, index_name)] = DIFFERS
+            return states, None
+        finally:
+            conn.close()
+    except Exception, e:
+        return None, str(e).strip()
+
+
+def shard_dsns(template, shards):
+    """
+    DSNs of shards from a template with {shard} placeholder.
+    shards - range like 0-31, list like 1,3,5 or their combination
+    Return list of (shard, dsn)
+    """
+    numbers = []
+    for item in shards.split(','):
+        if '-' in item:
+            start, end = item.split('-', 1)
+            numbers.extend(range(int(start), int(end) + 1))
+        else:
+            numbers.append(int(item))
+    return [(str(n), template.format(shard=n)) for n in numbers]
+
+
+def drift_matrix(dsns, tables_list, jobs=None):
+    """
+    Check drift of the tables in all databases concurrently, at most jobs databases at once.
+    Return list of (states, error) in order of dsns, see database_drift.
+    """
+    pool = ThreadPool(jobs or min(len(dsns), 8))
+    try:
+        return pool.map(lambda dsn: database_drift(dsn, tables_list), dsns)
+    finally:
+        pool.close()
+
+
+def format_matrix(tables_list, labels, results):
+    """
+    Return lines of the drift matrix, objects in sync in all databases are left out.
+    labels - column labels of databases, results - list of (states, error) per database
+    """
+    rows = []
+    for table in tables_list:
+        index_names = set()
+        for states, error in results:
+            index_names.update(i for t, i in (states or {}) if t == table.name and i is not None)
+        rows.append((table.name, None))
+        rows.extend((table.name, i) for i in sorted(index_names))
+
+    names = [key[0] if key[1] is None else '  ' + key[1] for key in rows]
+    width = max([len(l) for l in labels] + [1])
+    name_width = max([len(n) for n in names] + [0]) + 1
+
+    lines = []
+    for key, name in zip(rows, names):
+        cells = []
+        for states, error in results:
+            if states is None:
+                cells.append(FAILED)
+            else:
+                cells.append(states.get(key, IN_SYNC))
+        if key[1] is None and all(c == IN_SYNC for c in cells):
+            continue
+        lines.append(name.ljust(name_width) + ' '.join(c.rjust(width) for c in cells))
+
+    if lines:
+        header = ''.ljust(name_width) + ' '.join(l.rjust(width) for l in labels)
+        lines.insert(0, header)
+    return lines
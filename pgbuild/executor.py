@@ -0,0 +1,532 @@
+"""
+Deployment of roles directly to a database connection.
+
+Every task of a role is executed in its own transaction, copy tasks
+stream local files to the server with COPY FROM STDIN.
+
+Consecutive copy tasks are loaded as one stage, largest files first, by
+up to copy_jobs connections at once. Indexes of tables created by the
+role and loaded by its copy tasks are created after the load.
+
+Lock waits of a transaction are limited by lock_timeout. A task which
+failed to acquire a lock in time is rolled back and retried after an
+exponentially growing delay with random jitter, so a DDL statement
+never sits in a lock queue blocking the traffic behind it.
+
+Consecutive tasks of statements changing only the catalog, e.g. comments,
+defaults or functions, are sent together in one transaction and one round
+trip. If such a batch fails its tasks are run again one by one, and the
+error is reported with the task and the statement which caused it.
+
+An optional monitor (see monitor.py) is told about every task, so
+it can name the task in its progress and lock wait reports.
+"""
+import os
+import re
+import sys
+import time
+import random
+from multiprocessing.pool import ThreadPool
+from psycopg2 import errorcodes
+import psycopg2.pool
+import functions
+import types
+import roles
+
+
+re_leading_comments = re.compile(r'^(\s*--[^\n]*\n)*\s*')
+
+# statements which neither scan nor rewrite a table and hold their locks only briefly
+re_non_blocking = re.compile(r'''(
+    COMMENT\s+ON\b
+    | CREATE\s+SCHEMA\b
+    | CREATE\s+OR\s+REPLACE\s+(FUNCTION|PROCEDURE|VIEW)\b
+    | (?P<alter_table>ALTER\s+TABLE\s+(IF\s+EXISTS\s+)?\S+\s+ALTER\s+(COLUMN\s+)?\S+\s+(SET|DROP)\s+DEFAULT\b)
+    | ALTER\s+(INDEX|SEQUENCE|FUNCTION)\s+[^;]*\b(RENAME|OWNER)\b
+    | GRANT\b
+    | REVOKE\b
+    | SET\b
+    | RESET\b
+)''', re.I | re.X)
+query_existing_tables = """
+SELECT name
+FROM unnest(%s::text[]) name
+WHERE to_regclass(name) IS NOT NULL;
+"""
+
+# statements which can't run inside a transaction block
+re_non_transactional = re.compile(r'''(
+    (CREATE\s+(UNIQUE\s+)?INDEX | DROP\s+INDEX | REINDEX\s+(\([^)]*\)\s*)?\w+ | REFRESH\s+MATERIALIZED\s+VIEW)
+        \s+CONCURRENTLY\b
+    | ALTER\s+TABLE\s+[^;]*\bDETACH\s+PARTITION\s+[^;]*\bCONCURRENTLY\b
+)''', re.I | re.X)
+re_dollar_quote = re.compile(r'\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$')
+
+
+class ExecutorError(Exception):
+    pass
+
+
+def split_statements(sql):
+    """ Split SQL script into statements, respecting quotes, dollar quotes and comments """
+    statements = []
+    start = 0
+    pos = 0
+    length = len(sql)
+    while pos < length:
+        char = sql[pos]
+        if char == "'" or char == '"':
+            end = sql.find(char, pos + 1)
+            while end != -1 and sql[end + 1:end + 2] == char:  # escaped by doubling
+                end = sql.find(char, end + 2)
+            pos = length if end == -1 else end + 1
+        elif char == '-' and sql[pos:pos + 2] == '--':
+            end = sql.find('\n', pos)
+            pos = length if end == -1 else end + 1
+        elif char == '/' and sql[pos:pos + 2] == '/*':
+            end = sql.find('*/', pos + 2)
+            pos = length if end == -1 else end + 2
+        elif char == '$':
+            match = re_dollar_quote.match(sql, pos)
+            if match:
+                end = sql.find(match.group(0), match.end())
+                pos = length if end == -1 else end + len(match.group(0))
+            else:
+                pos += 1
+        elif char == ';':
+            statements.append(sql[start:pos + 1].strip())
+            pos += 1
+            start = pos
+        else:
+            pos += 1
+    tail = sql[start:].strip()
+    if tail:
+        statements.append(tail)
+    return [st for st in statements if st and st != ';']
+
+
+def is_non_transactional(statement):
+    return re_non_transactional.match(statement, re_leading_comments.match(statement).end()) is not None
+
+
+def has_top_level_comma(statement):
+    """ True if the statement has a comma out of parentheses and quotes, e.g. several ALTER TABLE actions """
+    depth = 0
+    quote = None
+    for char in statement:
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            return True
+    return False
+
+
+def is_non_blocking(statement):
+    match = re_non_blocking.match(statement, re_leading_comments.match(statement).end())
+    if match is None:
+        return False
+    # the default of a column may come along with other actions of the same ALTER TABLE
+    return not (match.group('alter_table') and has_top_level_comma(statement))
+
+
+def describe(task):
+    """ Task with the object it was rendered from, e.g. 'function task 3 (myschema.myfunc)' """
+    ret = '%s task %s' % (task.task_type, task.number)
+    name = getattr(getattr(task, 'definition', None), 'name', None)
+    if name:
+        ret += ' (%s)' % name
+    return ret
+
+
+def deferred_indexes(tasks):
+    """
+    Return dict of name to Table of tables which indexes can be created after their load.
+    Only a table created before the first copy loading it, a copy into an existing table keeps its indexes.
+    """
+    created = {}
+    loaded = set()
+    for task in tasks:
+        if task.task_type == 'table' and task.definition.name not in loaded:
+            created.setdefault(task.definition.name, task.definition)
+        elif task.task_type == 'copy':
+            loaded.add(task.table)
+    return dict((name, table) for name, table in created.items() if name in loaded and table.indexes)
+
+
+class Executor(object):
+
+    def __init__(self, connection, skip_unchanged=True, log=None,
+            lock_timeout=None, retries=0, retry_delay=1.0, max_retry_delay=60.0, defer_validation=False,
+            monitor=None, batch_size=100, copy_jobs=1, dsn=None):
+        """
+        connection - open DBAPI2 connection
+        skip_unchanged - don't replace functions which are identical to existing ones
+        log - callable receiving progress messages
+        lock_timeout - default lock_timeout of a task transaction, e.g. '2s'
+        retries - default number of retries of a task failed to acquire a lock
+        retry_delay, max_retry_delay - bounds of delay between retries in seconds
+        defer_validation - skip validation of constraints, to be run separately
+        monitor - monitor.Monitor of the connection session or None
+        batch_size - max number of non blocking tasks sent in one round trip, 1 sends every task separately
+        copy_jobs - number of connections loading copy tasks at once
+        dsn - database of the connection, needed to open connections of parallel copies
+        """
+        self.connection = connection
+        self.skip_unchanged = skip_unchanged
+        self.log = log or (lambda message: None)
+        self.lock_timeout = lock_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.defer_validation = defer_validation
+        self.monitor = monitor
+        self.batch_size = batch_size
+        self.copy_jobs = copy_jobs
+        self.dsn = dsn
+        self.deferred_indexes = {}  # name to Table of tables which indexes are created after load
+
+    def deploy_roles(self, roles):
+        for role in roles:
+            self.deploy_role(role)
+
+    def deploy_role(self, role):
+        if self.skip_unchanged:
+            fingerprints = self.functions_fingerprints(role)
+        else:
+            fingerprints = {}
+
+        self.deferred_indexes = deferred_indexes(role.tasks)
+        if self.deferred_indexes:
+            # a table existing before the deploy keeps serving queries, its indexes aren't deferred
+            for name in self.existing_tables(self.deferred_indexes.keys()):
+                del self.deferred_indexes[name]
+
+        batch = []
+        copies = []
+        for task in role.tasks:
+            if task.task_type == 'validate' and self.defer_validation:
+                continue
+            if task.task_type == 'function':
+                fingerprint = task.definition.fingerprint()
+                if fingerprint is not None and fingerprint in fingerprints.get(task.definition.name, ()):
+                    self.log('%s: function %s is unchanged, skipped' % (role.name, task.definition.name))
+                    continue
+            if task.task_type == 'copy':
+                self.run_batch(role, batch)
+                batch = []
+                copies.append(task)
+                continue
+            self.run_copies(role, copies)
+            copies = []
+            if self.batch_size > 1 and self.batchable(task):
+                batch.append(task)
+                if len(batch) >= self.batch_size:
+                    self.run_batch(role, batch)
+                    batch = []
+                continue
+            self.run_batch(role, batch)
+            batch = []
+            if self.monitor is not None:
+                self.monitor.begin('%s: %s task %s' % (role.name, task.task_type, task.number))
+            self.run_task(task)
+            self.log('%s: %s task %s done' % (role.name, task.task_type, task.number))
+        self.run_copies(role, copies)
+        self.run_batch(role, batch)
+
+    def batchable(self, task):
+        """ Check if the task has default lock budget and only non blocking statements """
+        if task.task_type not in ('schema', 'function', 'sql'):
+            return False
+        if task.lock_timeout is not None or task.retries is not None:
+            return False
+        return all(is_non_blocking(statement) for statement in split_statements(task.sql_content))
+
+    def run_batch(self, role, tasks):
+        """
+        Run the tasks in one transaction sent in one round trip. If it fails, the tasks are
+        run one by one, so the error is raised for the failed task and its statement.
+        """
+        if not tasks:
+            return
+        if len(tasks) > 1:
+            title = '%s: tasks %s-%s' % (role.name, tasks[0].number, tasks[-1].number)
+            if self.monitor is not None:
+                self.monitor.begin(title)
+            sql = ''.join(task.sql_content for task in tasks)
+
+            def run(cur):
+                cur.execute(sql)
+
+            try:
+                self.run_with_retries(run, self.lock_timeout, self.retries, title)
+            except Exception, e:
+                if getattr(e, 'pgcode', None) == errorcodes.LOCK_NOT_AVAILABLE:
+                    raise ExecutorError('%s failed: %s' % (title, e))
+                self.log('%s failed, running them one by one: %s' % (title, str(e).strip()))
+            else:
+                for task in tasks:
+                    self.log('%s: %s task %s done' % (role.name, task.task_type, task.number))
+                return
+
+        for task in tasks:
+            if self.monitor is not None:
+                self.monitor.begin('%s: %s task %s' % (role.name, task.task_type, task.number))
+            try:
+                self.run_task(task)
+            except ExecutorError:
+                statement, error = self.locate_error(task.sql_content)
+                if statement is None:
+                    raise
+                raise ExecutorError('%s failed at statement %s: %s' % (
+                    describe(task), ' '.join(statement.split())[:100], str(error).strip()))
+            self.log('%s: %s task %s done' % (role.name, task.task_type, task.number))
+
+    def locate_error(self, sql):
+        """
+        Run statements of failed SQL one by one in a transaction which is rolled back.
+        Return tuple of the first failing statement and its error, or (None, None).
+        """
+        cur = self.connection.cursor()
+        try:
+            if self.lock_timeout:
+                cur.execute('SET LOCAL lock_timeout = %s', (str(self.lock_timeout),))
+            for statement in split_statements(sql):
+                try:
+                    cur.execute(statement)
+                except Exception, e:
+                    return statement, e
+        finally:
+            cur.close()
+            self.connection.rollback()
+        return None, None
+
+    def run_copies(self, role, tasks):
+        """
+        Load the copy tasks largest first, by up to copy_jobs connections at once,
+        then create deferred indexes of the loaded tables
+        """
+        if not tasks:
+            return
+        tasks = sorted(tasks, key=lambda t: os.path.getsize(t.copy_from), reverse=True)
+        try:
+            self.load_copies(role, tasks)
+        except Exception:
+            # a failed load leaves the tables with the loaded rows, they aren't left without indexes
+            error = sys.exc_info()
+            try:
+                self.create_deferred_indexes(role, tasks)
+            except Exception, e:
+                self.log('%s: deferred indexes not created: %s' % (role.name, str(e).strip()))
+            raise error[0], error[1], error[2]
+        self.create_deferred_indexes(role, tasks)
+
+    def load_copies(self, role, tasks):
+        started = time.time()
+        if self.copy_jobs > 1 and len(tasks) > 1:
+            jobs = min(self.copy_jobs, len(tasks))
+            connections = psycopg2.pool.ThreadedConnectionPool(1, jobs, self.dsn)
+
+            def load(task):
+                conn = connections.getconn()
+                try:
+                    rows = Executor(conn, log=self.log, lock_timeout=self.lock_timeout, retries=self.retries,
+                                    retry_delay=self.retry_delay, max_retry_delay=self.max_retry_delay).run_copy(task)
+                finally:
+                    connections.putconn(conn)
+                self.log('%s: %s task %s done, %s rows' % (role.name, task.task_type, task.number, rows))
+                return rows
+
+            pool = ThreadPool(jobs)
+            try:
+                rows = sum(pool.map(load, tasks))
+            finally:
+                pool.close()
+                connections.closeall()
+        else:
+            rows = 0
+            for task in tasks:
+                if self.monitor is not None:
+                    self.monitor.begin('%s: %s task %s' % (role.name, task.task_type, task.number),
+                                       os.path.getsize(task.copy_from))
+                task_rows = self.run_copy(task)
+                rows += task_rows
+                self.log('%s: %s task %s done, %s rows' % (role.name, task.task_type, task.number, task_rows))
+
+        elapsed = time.time() - started
+        self.log('%s: %s rows loaded from %s files in %.1fs, %d rows/s' % (
+            role.name, rows, len(tasks), elapsed, rows / elapsed if elapsed > 0 else rows))
+
+    def create_deferred_indexes(self, role, tasks):
+        for name in sorted(set(task.table for task in tasks)):
+            table = self.deferred_indexes.pop(name, None)
+            if table is not None:
+                if self.monitor is not None:
+                    self.monitor.begin('%s: indexes of %s' % (role.name, name))
+                self.execute(table.indexes.create_clause())
+                self.log('%s: indexes of %s created' % (role.name, name))
+
+    def existing_tables(self, names):
+        """ Return names of the tables which exist """
+        cur = self.connection.cursor()
+        cur.execute(query_existing_tables, (list(names),))
+        ret = [row[0] for row in cur.fetchall()]
+        cur.close()
+        self.connection.rollback()
+        return ret
+
+    def functions_fingerprints(self, role):
+        """
+        Fetch fingerprints of existing functions from schemas of the role functions in one query.
+        Return dict of function name to set of fingerprints of its overloads.
+        """
+        schemas = set()
+        for task in role.tasks:
+            if task.task_type == 'function' and task.definition.name is not None:
+                schemas.add(task.definition.name.split('.')[0])
+        if not schemas:
+            return {}
+
+        cur = self.connection.cursor()
+        cur.execute(functions.query_functions_fingerprints, (list(schemas),))
+        ret = {}
+        for name, fingerprint in cur.fetchall():
+            ret.setdefault(name, set()).add(fingerprint)
+        cur.close()
+        self.connection.rollback()
+        return ret
+
+    def task_sql(self, task):
+        """
+        Return SQL of the task, existing types are altered in place instead of being recreated,
+        indexes of tables to be loaded are left for run_copies
+        """
+        if task.task_type == 'table' and task.definition.name in self.deferred_indexes:
+            return u''.join(task.definition.iter_create_clause(validate=False, create_indexes=False))
+        if task.task_type == 'type':
+            existing = types.Type.load_from_connection(self.connection, task.definition.name)
+            if existing is not None:
+                return existing.alter_to(task.definition)
+        return task.sql_content
+
+    def lock_budget(self, task):
+        """ Return lock_timeout and retries of the task, executor defaults unless the task has its own """
+        lock_timeout = getattr(task, 'lock_timeout', None) or self.lock_timeout
+        retries = getattr(task, 'retries', None)
+        if retries is None:
+            retries = self.retries
+        return lock_timeout, retries
+
+    def run_task(self, task):
+        if task.task_type == 'copy':
+            self.run_copy(task)
+            return
+
+        lock_timeout, retries = self.lock_budget(task)
+        title = '%s task %s' % (task.task_type, task.number)
+        sql = self.task_sql(task)
+        if task.task_type in roles.non_transactional_types or any(is_non_transactional(st) for st in split_statements(sql or '')):
+            try:
+                self.run_autocommit(sql, lock_timeout, retries, title)
+            except Exception, e:
+                raise ExecutorError('%s task %s failed: %s' % (task.task_type, task.number, e))
+            return
+
+        def run(cur):
+            if sql:
+                cur.execute(sql)
+
+        try:
+            self.run_with_retries(run, lock_timeout, retries, title)
+        except Exception, e:
+            raise ExecutorError('%s task %s failed: %s' % (task.task_type, task.number, e))
+
+    def run_copy(self, task):
+        """ Stream file of the copy task to the server, return number of loaded rows """
+        lock_timeout, retries = self.lock_budget(task)
+        result = {}
+
+        def run(cur):
+            with open(task.copy_from, 'rb') as f:
+                cur.copy_expert(task.copy_stdin_clause, f)
+            result['rows'] = cur.rowcount
+
+        try:
+            self.run_with_retries(run, lock_timeout, retries, '%s task %s' % (task.task_type, task.number))
+        except Exception, e:
+            raise ExecutorError('%s task %s failed: %s' % (task.task_type, task.number, e))
+        return result['rows']
+
+    def execute(self, sql, lock_timeout=None, retries=None):
+        """ Execute SQL in its own transaction with lock_timeout and retries """
+        def run(cur):
+            cur.execute(sql)
+
+        if retries is None:
+            retries = self.retries
+        self.run_with_retries(run, lock_timeout or self.lock_timeout, retries, 'statement')
+
+    def run_autocommit(self, sql, lock_timeout=None, retries=0, title='statement'):
+        """
+        Execute SQL statement by statement outside of a transaction block,
+        for statements managing transactions themselves, e.g. committing in batches
+        or building indexes concurrently. A statement which failed to acquire a lock is retried on its own.
+        """
+        self.connection.autocommit = True
+        cur = self.connection.cursor()
+        try:
+            if lock_timeout:
+                cur.execute('SET lock_timeout = %s', (str(lock_timeout),))
+            for statement in split_statements(sql or ''):
+                attempt = 0
+                while True:
+                    try:
+                        cur.execute(statement)
+                        break
+                    except Exception, e:
+                        if not self.wait_retry(e, attempt, lock_timeout, retries, title):
+                            raise
+                        attempt += 1
+        finally:
+            if lock_timeout:
+                cur.execute('RESET lock_timeout')
+            cur.close()
+            self.connection.autocommit = False
+
+    def run_with_retries(self, run, lock_timeout, retries, title):
+        """
+        Call run with a cursor in a transaction limited by lock_timeout.
+        Retry if a lock wasn't acquired in time, other errors are raised immediately.
+        """
+        attempt = 0
+        while True:
+            cur = self.connection.cursor()
+            try:
+                if lock_timeout:
+                    cur.execute('SET LOCAL lock_timeout = %s', (str(lock_timeout),))
+                run(cur)
+                self.connection.commit()
+                return
+            except Exception, e:
+                self.connection.rollback()
+                if not self.wait_retry(e, attempt, lock_timeout, retries, title):
+                    raise
+                attempt += 1
+            finally:
+                cur.close()
+
+    def wait_retry(self, error, attempt, lock_timeout, retries, title):
+        """ Sleep before the next attempt if the error is a lock not acquired in time and retries are left """
+        if getattr(error, 'pgcode', None) != errorcodes.LOCK_NOT_AVAILABLE or attempt >= retries:
+            return False
+        delay = random.uniform(0, min(self.max_retry_delay, self.retry_delay * 2 ** attempt))
+        self.log('%s: lock not acquired within %s, retry %s of %s in %.1fs' % (
+            title, lock_timeout, attempt + 1, retries, delay))
+        time.sleep(delay)
+        return True
@@ -1,3 +1,120 @@
+import hashlib
+import re
+import tables
+
+re_header = re.compile(r'CREATE\s+(?:OR\s+REPLACE\s+)?FUNCTION\s+([\w."$]+)\s*\(', re.I)
+re_body = re.compile(r'\bAS\s+(\$\w*\$)(.*?)\1', re.I | re.S)
+re_language = re.compile(r'\bLANGUAGE\s+\'?(\w+)\'?', re.I)
+re_returns = re.compile(
+    r'\bRETURNS\s+(?!NULL\s)(.*?)\s*(?:\b(?:AS|LANGUAGE|IMMUTABLE|STABLE|VOLATILE|STRICT|CALLED|RETURNS|'
+    r'SECURITY|EXTERNAL|COST|ROWS|SET|PARALLEL|LEAKPROOF|WINDOW|TRANSFORM|SUPPORT)\b|$)', re.I | re.S)
+re_volatility = re.compile(r'\b(IMMUTABLE|STABLE|VOLATILE)\b', re.I)
+re_strict = re.compile(r'\b(STRICT|RETURNS\s+NULL\s+ON\s+NULL\s+INPUT)\b', re.I)
+re_security_definer = re.compile(r'\bSECURITY\s+DEFINER\b', re.I)
+# attributes which are not part of the fingerprint, functions using them are always deployed
+re_untracked = re.compile(r'\b(COST|ROWS|PARALLEL|SET|LEAKPROOF|WINDOW|TRANSFORM|SUPPORT)\b', re.I)
+
+# fingerprints of existing functions computed the same way as Function.fingerprint
+query_functions_fingerprints = """
+SELECT
+    n.nspname || '.' || p.proname "name",
+    md5(
+        lower(regexp_replace(pg_get_function_arguments(p.oid), '\\s+', ' ', 'g')) || '|' ||
+        lower(regexp_replace(pg_get_function_result(p.oid), '\\s+', ' ', 'g')) || '|' ||
+        lower(l.lanname) || '|' ||
+        p.provolatile || '|' ||
+        CASE WHEN p.proisstrict THEN 't' ELSE 'f' END || '|' ||
+        CASE WHEN p.prosecdef THEN 't' ELSE 'f' END || '|' ||
+        p.prosrc
+    ) "fingerprint"
+FROM pg_proc p
+    JOIN pg_namespace n ON n.oid = p.pronamespace
+    JOIN pg_language l ON l.oid = p.prolang
+WHERE n.nspname = ANY(%s);
+"""
+
+
+def normalize(text):
+    """ Lower case text with collapsed whitespaces """
+    text = re.sub(r'\s+', ' ', text.strip().lower())
+    text = re.sub(r'\s*,\s*', ', ', text)
+    text = re.sub(r'\(\s+', '(', text)
+    return re.sub(r'\s+\)', ')', text)
+
+
+# type names which an argument without name can start with
+known_types = set(tables.type_aliases.keys() + tables.type_aliases.values() + [
+    'text', 'date', 'numeric', 'json', 'jsonb', 'uuid', 'bytea', 'interval', 'void', 'trigger', 'record',
+    'anyelement', 'anyarray', 'regclass', 'oid', 'inet', 'cidr', 'xml', 'tsvector', 'tsquery', 'hstore'])
+
+argument_modes = ['in', 'out', 'inout', 'variadic']
+
+
+def split_top_level(text):
+    """ Split text by commas out of parentheses """
+    ret = []
+    depth = 0
+    start = 0
+    for pos, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            ret.append(text[start:pos])
+            start = pos + 1
+    ret.append(text[start:])
+    return [part.strip() for part in ret if part.strip()]
+
+
+def canonical_argument(argument):
+    """ Argument as printed by pg_get_function_arguments: mode, name and type in the form of format_type """
+    argument = normalize(argument)
+    default = ''
+    match = re.search(r'\s+(default\b|=)\s*(.*)$', argument)
+    if match:
+        default = ' default ' + match.group(2)
+        argument = argument[:match.start()]
+    words = argument.split(' ')
+    mode = ''
+    if words[0] in argument_modes and len(words) > 1:
+        mode = '' if words[0] == 'in' else words[0] + ' '
+        words = words[1:]
+    dtype = ' '.join(words)
+    name = ''
+    if re.sub(r'(\(.*|\[\]|\s+(with|without)\s+time\s+zone)+$', '', dtype) not in known_types and len(words) > 1:
+        name = words[0] + ' '
+        dtype = ' '.join(words[1:])
+    return mode + name + tables.normalized_type(dtype) + default
+
+
+def canonical_arguments(arguments):
+    return ', '.join(canonical_argument(a) for a in split_top_level(arguments))
+
+
+def canonical_result(result):
+    """ Result as printed by pg_get_function_result """
+    result = normalize(result)
+    if result.startswith('setof '):
+        return 'setof ' + tables.normalized_type(result[len('setof '):])
+    match = re.match(r'^table\s*\((.*)\)$', result)
+    if match:
+        return 'table(%s)' % canonical_arguments(match.group(1))
+    return tables.normalized_type(result)
+
+
+def split_arguments(script, start):
+    """ Return arguments text of the function starting at the open parenthesis and the position after it """
+    depth = 0
+    for pos in xrange(start, len(script)):
+        if script[pos] == '(':
+            depth += 1
+        elif script[pos] == ')':
+            depth -= 1
+            if depth == 0:
+                return script[start + 1:pos], pos + 1
+    return None, len(script)
+
 
 class Function(object):
 
@@ -10,4 +127,55 @@ class Function(object):
     def __init__(self, script):
 
         self.script = script
+        self.name = None
+        self.arguments = None
+        self.result = None
+        self.body = None
+        self.header = None
+
+        self._parse()
+
+    def _parse(self):
+        """ Parse name, signature and body, left None if the script isn't a single function """
+        headers = re_header.findall(self.script)
+        if len(headers) != 1:
+            return
+        match = re_header.search(self.script)
+        name = match.group(1)
+        if '.' not in name:
+            name = 'public.' + name
+        self.name = name.replace('"', '') if '"' in name else name.lower()
+
+        self.arguments, pos = split_arguments(self.script, match.end() - 1)
+        body = re_body.search(self.script, pos)
+        if self.arguments is None or body is None:
+            return
+        self.body = body.group(2)
+        self.header = self.script[pos:body.start()] + ' ' + self.script[body.end():]
+        returns = re_returns.search(self.script[pos:body.start()])
+        if returns:
+            self.result = returns.group(1)
+
+    def fingerprint(self):
+        """
+        Hash of the definition comparable with fingerprints of existing functions,
+        None if the definition can't be compared reliably
+        """
+        if self.body is None or self.result is None or re_untracked.search(self.header):
+            return None
+
+        volatility = re_volatility.search(self.header)
+        volatility = volatility.group(1)[0].lower() if volatility else 'v'
+        language = re_language.search(self.header)
+        if language is None:
+            return None
 
+        return hashlib.md5('|'.join([
+            canonical_arguments(self.arguments),
+            canonical_result(self.result),
+            language.group(1).lower(),
+            volatility,
+            't' if re_strict.search(self.header) else 'f',
+            't' if re_security_definer.search(self.header) else 'f',
+            self.body
+        ])).hexdigest()
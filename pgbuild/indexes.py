@@ -0,0 +1,87 @@
+"""
+Analysis of redundant and unused indexes.
+
+An index is redundant if another index with the same method and predicate
+makes it useless:
+
+    - an exact duplicate of another index or of the primary key
+    - a non unique btree index whose fields are a prefix of another btree index
+
+Unused indexes are found in statistics of an existing database: indexes
+never scanned since the last statistics reset still cost disk space and
+an index update for every insert and non HOT update of their table.
+"""
+import tables
+
+query_unused_indexes = """
+SELECT
+    s.relid::regclass::text "table",
+    s.indexrelname "index",
+    pg_relation_size(s.indexrelid) "size",
+    t.n_tup_ins + t.n_tup_upd - t.n_tup_hot_upd "writes"
+FROM pg_stat_user_indexes s
+    JOIN pg_index i ON i.indexrelid = s.indexrelid
+    JOIN pg_stat_user_tables t ON t.relid = s.relid
+WHERE s.idx_scan = 0
+    AND NOT i.indisunique
+    AND s.relid IN (SELECT to_regclass(name) FROM unnest(%s::text[]) name)
+ORDER BY pg_relation_size(s.indexrelid) DESC;
+"""
+
+
+def primary_key_index(table):
+    """ Index backing the primary key of the table or None """
+    if not table.primary_key:
+        return None
+    name = '%s_pkey' % tables.split_name(table.name)[1]
+    return tables.Index(table.name, name, 'btree', [c.name for c in table.primary_key], unique=True)
+
+
+def normalized_fields(index):
+    return [f.strip() for f in index.fields]
+
+
+def redundant_indexes(table):
+    """
+    Return list of (index, covering index, reason) tuples for redundant indexes of the table.
+    Primary key and unique indexes are kept in favor of their non unique duplicates.
+    """
+    pk = primary_key_index(table)
+    candidates = list(table.indexes) + ([pk] if pk is not None else [])
+
+    ret = []
+    for idx, index in enumerate(candidates):
+        if index is pk:
+            continue
+        for other_idx, other in enumerate(candidates):
+            if other is index or other.method != index.method or other.predicate != index.predicate:
+                continue
+            fields = normalized_fields(index)
+            other_fields = normalized_fields(other)
+            if fields == other_fields:
+                if other is pk or (other.unique and not index.unique) or (
+                        other.unique == index.unique and other_idx < idx):
+                    ret.append((index, other, 'duplicate'))
+                    break
+            elif (index.method == 'btree' and not index.unique
+                    and len(fields) < len(other_fields) and other_fields[:len(fields)] == fields):
+                ret.append((index, other, 'prefix'))
+                break
+    return ret
+
+
+def unused_indexes(connection, tables_list):
+    """ Return list of (table, index, size in bytes, writes) of never scanned indexes of the tables """
+    cur = connection.cursor()
+    cur.execute(query_unused_indexes, ([t.name for t in tables_list],))
+    ret = cur.fetchall()
+    cur.close()
+    return ret
+
+
+def pretty_size(size):
+    for unit in ['bytes', 'kB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return '%d %s' % (size, unit)
+        size /= 1024
+    return '%d TB' % size
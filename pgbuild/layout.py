@@ -0,0 +1,157 @@
+"""
+Column alignment analysis of tables.
+
+Every fixed length value in a row is aligned to its type alignment, so
+columns in a bad order (e.g. boolean, bigint, boolean, bigint) waste
+padding bytes in every row. The analysis estimates padding of the
+current column order and of an order minimizing it: fixed length
+columns sorted by alignment, largest first, followed by variable
+length columns.
+
+Variable length values mostly have a short header and no alignment,
+so the offset after them is unknown and the next aligned column is
+counted with the average expected padding.
+"""
+
+MAXALIGN = 8
+
+alignments = {'c': 1, 's': 2, 'i': 4, 'd': 8}
+
+# (typlen, typalign) of built-in types, typlen -1 is a variable length type
+type_layouts = {
+    'boolean': (1, 'c'),
+    'bool': (1, 'c'),
+    '"char"': (1, 'c'),
+    'smallint': (2, 's'),
+    'int2': (2, 's'),
+    'smallserial': (2, 's'),
+    'integer': (4, 'i'),
+    'int': (4, 'i'),
+    'int4': (4, 'i'),
+    'serial': (4, 'i'),
+    'real': (4, 'i'),
+    'float4': (4, 'i'),
+    'date': (4, 'i'),
+    'oid': (4, 'i'),
+    'macaddr': (6, 'i'),
+    'bigint': (8, 'd'),
+    'int8': (8, 'd'),
+    'bigserial': (8, 'd'),
+    'double precision': (8, 'd'),
+    'float8': (8, 'd'),
+    'float': (8, 'd'),
+    'money': (8, 'd'),
+    'time': (8, 'd'),
+    'time without time zone': (8, 'd'),
+    'timestamp': (8, 'd'),
+    'timestamp without time zone': (8, 'd'),
+    'timestamptz': (8, 'd'),
+    'timestamp with time zone': (8, 'd'),
+    'timetz': (12, 'd'),
+    'time with time zone': (12, 'd'),
+    'interval': (16, 'd'),
+    'uuid': (16, 'c'),
+    'point': (16, 'd'),
+    'text': (-1, 'i'),
+    'varchar': (-1, 'i'),
+    'character varying': (-1, 'i'),
+    'char': (-1, 'i'),
+    'character': (-1, 'i'),
+    'bpchar': (-1, 'i'),
+    'bytea': (-1, 'i'),
+    'numeric': (-1, 'i'),
+    'decimal': (-1, 'i'),
+    'json': (-1, 'i'),
+    'jsonb': (-1, 'i'),
+    'xml': (-1, 'i'),
+    'inet': (-1, 'i'),
+    'cidr': (-1, 'i'),
+    'tsvector': (-1, 'i'),
+    'hstore': (-1, 'i'),
+}
+
+query_types_layouts = """
+SELECT t.name, p.typlen, p.typalign
+FROM unnest(%s::text[]) t(name)
+    JOIN pg_type p ON p.oid = to_regtype(t.name);
+"""
+
+
+def base_type(dtype):
+    """ Lower case type name without length modifier, arrays are reported as text[] """
+    dtype = dtype.strip().lower()
+    if dtype.endswith(']'):
+        return 'text[]'
+    if dtype.find('(') > 0:
+        dtype = dtype[0:dtype.find('(')].rstrip()
+    return dtype
+
+
+def load_layouts(connection, tables):
+    """ Fetch length and alignment of all column types of the tables from pg_type in one query """
+    names = set()
+    for table in tables:
+        for column in table.columns:
+            names.add(column.type)
+    cur = connection.cursor()
+    cur.execute(query_types_layouts, (list(names),))
+    ret = dict((name, (typlen, typalign)) for name, typlen, typalign in cur.fetchall())
+    cur.close()
+    return ret
+
+
+def column_layout(column, layouts=None):
+    """ Return (length, alignment) of a column, None for unknown types """
+    if layouts and column.type in layouts:
+        length, align = layouts[column.type]
+    else:
+        dtype = base_type(column.type)
+        if dtype == 'text[]':
+            length, align = -1, 'i'
+        elif dtype in type_layouts:
+            length, align = type_layouts[dtype]
+        else:
+            return None
+    return length, alignments[align]
+
+
+def row_padding(columns, layouts=None):
+    """ Estimated padding bytes of a row with all columns not null """
+    padding = 0.0
+    offset = 0  # None when unknown after a variable length value
+    for column in columns:
+        layout = column_layout(column, layouts)
+        if layout is None or layout[0] < 0:
+            offset = None
+            continue
+        length, align = layout
+        if offset is None:
+            padding += (align - 1) / 2.0
+            offset = 0
+        else:
+            padding += -offset % align
+            offset += -offset % align
+        offset += length
+    if offset is not None:
+        padding += -offset % MAXALIGN
+    return padding
+
+
+def optimal_order(columns, layouts=None):
+    """ Columns in order minimizing padding: fixed length by alignment, then variable length and unknown """
+    def key(item):
+        idx, column = item
+        layout = column_layout(column, layouts)
+        if layout is None:
+            return (2, 0, idx)
+        if layout[0] < 0:
+            return (1, 0, idx)
+        return (0, -layout[1], idx)
+
+    return [c for idx, c in sorted(enumerate(columns), key=key)]
+
+
+def analyze(table, layouts=None):
+    """ Return tuple of current padding, optimal padding and optimal order of the table columns """
+    order = optimal_order(table.columns, layouts)
+    return row_padding(table.columns, layouts), row_padding(order, layouts), order
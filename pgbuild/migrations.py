@@ -0,0 +1,146 @@
+"""
+Migration builds relative to a previous state of an application.
+
+Every build stores a snapshot of its roles (table and type definitions
+and hashes of the rest of tasks) in <role>/snapshot.yaml. A migration
+build compares roles with a previous build or with another application
+descriptor and keeps only the changes:
+
+    - tables and types are altered from their previous definitions
+    - other tasks are kept only if their content has changed
+"""
+import os
+import hashlib
+import yaml
+import tables
+import types
+import roles
+
+SNAPSHOT_FILE = 'snapshot.yaml'
+
+
+def file_hash(path):
+    """ sha1 of a file content read in blocks """
+    ret = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            ret.update(block)
+    return ret.hexdigest()
+
+
+def task_hash(task):
+    """ Hash identifying the content of a task """
+    content = task.sql_content
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    if task.task_type == 'copy':
+        content += file_hash(task.copy_from)
+    return hashlib.sha1(content).hexdigest()
+
+
+class Snapshot(object):
+    """ State of a role sufficient for computing migrations """
+
+    @classmethod
+    def from_role(cls, role):
+        snapshot = cls()
+        for task in role.tasks:
+            if task.task_type == 'table':
+                snapshot.tables[task.definition.name] = task.definition
+            elif task.task_type == 'type':
+                snapshot.types[task.definition.name] = task.definition
+            elif task.task_type != 'validate':
+                snapshot.task_hashes.add(task_hash(task))
+        return snapshot
+
+    @classmethod
+    def load_from_file(cls, path):
+        content = yaml.load(file(path).read())
+        snapshot = cls()
+        for table in content.get('tables', []):
+            table = tables.Table(table)
+            snapshot.tables[table.name] = table
+        for custom_type in content.get('types', []):
+            custom_type = types.Type(custom_type)
+            snapshot.types[custom_type.name] = custom_type
+        snapshot.task_hashes.update(content.get('tasks', []))
+        return snapshot
+
+    def __init__(self):
+        self.tables = {}
+        self.types = {}
+        self.task_hashes = set()
+
+    def dump(self):
+        return yaml.safe_dump({
+            'tables': [t.yaml_definition for t in self.tables.values()],
+            'types': [t.yaml_definition for t in self.types.values()],
+            'tasks': sorted(self.task_hashes)
+        }, default_flow_style=False)
+
+    def write(self, path):
+        open(path, 'w').write(self.dump())
+
+
+def load_snapshots(since):
+    """
+    Load snapshots of roles from a previous build directory or an application descriptor.
+    Return dict of role name to Snapshot.
+    """
+    ret = {}
+    if os.path.isdir(since):
+        for role_name in os.listdir(since):
+            path = os.path.join(since, role_name, SNAPSHOT_FILE)
+            if os.path.exists(path):
+                ret[role_name] = Snapshot.load_from_file(path)
+    else:
+        for role in roles.load_from_file(since):
+            ret[role.name] = Snapshot.from_role(role)
+    return ret
+
+
+def altered_task(task, sql, number=None, task_type=None):
+    """ Copy of the task with the alter script instead of its content """
+    ret = roles.SQLTask(number or task.number, task_type or task.task_type, sql, definition=task.definition)
+    for option in roles.task_options:
+        setattr(ret, option, getattr(task, option))
+    return ret
+
+
+def migration_tasks(role, snapshot, safe_not_null=False):
+    """
+    Return tasks of the role needed to migrate from the snapshot state.
+    Indexes of partitions and backfill of added columns go to separate tasks following the table alter,
+    validation of constraints added to existing tables goes to separate tasks at the end.
+    """
+    if snapshot is None:
+        return list(role.tasks)
+
+    ret = []
+    validations = []
+    for task in role.tasks:
+        if task.task_type == 'table' and task.definition.name in snapshot.tables:
+            previous = snapshot.tables[task.definition.name]
+            sql = previous.alter_to(task.definition, validate=False, safe_not_null=safe_not_null, backfill=False,
+                                    partition_indexes=False)
+            if sql:
+                ret.append(altered_task(task, sql))
+            sql = previous.partition_indexes_to(task.definition)
+            if sql:
+                ret.append(altered_task(task, sql, roles.indexes_number(task.number), 'indexes'))
+            sql = previous.backfill_to(task.definition)
+            if sql:
+                ret.append(altered_task(task, sql, roles.backfill_number(task.number), 'backfill'))
+            sql = previous.validate_to(task.definition, safe_not_null)
+            if sql:
+                validations.append(altered_task(task, sql, roles.validation_number(task.number), 'validate'))
+        elif task.task_type == 'type' and task.definition.name in snapshot.types:
+            sql = snapshot.types[task.definition.name].alter_to(task.definition)
+            if sql:
+                ret.append(altered_task(task, sql))
+        elif task.task_type == 'validate':
+            if task.definition.name not in snapshot.tables:
+                ret.append(task)
+        elif task.task_type in ('table', 'type') or task_hash(task) not in snapshot.task_hashes:
+            ret.append(task)
+    return ret + validations
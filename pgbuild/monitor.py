@@ -0,0 +1,261 @@
+"""
+Monitoring of a deployment session from a second connection.
+
+While a task runs, its backend is polled in pg_stat_activity:
+
+    - a statement waiting for a lock is reported with the lock, the number
+      of sessions queued behind it and the sessions holding it
+    - CREATE INDEX and COPY report their progress from
+      pg_stat_progress_create_index and pg_stat_progress_copy (PostgreSQL 12+ and 14+),
+      with the remaining time estimated from the rate of progress
+    - other statements running longer than the poll interval are reported with their duration
+
+COPY FROM STDIN doesn't know the size of its input, it is taken from the
+size of the local file being streamed.
+
+A statement waiting for a lock longer than cancel_after seconds is cancelled
+with pg_cancel_backend, so it stops blocking the traffic queued behind it.
+"""
+import time
+import threading
+import psycopg2
+import indexes
+
+DEFAULT_INTERVAL = 5.0
+
+query_progress_views = """
+SELECT
+    to_regclass('pg_catalog.pg_stat_progress_create_index') IS NOT NULL,
+    to_regclass('pg_catalog.pg_stat_progress_copy') IS NOT NULL;
+"""
+
+query_activity = """
+SELECT
+    state,
+    wait_event_type,
+    query_start,
+    extract(epoch FROM now() - query_start),
+    left(regexp_replace(query, '\\s+', ' ', 'g'), 80)
+FROM pg_stat_activity
+WHERE pid = %(pid)s;
+"""
+
+query_lock_wait = """
+SELECT
+    coalesce(l.relation::regclass::text, l.locktype),
+    l.mode,
+    (SELECT count(*) FROM pg_stat_activity a WHERE %(pid)s = ANY(pg_blocking_pids(a.pid)))
+FROM pg_locks l
+WHERE l.pid = %(pid)s AND NOT l.granted
+LIMIT 1;
+"""
+
+query_blockers = """
+SELECT
+    pid,
+    usename,
+    state,
+    extract(epoch FROM now() - coalesce(xact_start, query_start)),
+    left(regexp_replace(query, '\\s+', ' ', 'g'), 60)
+FROM pg_stat_activity
+WHERE pid = ANY(pg_blocking_pids(%(pid)s))
+ORDER BY pid;
+"""
+
+query_create_index_progress = """
+SELECT relid::regclass::text, phase, blocks_total, blocks_done, tuples_total, tuples_done
+FROM pg_stat_progress_create_index
+WHERE pid = %(pid)s;
+"""
+
+query_copy_progress = """
+SELECT relid::regclass::text, bytes_processed, bytes_total, tuples_processed
+FROM pg_stat_progress_copy
+WHERE pid = %(pid)s;
+"""
+
+query_cancel = """
+SELECT pg_cancel_backend(pid)
+FROM pg_stat_activity
+WHERE pid = %(pid)s AND wait_event_type = 'Lock' AND query_start = %(query_start)s;
+"""
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds / 3600, seconds % 3600 / 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds / 60, seconds % 60)
+    return '%ds' % seconds
+
+
+def fraction(done, total):
+    """ Done part of the total or None if the total is unknown """
+    if not total:
+        return None
+    return min(float(done) / total, 1.0)
+
+
+class Estimate(object):
+    """ Remaining time of an operation from its rate of progress since the first observation """
+
+    def __init__(self):
+        self.key = None
+        self.start = None
+        self.start_fraction = None
+
+    def update(self, key, done, now):
+        """
+        key - identity of the operation, e.g. statement start time and phase, other key restarts the estimate
+        done - done fraction of the operation
+        Return estimated remaining seconds or None if unknown yet
+        """
+        if key != self.key or done < self.start_fraction:
+            self.key = key
+            self.start = now
+            self.start_fraction = done
+            return None
+        if done <= self.start_fraction or now <= self.start:
+            return None
+        return (now - self.start) * (1.0 - done) / (done - self.start_fraction)
+
+
+def progress_message(title, done, remaining):
+    """ e.g. 'building index: scanning table 45% ETA 1m20s' """
+    ret = title
+    if done is not None:
+        ret += ' %d%%' % (done * 100)
+    if remaining is not None:
+        ret += ' ETA %s' % format_duration(remaining)
+    return ret
+
+
+class Monitor(object):
+
+    def __init__(self, dsn, pid, log, interval=DEFAULT_INTERVAL, cancel_after=None):
+        """
+        dsn - database of the monitored session, a separate connection is opened
+        pid - backend pid of the monitored session
+        log - callable receiving progress messages
+        interval - seconds between polls
+        cancel_after - cancel a statement waiting for a lock longer than that many seconds
+        """
+        self.dsn = dsn
+        self.pid = pid
+        self.log = log
+        self.interval = interval
+        self.cancel_after = cancel_after
+        self.title = 'statement'
+        self.expected_bytes = None
+        self.estimate = Estimate()
+        self.wait_key = None
+        self.wait_start = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.connection = None
+
+    def begin(self, title, expected_bytes=None):
+        """ Called by the monitored session before a task, expected_bytes is size of COPY input """
+        self.title = title
+        self.expected_bytes = expected_bytes
+
+    def start(self):
+        self.connection = psycopg2.connect(self.dsn)
+        # statistics views are a snapshot taken once per transaction
+        self.connection.autocommit = True
+        cur = self.connection.cursor()
+        cur.execute(query_progress_views)
+        self.has_index_progress, self.has_copy_progress = cur.fetchone()
+        cur.close()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.connection is not None:
+            self.connection.close()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except psycopg2.Error, e:
+                # monitoring never breaks the deployment
+                self.log('monitor stopped: %s' % str(e).strip())
+                return
+
+    def poll(self):
+        cur = self.connection.cursor()
+        try:
+            cur.execute(query_activity, {'pid': self.pid})
+            row = cur.fetchone()
+            if row is None or row[0] != 'active':
+                self.wait_key = None
+                return
+            state, wait_event_type, query_start, duration, query = row
+            if wait_event_type == 'Lock':
+                self.report_lock_wait(cur, query_start)
+                return
+            # a later wait of the same statement starts counting again
+            self.wait_key = None
+            if not self.report_progress(cur, query_start) and duration >= self.interval:
+                self.log('%s: running %s: %s' % (self.title, format_duration(duration), query))
+        finally:
+            cur.close()
+
+    def report_lock_wait(self, cur, query_start):
+        now = time.time()
+        if self.wait_key != query_start:
+            self.wait_key = query_start
+            self.wait_start = now - self.interval
+        waiting = now - self.wait_start
+
+        cur.execute(query_lock_wait, {'pid': self.pid})
+        row = cur.fetchone()
+        if row is None:
+            return
+        lock_object, mode, queued = row
+        self.log('%s: waiting %s for %s on %s, %s sessions queued behind' % (
+            self.title, format_duration(waiting), mode, lock_object, queued))
+        cur.execute(query_blockers, {'pid': self.pid})
+        for pid, user, state, duration, query in cur.fetchall():
+            self.log('    blocked by pid %s (%s, %s %s): %s' % (
+                pid, user, state, format_duration(duration or 0), query))
+
+        if self.cancel_after is not None and waiting >= self.cancel_after:
+            # the statement is cancelled only if it still waits, not the next one of the session
+            cur.execute(query_cancel, {'pid': self.pid, 'query_start': query_start})
+            if cur.fetchone() is not None:
+                self.log('%s: cancelled after waiting %s for a lock' % (self.title, format_duration(waiting)))
+            self.wait_key = None
+
+    def report_progress(self, cur, query_start):
+        """ Log progress of CREATE INDEX or COPY, return False if no such statement is running """
+        now = time.time()
+        if self.has_index_progress:
+            cur.execute(query_create_index_progress, {'pid': self.pid})
+            row = cur.fetchone()
+            if row is not None:
+                table, phase, blocks_total, blocks_done, tuples_total, tuples_done = row
+                done = fraction(blocks_done, blocks_total)
+                if done is None:
+                    done = fraction(tuples_done, tuples_total)
+                remaining = self.estimate.update((query_start, phase), done, now) if done is not None else None
+                self.log('%s: CREATE INDEX on %s: %s' % (self.title, table, progress_message(phase, done, remaining)))
+                return True
+
+        if self.has_copy_progress:
+            cur.execute(query_copy_progress, {'pid': self.pid})
+            row = cur.fetchone()
+            if row is not None:
+                table, bytes_processed, bytes_total, tuples = row
+                done = fraction(bytes_processed, bytes_total or self.expected_bytes)
+                remaining = self.estimate.update(query_start, done, now) if done is not None else None
+                self.log('%s: COPY %s: %s' % (self.title, table, progress_message(
+                    '%s rows, %s' % (tuples, indexes.pretty_size(bytes_processed)), done, remaining)))
+                return True
+        return False
@@ -1,8 +1,10 @@
 import os
+import hashlib
 import yaml
 import tables
 import functions
 import types
+import layout
 
 def full_path(path):
     """
@@ -25,9 +27,22 @@ def absrelpath(path, start):
     return ret_path
 
 
-def load_from_file(path):
+def load_from_file(path, optimize_layout=False, only_roles=None, only_types=None, registry=None):
+    """
+    Load roles of application descriptor.
+    optimize_layout - create tables with columns ordered to minimize alignment padding
+    only_roles - names of roles to load, other roles aren't loaded at all
+    only_types - item types to load (table, function, ...), items of other types are skipped
+    registry - Registry shared by all roles, a new one if not given
+    """
+    return list(iter_roles(path, optimize_layout, only_roles, only_types, registry))
+
 
-    ret = []
+def iter_roles(path, optimize_layout=False, only_roles=None, only_types=None, registry=None):
+    """ Generate roles of application descriptor one by one, see load_from_file """
+
+    if registry is None:
+        registry = Registry()
     content = file(path).read()
     yaml_content = yaml.load(content)
 
@@ -36,101 +51,338 @@ def load_from_file(path):
             if isinstance(module, str):
                 module = absrelpath(module, os.path.dirname(path))
                 module_content = yaml.load(file(module).read())
-                ret += get_roles(module_content, module)
+                for role in get_roles(module_content, module, optimize_layout, only_roles, only_types, registry):
+                    yield role
             else:
-                ret += get_roles(module, path)
+                for role in get_roles(module, path, optimize_layout, only_roles, only_types, registry):
+                    yield role
 
     else:
-        ret += get_roles(yaml_content, path)
-    return ret
+        for role in get_roles(yaml_content, path, optimize_layout, only_roles, only_types, registry):
+            yield role
 
 
-def get_roles(content, path):
-    ret = []
+def get_roles(content, path, optimize_layout=False, only_roles=None, only_types=None, registry=None):
+    """ Generate roles of descriptor content """
     for role_name in content.keys():
-        role = Role(role_name, content[role_name], os.path.dirname(os.path.abspath(path)))
-        ret.append(role)
+        if only_roles and role_name not in only_roles:
+            continue
+        role = Role(role_name, content[role_name], os.path.dirname(os.path.abspath(path)), optimize_layout,
+                    only_types, registry)
+        role.descriptor_path = full_path(path)
+        yield role
+
+
+def referenced_paths(path):
+    """
+    Best effort list of files referenced by application descriptor, descriptors of modules included.
+    Unlike sources of roles it's available when roles can't be loaded, parts which can't be read are skipped.
+    """
+    ret = [full_path(path)]
+    try:
+        content = yaml.load(file(path).read())
+    except Exception:
+        return ret
+    descriptors = [(content, path)]
+    if isinstance(content, list):
+        descriptors = []
+        for module in content:
+            if isinstance(module, basestring):
+                module = absrelpath(module, os.path.dirname(path))
+                ret.append(module)
+                try:
+                    descriptors.append((yaml.load(file(module).read()), module))
+                except Exception:
+                    continue
+            else:
+                descriptors.append((module, path))
+    for descriptor, descriptor_path in descriptors:
+        start = os.path.dirname(os.path.abspath(descriptor_path))
+        for items in (descriptor.values() if isinstance(descriptor, dict) else []):
+            for item in (items if isinstance(items, list) else []):
+                if not isinstance(item, dict):
+                    continue
+                for item_type in ['table', 'function', 'type']:
+                    if isinstance(item.get(item_type), basestring):
+                        ret.append(absrelpath(item[item_type], start))
+                if isinstance(item.get('copy'), dict) and isinstance(item['copy'].get('from'), basestring):
+                    ret.append(absrelpath(item['copy']['from'], start))
     return ret
 
 
 class RoleError(Exception):
     pass
 
+
+class Registry(object):
+    """
+    Definitions and artifacts of a build.
+    A file referenced by many roles or modules is loaded once per its content,
+    byte-identical task files of a build are hard links to a single file.
+    """
+
+    def __init__(self):
+        self.definitions = {}
+        self.artifacts = {}  # content hash to path and stat signature of the first file with the content
+
+    def definition(self, path, load, *key):
+        """
+        Return result of load(path), it's called once for the same content of the file.
+        key - additional properties the result depends on
+        """
+        key = (path, hashlib.sha1(file(path, 'rb').read()).hexdigest()) + key
+        if key not in self.definitions:
+            self.definitions[key] = load(path)
+        return self.definitions[key]
+
+    @staticmethod
+    def signature(path):
+        """ Inode, size and modification time of a file, None if it doesn't exist """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def link_artifact(self, path, digest):
+        """
+        Replace the written file by a hard link to a file with the same content if there is one.
+        Files rewritten or removed since they were registered aren't linked to.
+        """
+        existing = self.artifacts.get(digest)
+        if existing is None or existing[0] == path or self.signature(existing[0]) != existing[1]:
+            self.artifacts[digest] = (path, self.signature(path))
+            return
+        try:
+            os.link(existing[0], path + '.link')
+        except OSError:  # e.g. another file system, the copy is kept
+            return
+        os.rename(path + '.link', path)
+
+
+# options which can be given to any role item along with its type, e.g.
+#   - table: path/to/mytable.yaml
+#     lock_timeout: 2s
+#     retries: 5
+task_options = ['lock_timeout', 'retries']
+
+
+def get_item_type(item):
+    item_types = [k for k in item.keys() if k not in task_options]
+    if len(item_types) != 1:
+        raise RoleError('Role item must have exactly one type: %s' % ', '.join(item.keys()))
+    return item_types[0]
+
 class Role(dict):
 
-    def __init__(self, name, descriptor, relpath_start):
+    def __init__(self, name, descriptor, relpath_start, optimize_layout=False, only_types=None, registry=None):
         self.name = name
         self.descriptor = descriptor
         self.relpath_start = relpath_start
+        self.optimize_layout = optimize_layout
+        self.only_types = only_types
+        self.registry = registry or Registry()
+        self.descriptor_path = None
+        self.items = {}  # descriptor item number to its task and validation task or None
         self.tasks = []
 
         self._build_tasks()
 
+    @property
+    def sources(self):
+        """ Files the role is made of """
+        ret = [self.descriptor_path] if self.descriptor_path else []
+        return ret + [self.items[idx][0].source for idx in sorted(self.items) if self.items[idx][0].source]
 
     def _build_tasks(self):
-
         for idx, item in enumerate(self.descriptor):
-            item_type = item.keys()[0]
-
-            if item_type == 'schema':
-                sql = 'CREATE SCHEMA IF NOT EXISTS %s;\n' % item[item_type]
-                self.tasks.append(SQLTask(idx, item_type, sql))
-
-            elif item_type == 'table':
-
-                table_path = item[item_type]
-                table_path = absrelpath(table_path, self.relpath_start)
-                table = tables.Table.load_from_yaml_file(table_path)
-                sql = table.create_clause()
-                self.tasks.append(SQLTask(idx, item_type, sql))
-
-            elif item_type == 'function':
-                func_path = item[item_type]
-                func_path = absrelpath(func_path, self.relpath_start)
-                function = functions.Function.load_from_file(func_path)
-                sql = unicode(function.script, 'utf-8')
-                self.tasks.append(SQLTask(idx, item_type, sql))
-
-            elif item_type == 'sql':
-                sql = item[item_type].rstrip().rstrip(';')+';\n'
-                self.tasks.append(SQLTask(idx, item_type, sql))
-
-            elif item_type == 'type':
-                item_path = item[item_type]
-                item_path = absrelpath(item_path, self.relpath_start)
-                custom_type = types.Type.load_from_yaml_file(item_path)
-                sql = custom_type.drop_clause() + custom_type.create_clause()
-                self.tasks.append(SQLTask(idx, item_type, sql))
-
-            #elif item_type == 'job':
-            #    self.jobs.append(item[item_type])
-
-            elif item_type == 'copy':
-                table= item[item_type]['table']
-                columns = item[item_type]['columns']
-                copy_from = item[item_type].get('from')
-                copy_from = absrelpath(copy_from, self.relpath_start)
-                copy_format = item[item_type].get('format')
-                delimiter = item[item_type].get('delimiter')
-                quote = item[item_type].get('quote')
-                task = CSVTask(idx, item_type, table, columns,
-                    copy_from = copy_from,
-                    copy_format = copy_format,
-                    delimiter = delimiter,
-                    quote = quote
-                    )
-                self.tasks.append(task)
+            # item numbers stay the same when some types are skipped
+            if self.only_types and get_item_type(item) not in self.only_types:
+                continue
+            self.items[idx] = self._build_item(idx, item)
+        self._collect_tasks()
+
+    def _collect_tasks(self):
+        items = [self.items[idx] for idx in sorted(self.items)]
+        # validation of constraints runs after all other tasks
+        self.tasks = [task for task, validation in items]
+        self.tasks += [validation for task, validation in items if validation is not None]
+
+    def _build_item(self, idx, item):
+        """ Return tuple of the task of a descriptor item and its validation task or None """
+
+        item_type = get_item_type(item)
+        source = None
+        validation = None
+
+        if item_type == 'schema':
+            sql = 'CREATE SCHEMA IF NOT EXISTS %s;\n' % item[item_type]
+            task = SQLTask(idx, item_type, sql)
+
+        elif item_type == 'table':
+
+            table_path = item[item_type]
+            table_path = absrelpath(table_path, self.relpath_start)
+            source = table_path
+            table = self.registry.definition(table_path, self._load_table, self.optimize_layout)
+            # DDL of the table is rendered on demand, see SQLTask.iter_sql
+            task = SQLTask(idx, item_type, None, definition=table,
+                           render=lambda: table.iter_create_clause(validate=False))
+            if table.check:
+                validation = SQLTask(validation_number(idx), 'validate', table.validate_clause(), definition=table)
+
+        elif item_type == 'function':
+            func_path = item[item_type]
+            func_path = absrelpath(func_path, self.relpath_start)
+            source = func_path
+            function, sql = self.registry.definition(func_path, self._load_function)
+            task = SQLTask(idx, item_type, sql, definition=function)
+
+        elif item_type == 'sql':
+            sql = item[item_type].rstrip().rstrip(';')+';\n'
+            task = SQLTask(idx, item_type, sql)
+
+        elif item_type == 'type':
+            item_path = item[item_type]
+            item_path = absrelpath(item_path, self.relpath_start)
+            source = item_path
+            custom_type, sql = self.registry.definition(item_path, self._load_type)
+            task = SQLTask(idx, item_type, sql, definition=custom_type)
+
+        #elif item_type == 'job':
+        #    self.jobs.append(item[item_type])
+
+        elif item_type == 'copy':
+            table= item[item_type]['table']
+            columns = item[item_type]['columns']
+            copy_from = item[item_type].get('from')
+            copy_from = absrelpath(copy_from, self.relpath_start)
+            source = copy_from
+            copy_format = item[item_type].get('format')
+            delimiter = item[item_type].get('delimiter')
+            quote = item[item_type].get('quote')
+            encoding = item[item_type].get('encoding', 'utf-8')
+            task = CSVTask(idx, item_type, table, columns,
+                copy_from = copy_from,
+                copy_format = copy_format,
+                delimiter = delimiter,
+                quote = quote,
+                encoding = encoding
+                )
+
+        else:
+            raise RoleError('Unknown role item type "%s"' % item_type)
+
+        task.source = source
+        for option in task_options:
+            setattr(task, option, item.get(option))
+            if validation is not None:
+                setattr(validation, option, item.get(option))
+
+        return task, validation
+
+    def _load_table(self, path):
+        table = tables.Table.load_from_yaml_file(path)
+        if self.optimize_layout:
+            table.columns = tables.ColumnsList(layout.optimal_order(table.columns))
+        return table
+
+    def _load_function(self, path):
+        function = functions.Function.load_from_file(path)
+        return function, unicode(function.script, 'utf-8')
+
+    def _load_type(self, path):
+        custom_type = types.Type.load_from_yaml_file(path)
+        return custom_type, custom_type.create_or_alter_clause()
+
+    def rebuild(self, changed):
+        """
+        Render again only tasks made of changed files.
+        changed - set of full paths of changed files
+        Return list of the new tasks.
+        """
+        ret = []
+        for idx in sorted(self.items):
+            if self.items[idx][0].source in changed:
+                self.items[idx] = self._build_item(idx, self.descriptor[idx])
+                ret += [t for t in self.items[idx] if t is not None]
+        if ret:
+            self._collect_tasks()
+        return ret
+
+    def get_table(self, name):
+        """ Return Table defined by the role with the given name or None """
+        for task in self.tasks:
+            if task.task_type == 'table' and task.definition.name == name:
+                return task.definition
+        return None
 
-            else:
-                raise RoleError('Unknown role item type "%s"' % item_type)
+
+def validation_number(number):
+    """ Number of a task validating constraints created by the task with given number """
+    return '%s_validate' % number
+
+
+def backfill_number(number):
+    """ Number of a task populating columns added by the task with given number """
+    return '%s_backfill' % number
+
+
+def indexes_number(number):
+    """ Number of a task building indexes of partitions for the task with given number """
+    return '%s_indexes' % number
+
+
+# types of tasks managing transactions themselves, they can't run in a single transaction
+non_transactional_types = ['backfill', 'indexes']
 
 
 class SQLTask(object):
 
-    def __init__(self, number, task_type, sql_content):
+    def __init__(self, number, task_type, sql_content, definition=None, render=None):
+        """
+        sql_content - SQL of the task or None if it's rendered on demand
+        render - function generating SQL of the task in chunks
+        """
         self.number = number
         self.task_type = task_type
-        self.sql_content = sql_content
+        self._sql_content = sql_content
+        self.render = render
+        self.definition = definition  # Table, Type or Function the task was rendered from
+        self.source = None  # file the task was rendered from
+        self.lock_timeout = None
+        self.retries = None
+
+    @property
+    def sql_content(self):
+        if self._sql_content is None and self.render is not None:
+            return u''.join(self.render())
+        return self._sql_content
+
+    def iter_sql(self):
+        """ Generate SQL of the task in chunks, rendered SQL isn't kept in memory """
+        if self._sql_content is None and self.render is not None:
+            return self.render()
+        return iter([self._sql_content])
+
+    @property
+    def psql_options(self):
+        if not self.retries or self.task_type in non_transactional_types:
+            return ''
+        return ' --single-transaction'
+
+    @property
+    def options_entry(self):
+        entry = ''
+        if self.retries:
+            entry += """  register: result
+  until: result.rc == 0
+  retries: {0}
+  delay: 5
+""".format(self.retries)
+        if self.task_type == 'validate':  # run or skip separately with --tags/--skip-tags validate
+            entry += "  tags: validate\n"
+        return entry
 
     @property
     def transfer_entry(self):
@@ -145,11 +397,11 @@ class SQLTask(object):
 
         return """
 - name: deploy {0}.sql
-  command: psql -f /tmp/.pgbuild/run/{0}.sql -d {{{{cluster_name}}}}{{{{'_%02d'|format(item)}}}} -p {{{{port}}}} --set=ON_ERROR_STOP=1
+  command: psql -f /tmp/.pgbuild/run/{0}.sql -d {{{{cluster_name}}}}{{{{'_%02d'|format(item)}}}} -p {{{{port}}}} --set=ON_ERROR_STOP=1{1}
   with_items: hostvars[inventory_hostname].shards
   sudo: yes
   sudo_user: postgres
-""".format(self.number)
+{2}""".format(self.number, self.psql_options, self.options_entry)
 
 
     @property
@@ -157,15 +409,15 @@ class SQLTask(object):
 
         return """
 - name: deploy {0}.sql
-  command: psql -f /tmp/.pgbuild/run/{0}.sql -d {{{{cluster_name}}}} -p {{{{port}}}} --set=ON_ERROR_STOP=1
+  command: psql -f /tmp/.pgbuild/run/{0}.sql -d {{{{cluster_name}}}} -p {{{{port}}}} --set=ON_ERROR_STOP=1{1}
   sudo: yes
   sudo_user: postgres
-""".format(self.number)
+{2}""".format(self.number, self.psql_options, self.options_entry)
 
 
 class CSVTask(object):
     def __init__(self, number, task_type, table, columns,
-        copy_from, copy_format, delimiter, quote):
+        copy_from, copy_format, delimiter, quote, encoding='utf-8'):
         self.number = number
         self.task_type = task_type
         self.table = table
@@ -174,6 +426,10 @@ class CSVTask(object):
         self.copy_format = copy_format
         self.delimiter = delimiter
         self.quote = quote
+        self.encoding = encoding
+        self.source = copy_from
+        self.lock_timeout = None
+        self.retries = None
 
     @property
     def transfer_entry(self):
@@ -230,3 +486,22 @@ COPY {table} ({columns})
     delimiter=self.delimiter,
     quote=self.quote
 )
+
+    def iter_sql(self):
+        return iter([self.sql_content])
+
+    @property
+    def copy_stdin_clause(self):
+        """ COPY statement reading the data from client """
+        options = []
+        if self.copy_format:
+            options.append(self.copy_format)
+        if self.delimiter:
+            options.append("DELIMITER '%s'" % self.delimiter)
+        if self.quote:
+            options.append("QUOTE '%s'" % self.quote)
+        return "COPY {table} ({columns}) FROM STDIN {options}".format(
+            table=self.table,
+            columns=', '.join(self.columns),
+            options=' '.join(options)
+        )
@@ -0,0 +1,208 @@
+"""
+pgbuild daemon answering ddl, diff and build requests over a unix socket.
+
+Parsed tables and application roles are kept in memory and reloaded only
+when modification time of any of their source files changes, connections
+to databases are kept open in pools. Requests are handled one at a time,
+every request and response is a JSON line:
+
+    {"command": "diff", "args": ["/path/a.yaml", "postgresql://host/db/my.table"], "options": {"safe_not_null": true}}
+    {"ok": true, "output": "ALTER TABLE ..."}
+    {"ok": false, "error": "..."}
+
+Paths in requests must be absolute, the daemon doesn't know the working
+directory of its clients.
+"""
+import os
+import sys
+import copy
+import json
+import socket
+import SocketServer
+import StringIO
+import tables
+import roles
+import builder
+import migrations
+import validate
+
+DEFAULT_SOCKET = '/tmp/pgbuild.sock'
+
+
+class ServerError(Exception):
+    pass
+
+
+def mtimes(paths):
+    """ Return dict of path to its modification time, None for missing files """
+    ret = {}
+    for path in paths:
+        try:
+            ret[path] = os.stat(path).st_mtime
+        except OSError:
+            ret[path] = None
+    return ret
+
+
+class ModelCache(object):
+    """ Models loaded from files, valid until any of their source files changes """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key, load):
+        """
+        Return the cached model of the key or load it again if its sources have changed.
+        load - function returning tuple of model and list of its source files
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            model, sources, times = entry
+            if mtimes(sources) == times:
+                return model
+        model, sources = load()
+        self.entries[key] = (model, sources, mtimes(sources))
+        return model
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            response = self.server.pgbuild.respond(line)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class Server(object):
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, log=None, max_connections=4):
+        self.socket_path = socket_path
+        self.log = log or (lambda message: None)
+        self.max_connections = max_connections
+        self.cache = ModelCache()
+        self.pools = {}
+        self.commands = {
+            'ddl': self.ddl,
+            'diff': self.diff,
+            'build': self.build
+        }
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = SocketServer.UnixStreamServer(self.socket_path, RequestHandler)
+        server.pgbuild = self
+        self.log('listening on %s' % self.socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.socket_path)
+            for pool in self.pools.values():
+                pool.closeall()
+
+    def respond(self, line):
+        """ Handle a request line, output printed by the command is returned along with its result """
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            request = json.loads(line)
+            command = self.commands.get(request.get('command'))
+            if command is None:
+                raise ServerError('unknown command %s' % request.get('command'))
+            options = dict((str(k), v) for k, v in request.get('options', {}).items())
+            result = command(*request.get('args', []), **options)
+            response = {'ok': True, 'output': sys.stdout.getvalue() + (result or '')}
+        except Exception, e:
+            response = {'ok': False, 'error': str(e)}
+        finally:
+            sys.stdout = stdout
+        self.log('%s: %s' % (line.strip(), 'done' if response['ok'] else response['error']))
+        return response
+
+    def table(self, location):
+        """ Table of a yaml file or of a database location postgresql://.../table_name """
+        if location.startswith('postgresql://'):
+            connstr, table_name = location.rsplit('/', 1)
+            return self.existing_table(connstr, table_name)
+        path = roles.full_path(location)
+        return self.cache.get(('table', path), lambda: (tables.Table.load_from_yaml_file(path), [path]))
+
+    def existing_table(self, connstr, table_name):
+        import psycopg2.pool
+        pool = self.pools.get(connstr)
+        if pool is None:
+            pool = psycopg2.pool.SimpleConnectionPool(1, self.max_connections, connstr)
+            self.pools[connstr] = pool
+        conn = pool.getconn()
+        broken = True
+        try:
+            table = tables.Table.load_from_connection(conn, table_name)
+            conn.rollback()
+            broken = False
+        finally:
+            # a connection left in a failed transaction is not reused
+            pool.putconn(conn, close=broken)
+        return table
+
+    def roles(self, path, optimize_layout=False, only_roles=None, only_types=None):
+        """ Roles of an application descriptor """
+        path = roles.full_path(path)
+
+        def load():
+            app_roles = roles.load_from_file(path, optimize_layout, only_roles, only_types)
+            sources = set([path])
+            for role in app_roles:
+                sources.update(role.sources)
+            return app_roles, sorted(sources)
+
+        key = ('roles', path, optimize_layout, tuple(only_roles or []), tuple(only_types or []))
+        return self.cache.get(key, load)
+
+    def ddl(self, location):
+        return self.table(location).create_clause()
+
+    def diff(self, location1, location2, safe_not_null=False):
+        return self.table(location1).diff_to(self.table(location2), safe_not_null=safe_not_null)
+
+    def build(self, src, dest, build_format='psql', validate_data=False, jobs=None, since=None,
+              safe_not_null=False, optimize_layout=False, only_roles=None, only_types=None):
+        app_roles = self.roles(src, optimize_layout, only_roles, only_types)
+        if validate_data:
+            errors = validate.validate_roles(app_roles, jobs)
+            if errors:
+                raise ServerError('\n'.join(errors))
+
+        if since and not os.path.isdir(since):
+            snapshots = dict((r.name, migrations.Snapshot.from_role(r)) for r in self.roles(since))
+        elif since:
+            snapshots = migrations.load_snapshots(since)
+
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        # cached roles keep their registry, files of previous builds may be rewritten independently
+        for role in app_roles:
+            role.registry.artifacts.clear()
+        for role in app_roles:
+            snapshot = migrations.Snapshot.from_role(role)
+            if since:
+                # cached role stays intact
+                role = copy.copy(role)
+                role.tasks = migrations.migration_tasks(role, snapshots.get(role.name), safe_not_null)
+            builder.builders.get(build_format)(role, dest)
+            snapshot.write(os.path.join(dest, role.name, migrations.SNAPSHOT_FILE))
+
+
+def request(socket_path, command, args, **options):
+    """ Send a request to the daemon, return its output """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({'command': command, 'args': args, 'options': options}) + '\n')
+        response = json.loads(sock.makefile('r').readline())
+    finally:
+        sock.close()
+    if not response['ok']:
+        raise ServerError(response['error'])
+    return response['output']
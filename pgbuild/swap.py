@@ -0,0 +1,327 @@
+"""
+Deployment of a table definition by swapping in a rebuilt copy of the table.
+
+Instead of DROP and CREATE the existing table keeps serving reads and
+writes while its new version is built next to it:
+
+    1. shadow table {table}__pgbuild_new is created with the new definition,
+       without indexes; a trigger logs primary keys of rows written
+       to the table into {table}__pgbuild_log
+    2. rows are copied to the shadow table in chunks ranged by primary key,
+       every chunk in its own transaction
+    3. indexes are built on the shadow table
+    4. logged rows are replayed: deleted from the shadow table and copied
+       again, until the log is short
+    5. under a short ACCESS EXCLUSIVE lock the rest of the log is replayed,
+       sequences are moved on to the values of the old ones, the old table
+       is dropped and the shadow table with its indexes and sequences takes
+       over the names
+
+Columns present in both versions are copied, new columns get their
+defaults. The table needs a primary key kept by the new definition.
+Owner, privileges and comments of the old table are moved to the new one,
+comments of the new definition take precedence.
+Tables referenced by foreign keys or views and partitioned tables are
+refused, as their dependents would stay bound to the old table, and so
+are tables with triggers, row level security policies or column privileges,
+which aren't moved. TRUNCATE of the table while it's being swapped is not captured.
+"""
+import copy
+import tables
+
+query_exists = "SELECT to_regclass(%s) IS NOT NULL;"
+
+query_dependents = """
+SELECT 'foreign key ' || conname || ' of ' || conrelid::regclass::text
+FROM pg_constraint
+WHERE confrelid = to_regclass(%(table)s) AND contype = 'f'
+UNION
+SELECT 'view ' || r.ev_class::regclass::text
+FROM pg_depend d
+    JOIN pg_rewrite r ON r.oid = d.objid
+WHERE d.refobjid = to_regclass(%(table)s) AND r.ev_class <> d.refobjid
+UNION
+SELECT 'trigger ' || tgname
+FROM pg_trigger
+WHERE tgrelid = to_regclass(%(table)s) AND NOT tgisinternal AND tgname <> 'pgbuild_swap'
+UNION
+SELECT 'policy ' || polname
+FROM pg_policy
+WHERE polrelid = to_regclass(%(table)s)
+UNION
+SELECT 'privileges of column ' || attname
+FROM pg_attribute
+WHERE attrelid = to_regclass(%(table)s) AND attacl IS NOT NULL;
+"""
+
+query_owner = "SELECT pg_get_userbyid(relowner) FROM pg_class WHERE oid = to_regclass(%s);"
+
+query_privileges = """
+SELECT
+    a.privilege_type,
+    CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+    a.is_grantable
+FROM pg_class c, aclexplode(c.relacl) a
+WHERE c.oid = to_regclass(%s) AND a.grantee <> c.relowner;
+"""
+
+query_comments = """
+SELECT NULL, obj_description(to_regclass(%(table)s), 'pg_class')
+UNION ALL
+SELECT attname, col_description(attrelid, attnum)
+FROM pg_attribute
+WHERE attrelid = to_regclass(%(table)s) AND attnum > 0 AND NOT attisdropped;
+"""
+
+query_sequences = "SELECT pg_get_serial_sequence(%s, %s), pg_get_serial_sequence(%s, %s);"
+
+query_primary_key_name = "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p';"
+
+swap_log = """DROP TRIGGER IF EXISTS pgbuild_swap ON {table};
+DROP TABLE IF EXISTS {shadow};
+DROP TABLE IF EXISTS {log};
+DROP FUNCTION IF EXISTS {log}();
+CREATE UNLOGGED TABLE {log} (
+    pgbuild_id bigserial PRIMARY KEY,
+    {key_columns}
+);
+CREATE FUNCTION {log}() RETURNS trigger LANGUAGE plpgsql AS $swap$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        INSERT INTO {log} ({key}) VALUES ({old_key});
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO {log} ({key}) VALUES ({new_key});
+    END IF;
+    RETURN NULL;
+END
+$swap$;
+CREATE TRIGGER pgbuild_swap AFTER INSERT OR UPDATE OR DELETE ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE {log}();
+"""
+
+
+class SwapError(Exception):
+    pass
+
+
+def suffixed_name(name, suffix):
+    """ Schema qualified name with the suffix, shortened to fit identifier length limit """
+    relname = name.split('.')[-1]
+    return tables.qualify_name(name, relname[:63 - len(suffix)] + suffix)
+
+
+class Swap(object):
+
+    def __init__(self, executor, existing, table, batch_size=10000):
+        """
+        executor - executor.Executor running the transactions, its lock_timeout and retries apply
+        existing - tables.Table loaded from the connection
+        table - new definition of the table
+        batch_size - number of rows copied or replayed in one transaction
+        """
+        if table.partition_method or existing.partition_method:
+            raise SwapError('partitioned table %s can not be swapped' % table.name)
+        if not existing.primary_key:
+            raise SwapError('table %s without primary key can not be swapped' % table.name)
+        self.executor = executor
+        self.existing = existing
+        self.table = table
+        self.batch_size = batch_size
+
+        self.key = [c.name for c in existing.primary_key]
+        for name in self.key:
+            if not table.columns.has_column(name):
+                raise SwapError('primary key column %s is dropped, table %s can not be swapped' % (
+                    name, table.name))
+        self.columns = [c.name for c in table.columns if existing.columns.has_column(c.name)]
+        for column in table.columns:
+            if column.name not in self.columns and column.not_null and column.default is None:
+                raise SwapError('new column %s.%s is not null and has no default' % (table.name, column.name))
+
+        # values of GENERATED ALWAYS identity columns are copied as they are
+        always = [c for c in table.columns if c.identity == 'always' and c.name in self.columns]
+        self.overriding = ' OVERRIDING SYSTEM VALUE' if always else ''
+
+        self.shadow_name = suffixed_name(table.name, '__pgbuild_new')
+        self.log_name = suffixed_name(table.name, '__pgbuild_log')
+
+    def index_name(self, index):
+        """ Temporary name of the index on the shadow table """
+        return index.name[:63 - len('__pgbuild')] + '__pgbuild'
+
+    def setup_clause(self):
+        """ Log of written keys with its trigger and the shadow table without indexes """
+        key_types = dict((c.name, c.type) for c in self.existing.columns)
+        ret = swap_log.format(
+            table=self.table.name,
+            shadow=self.shadow_name,
+            log=self.log_name,
+            key_columns=',\n    '.join('%s %s' % (k, key_types[k]) for k in self.key),
+            key=', '.join(self.key),
+            old_key=', '.join('OLD.%s' % k for k in self.key),
+            new_key=', '.join('NEW.%s' % k for k in self.key))
+
+        shadow = copy.deepcopy(self.table)
+        shadow.name = self.shadow_name
+        shadow.indexes = tables.IndexesList()
+        for check in shadow.check:
+            check.table = self.shadow_name
+        ret += shadow.create_clause()
+        return ret
+
+    def indexes_clause(self):
+        return ''.join(index.create_clause(table=self.shadow_name, name=self.index_name(index))
+                       for index in self.table.indexes)
+
+    def key_clause(self):
+        return '(%s)' % ', '.join(self.key)
+
+    def copy_chunk(self, cur, last):
+        """ Copy rows following the key last, return key of the last copied row or None if none left """
+        key = self.key_clause()
+        params = {'last': tuple(last) if last is not None else None}
+        where = 'WHERE %s > %%(last)s' % key if last is not None else ''
+        cur.execute('SELECT %s FROM (SELECT %s FROM %s %s ORDER BY %s LIMIT %d) chunk ORDER BY %s LIMIT 1' % (
+            ', '.join(self.key), ', '.join(self.key), self.table.name, where, ', '.join(self.key), self.batch_size,
+            ', '.join('%s DESC' % k for k in self.key)), params)
+        row = cur.fetchone()
+        if row is None:
+            return None
+        params['next'] = tuple(row)
+        columns = ', '.join(self.columns)
+        cur.execute('INSERT INTO %s (%s)%s SELECT %s FROM %s %s %s %s <= %%(next)s' % (
+            self.shadow_name, columns, self.overriding, columns, self.table.name, where, 'AND' if where else 'WHERE',
+            key), params)
+        return row
+
+    def replay(self, cur, limit=None):
+        """ Replay up to limit logged rows, all if limit is None, return number of replayed log entries """
+        if limit is None:
+            cur.execute('SELECT max(pgbuild_id), count(*) FROM %s' % self.log_name)
+        else:
+            cur.execute('SELECT max(pgbuild_id), count(*) FROM (SELECT pgbuild_id FROM %s ORDER BY pgbuild_id LIMIT %d) l' % (
+                self.log_name, limit))
+        upto, count = cur.fetchone()
+        if not count:
+            return 0
+        key = self.key_clause()
+        columns = ', '.join(self.columns)
+        logged = 'SELECT %s FROM %s WHERE pgbuild_id <= %%(upto)s' % (', '.join(self.key), self.log_name)
+        cur.execute('DELETE FROM %s WHERE %s IN (%s)' % (self.shadow_name, key, logged), {'upto': upto})
+        cur.execute('INSERT INTO %s (%s)%s SELECT %s FROM %s WHERE %s IN (%s)' % (
+            self.shadow_name, columns, self.overriding, columns, self.table.name, key, logged), {'upto': upto})
+        cur.execute('DELETE FROM %s WHERE pgbuild_id <= %%(upto)s' % self.log_name, {'upto': upto})
+        return count
+
+    def move_attributes(self, cur):
+        """ Give the shadow table owner, privileges and comments of the table """
+        cur.execute(query_owner, (self.table.name,))
+        cur.execute('ALTER TABLE %s OWNER TO %s' % (self.shadow_name, cur.fetchone()[0]))
+        cur.execute(query_privileges, (self.table.name,))
+        for privilege, grantee, grantable in cur.fetchall():
+            cur.execute('GRANT %s ON %s TO %s%s' % (
+                privilege, self.shadow_name, grantee, ' WITH GRANT OPTION' if grantable else ''))
+
+        cur.execute(query_comments, {'table': self.table.name})
+        for column, comment in cur.fetchall():
+            if comment is None:
+                continue
+            if column is None and self.table.description is None:
+                cur.execute('COMMENT ON TABLE %s IS %%s' % self.shadow_name, (comment,))
+            elif column in self.columns and self.table.columns.get_column(column).description is None:
+                cur.execute('COMMENT ON COLUMN %s.%s IS %%s' % (self.shadow_name, column), (comment,))
+
+    def switch(self, cur):
+        """ Replace the table with the shadow table, run under ACCESS EXCLUSIVE lock """
+        cur.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % self.table.name)
+        self.replay(cur)
+
+        sequences = []
+        for column in self.columns:
+            cur.execute(query_sequences, (self.table.name, column, self.shadow_name, column))
+            old_sequence, new_sequence = cur.fetchone()
+            if old_sequence and new_sequence:
+                cur.execute('SELECT setval(%%s, last_value, is_called) FROM %s' % old_sequence, (new_sequence,))
+                sequences.append((old_sequence, new_sequence))
+        self.move_attributes(cur)
+
+        name = self.table.name.split('.')[-1]
+        cur.execute('DROP TABLE %s' % self.table.name)
+        cur.execute('ALTER TABLE %s RENAME TO %s' % (self.shadow_name, name))
+        cur.execute('DROP TABLE %s' % self.log_name)
+        cur.execute('DROP FUNCTION %s()' % self.log_name)
+
+        for index in self.table.indexes:
+            cur.execute('ALTER INDEX %s RENAME TO %s' % (
+                tables.qualify_name(self.table.name, self.index_name(index)), index.name))
+        cur.execute(query_primary_key_name, (self.table.name,))
+        row = cur.fetchone()
+        if row is not None:
+            cur.execute('ALTER TABLE %s RENAME CONSTRAINT %s TO %s_pkey' % (self.table.name, row[0], name))
+        for old_sequence, new_sequence in sequences:
+            cur.execute('ALTER SEQUENCE %s RENAME TO %s' % (new_sequence, tables.split_name(old_sequence)[1]))
+
+    def run(self):
+        executor = self.executor
+        title = 'swap of %s' % self.table.name
+
+        dependents_cur = executor.connection.cursor()
+        dependents_cur.execute(query_dependents, {'table': self.table.name})
+        dependents = [row[0] for row in dependents_cur.fetchall()]
+        dependents_cur.close()
+        executor.connection.rollback()
+        if dependents:
+            raise SwapError('table %s can not be swapped, it is used by %s' % (self.table.name, ', '.join(dependents)))
+
+        if executor.monitor is not None:
+            executor.monitor.begin(title)
+        executor.execute(self.setup_clause())
+        executor.log('%s: shadow table %s created' % (title, self.shadow_name))
+
+        state = {'last': None, 'rows': 0}
+
+        def copy_chunk(cur):
+            state['next'] = self.copy_chunk(cur, state['last'])
+            if state['next'] is not None:
+                state['rows'] += cur.rowcount
+
+        while True:
+            executor.run_with_retries(copy_chunk, executor.lock_timeout, executor.retries, title)
+            if state['next'] is None:
+                break
+            state['last'] = state['next']
+        executor.log('%s: %s rows copied' % (title, state['rows']))
+
+        if self.table.indexes:
+            executor.execute(self.indexes_clause())
+            executor.log('%s: indexes built' % title)
+
+        replayed = {'count': self.batch_size}
+
+        def replay_batch(cur):
+            # the log is read and cleared in one snapshot, keys logged by transactions
+            # committed in between are left for the next batch
+            cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            replayed['count'] = self.replay(cur, self.batch_size)
+
+        while replayed['count'] >= self.batch_size:
+            executor.run_with_retries(replay_batch, executor.lock_timeout, executor.retries, title)
+
+        executor.run_with_retries(self.switch, executor.lock_timeout, executor.retries, title)
+        executor.log('%s: swapped' % title)
+
+
+def deploy(executor, table, batch_size=10000):
+    """ Swap an existing table to the definition, a missing table is just created """
+    cur = executor.connection.cursor()
+    cur.execute(query_exists, (table.name,))
+    exists = cur.fetchone()[0]
+    cur.close()
+    if not exists:
+        executor.connection.rollback()
+        executor.execute(table.create_clause())
+        return
+    existing = tables.Table.load_from_connection(executor.connection, table.name)
+    executor.connection.rollback()
+    Swap(executor, existing, table, batch_size).run()
@@ -17,6 +17,11 @@ Definition example:
         - name: col3
           type: text
           default: ""
+        - col4:
+            type: bigint
+            identity: by default
+            sequence:
+                cache: 100
     primary_key: [col1, col2]
     indexes:
         - idx1: [col1, col2]
@@ -29,15 +34,45 @@ Definition example:
         - name: idx4
           fields: [col1, col2]
           method: gin
+        - idx5:
+            fields: [col1]
+            include: [col2]
+            storage:
+                fillfactor: 90
+            tablespace: fast_storage
+            maintenance_work_mem: 2GB
+            max_parallel_maintenance_workers: 4
     check:
         - check_col3: ...
         - ...
+    partition_by:
+        method: range
+        key: [col1]
+        partitions:
+            - mytable_old: FROM (MINVALUE) TO (0)
+            - mytable_default: DEFAULT
+        interval:
+            start: 0
+            end: 300
+            step: 100
+            name: "{table}_{start}"
+    unlogged: false
+    tablespace: fast_storage
+    storage:
+        fillfactor: 80
+        autovacuum_vacuum_scale_factor: 0.01
+        toast_tuple_target: 256
+        toast.autovacuum_enabled: false
 """
 import sys
 import os
+import re
+import copy
+import hashlib
+import itertools
+import calendar
+import datetime
 import yaml
-import psycopg2
-from psycopg2.extensions import adapt
 
 query_table_info = """
 SELECT description
@@ -54,12 +89,17 @@ SELECT
     a.attnotnull "not_null",
     a.atthasdef "has_default",
     c.adsrc "default_value",
-    b.description "description"
+    b.description "description",
+    a.attidentity "identity",
+    s.seqcache "sequence_cache",
+    s.seqincrement "sequence_increment"
 FROM pg_attribute a
     LEFT JOIN pg_description b
         ON b.objoid = a.attrelid AND b.objsubid = a.attnum
     LEFT JOIN pg_attrdef c
         ON c.adrelid = a.attrelid AND c.adnum = a.attnum
+    LEFT JOIN pg_sequence s
+        ON s.seqrelid = pg_get_serial_sequence(a.attrelid::regclass::text, a.attname)::regclass
 WHERE a.attrelid = %s::regclass
     AND a.attnum > 0 ;
 """
@@ -80,18 +120,50 @@ WHERE conrelid = %s::regclass
 AND contype = 'c';
 """
 
+query_storage_info = """
+SELECT
+    c.relpersistence = 'u' "unlogged",
+    t.spcname "tablespace",
+    c.reloptions "options",
+    tc.reloptions "toast_options"
+FROM pg_class c
+    LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+    LEFT JOIN pg_class tc ON tc.oid = c.reltoastrelid
+WHERE c.oid = %s::regclass;
+"""
+
+query_partitioning_info = """
+SELECT pt.partstrat, pg_get_partkeydef(pt.partrelid)
+FROM pg_partitioned_table pt
+WHERE pt.partrelid = %s::regclass;
+"""
+
+query_partitions_info = """
+SELECT n.nspname || '.' || c.relname, pg_get_expr(c.relpartbound, c.oid)
+FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE i.inhparent = %s::regclass
+ORDER BY 1;
+"""
+
 query_indexes_info = """
 SELECT
     a.indexrelid::regclass "name",
     a.indisunique "unique",
     d.amname "method",
-    array_agg(pg_get_indexdef(a.indexrelid, b.attnum, TRUE) ORDER BY b.attnum) "fields",
+    array_agg(pg_get_indexdef(a.indexrelid, b.attnum, TRUE) ORDER BY b.attnum)
+        FILTER (WHERE b.attnum <= a.indnkeyatts) "fields",
+    array_agg(pg_get_indexdef(a.indexrelid, b.attnum, TRUE) ORDER BY b.attnum)
+        FILTER (WHERE b.attnum > a.indnkeyatts) "include",
     pg_get_expr(a.indpred, a.indrelid, TRUE) predicate,
-    pg_get_indexdef(a.indexrelid, 0, TRUE) indexdef
+    pg_get_indexdef(a.indexrelid, 0, TRUE) indexdef,
+    c.reloptions "storage",
+    t.spcname "tablespace"
 FROM
     pg_index a,
     pg_attribute b,
-    pg_class c,
+    pg_class c LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace,
     pg_am d
 WHERE
         a.indrelid = %s::regclass
@@ -99,10 +171,126 @@ WHERE
     AND b.attrelid = a.indexrelid
     AND c.OID = a.indexrelid
     AND d.OID = c.relam
-GROUP BY a.indexrelid, a.indisunique, d.amname, a.indrelid, a.indpred;
+GROUP BY a.indexrelid, a.indisunique, d.amname, a.indrelid, a.indpred, a.indnkeyatts, c.reloptions, t.spcname;
 """
 
 
+# canonical definitions of tables hashed on the server the same way as Table.fingerprint,
+# NULL for tables which don't exist
+query_tables_fingerprints = """
+SELECT
+    t.name,
+    CASE WHEN t.oid IS NOT NULL THEN md5(
+        coalesce((
+            SELECT string_agg(
+                a.attname || ' ' || format_type(a.atttypid, a.atttypmod) || ' ' ||
+                a.attnotnull::text || ' ' || a.atthasdef::text || ' ' ||
+                coalesce(col_description(a.attrelid, a.attnum), ''), ',' ORDER BY a.attname)
+            FROM pg_attribute a
+            WHERE a.attrelid = t.oid AND a.attnum > 0 AND NOT a.attisdropped), '') || '|' ||
+        coalesce((
+            SELECT string_agg(a.attname, ',' ORDER BY array_position(c.conkey, a.attnum))
+            FROM pg_constraint c
+                JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+            WHERE c.conrelid = t.oid AND c.contype = 'p'), '') || '|' ||
+        coalesce((
+            SELECT string_agg(
+                i.relname || ' ' || x.indisunique::text || ' ' || m.amname || ' ' || (
+                    SELECT string_agg(pg_get_indexdef(x.indexrelid, k, TRUE), ',' ORDER BY k)
+                    FROM generate_series(1, x.indnkeyatts) k), ',' ORDER BY i.relname)
+            FROM pg_index x
+                JOIN pg_class i ON i.oid = x.indexrelid
+                JOIN pg_am m ON m.oid = i.relam
+            WHERE x.indrelid = t.oid AND NOT x.indisprimary), '') || '|' ||
+        coalesce((
+            SELECT string_agg(c.conname, ',' ORDER BY c.conname)
+            FROM pg_constraint c
+            WHERE c.conrelid = t.oid AND c.contype = 'c'), '') || '|' ||
+        coalesce(obj_description(t.oid, 'pg_class'), '')
+    ) END "fingerprint"
+FROM (SELECT name, to_regclass(name) oid FROM unnest(%s::text[]) name) t;
+"""
+
+# type names as they are reported by format_type
+type_aliases = {
+    'int': 'integer',
+    'int4': 'integer',
+    'serial': 'integer',
+    'serial4': 'integer',
+    'int8': 'bigint',
+    'bigserial': 'bigint',
+    'serial8': 'bigint',
+    'int2': 'smallint',
+    'smallserial': 'smallint',
+    'serial2': 'smallint',
+    'bool': 'boolean',
+    'float': 'double precision',
+    'float8': 'double precision',
+    'float4': 'real',
+    'decimal': 'numeric',
+    'varchar': 'character varying',
+    'char': 'character',
+    'bpchar': 'character',
+    'timestamp': 'timestamp without time zone',
+    'timestamptz': 'timestamp with time zone',
+    'time': 'time without time zone',
+    'timetz': 'time with time zone',
+}
+
+serial_types = ['serial', 'serial2', 'serial4', 'serial8', 'smallserial', 'bigserial']
+
+identity_kinds = {'a': 'always', 'd': 'by default'}
+
+# options of a sequence generating values of a column with their defaults
+sequence_defaults = {'cache': 1, 'increment': 1}
+
+backfill_job = """CREATE SCHEMA IF NOT EXISTS pgbuild;
+CREATE TABLE IF NOT EXISTS pgbuild.backfill (
+    table_name text,
+    column_name text,
+    last_key text,
+    done boolean NOT NULL DEFAULT false,
+    PRIMARY KEY (table_name, column_name)
+);
+INSERT INTO pgbuild.backfill (table_name, column_name) VALUES ('{table}', '{column}') ON CONFLICT DO NOTHING;
+DO $backfill$
+DECLARE
+    _last {table}.{key}%TYPE;
+    _next {table}.{key}%TYPE;
+BEGIN
+    IF (SELECT done FROM pgbuild.backfill WHERE table_name = '{table}' AND column_name = '{column}') THEN
+        RETURN;
+    END IF;
+    SELECT last_key INTO _last FROM pgbuild.backfill WHERE table_name = '{table}' AND column_name = '{column}';
+    LOOP
+        IF _last IS NULL THEN
+            SELECT max({key}) INTO _next FROM (
+                SELECT {key} FROM {table} ORDER BY {key} LIMIT {batch_size}) batch;
+        ELSE
+            SELECT max({key}) INTO _next FROM (
+                SELECT {key} FROM {table} WHERE {key} > _last ORDER BY {key} LIMIT {batch_size}) batch;
+        END IF;
+        EXIT WHEN _next IS NULL;
+        UPDATE {table} SET {column} = {value}
+            WHERE {key} <= _next AND (_last IS NULL OR {key} > _last) AND {column} IS NULL;
+        UPDATE pgbuild.backfill SET last_key = _next
+            WHERE table_name = '{table}' AND column_name = '{column}';
+        COMMIT;
+        _last := _next;
+        PERFORM pg_sleep({sleep});{throttle}
+    END LOOP;
+    UPDATE pgbuild.backfill SET done = true WHERE table_name = '{table}' AND column_name = '{column}';
+END
+$backfill$;
+"""
+
+backfill_throttle = """
+        WHILE (SELECT coalesce(max(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)), 0)
+               FROM pg_stat_replication) > pg_size_bytes('{max_lag}') LOOP
+            PERFORM pg_sleep(1);
+        END LOOP;"""
+
+
 def split_name(name):
     """ Split schema qualified name into tuple of schema name and object name """
     split = name.split('.')
@@ -116,6 +304,112 @@ def split_name(name):
     return (schema, name)
 
 
+def storage_value(value):
+    """ Storage parameter value as rendered in reloptions """
+    return str(value).lower() if isinstance(value, bool) else str(value)
+
+
+def parse_reloptions(options, toast_options=None):
+    """ Dict of storage parameters from pg_class.reloptions of a table and its TOAST table """
+    ret = {}
+    for option in options or []:
+        key, value = option.split('=', 1)
+        ret[key] = value
+    for option in toast_options or []:
+        key, value = option.split('=', 1)
+        ret['toast.' + key] = value
+    return ret
+
+
+def sequence_options(options):
+    """ Sequence options with values differing from defaults, so equal options compare equal """
+    ret = {}
+    for key, value in (options or {}).items():
+        if key not in sequence_defaults:
+            raise YamlTableError("Unknown sequence option %s, expected one of %s" % (
+                key, ', '.join(sorted(sequence_defaults))))
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise YamlTableError("Sequence option %s must be an integer, got %r" % (key, value))
+        if value != sequence_defaults[key]:
+            ret[key] = value
+    return ret
+
+
+def sequence_clause(options, prefix=''):
+    """
+    e.g. CACHE 100 INCREMENT BY 1, defaults are set for options out of the dict.
+    prefix - prepended to every option, e.g. SET for ALTER COLUMN of an identity column
+    """
+    ret = []
+    for key in sorted(sequence_defaults):
+        value = options.get(key, sequence_defaults[key])
+        ret.append('%s%s %s' % (prefix, 'INCREMENT BY' if key == 'increment' else key.upper(), value))
+    return ' '.join(ret)
+
+
+def alter_serial_sequence(table_name, column_name, options):
+    """
+    Set options of the sequence owned by a serial column. The sequence is found by pg_get_serial_sequence
+    when the script runs, its name needn't follow the column after renames of the table or the column.
+    """
+    if column_name.startswith('"') and column_name.endswith('"'):
+        column_name = column_name[1:-1]
+    else:
+        column_name = column_name.lower()
+    return ("DO $pgbuild$\nBEGIN\n    EXECUTE format('ALTER SEQUENCE %%s %s', pg_get_serial_sequence('%s', '%s'));\n"
+            "END\n$pgbuild$;\n") % (sequence_clause(options), table_name, column_name)
+
+
+def normalized_type(dtype):
+    """ Type name in the form of format_type: integer, character varying(10), timestamp(3) with time zone, text[] """
+    dtype = re.sub(r'\s+', ' ', dtype.strip().lower())
+    array = ''
+    while dtype.endswith('[]'):
+        dtype = dtype[:-2].rstrip()
+        array += '[]'
+    modifier = ''
+    match = re.match(r'^(.*?)\s*(\([^)]*\))(.*)$', dtype)
+    if match:
+        dtype = (match.group(1) + match.group(3)).strip()
+        modifier = match.group(2).replace(' ', '')
+    dtype = type_aliases.get(dtype, dtype)
+    if dtype == 'character' and not modifier:
+        modifier = '(1)'
+    if modifier and dtype.endswith(' time zone'):
+        base, zone = dtype.split(' ', 1)
+        return '%s%s %s%s' % (base, modifier, zone, array)
+    return dtype + modifier + array
+
+
+def wraps_whole(expression):
+    """ True if the opening parenthesis of the expression closes at its end """
+    depth = 0
+    quoted = False
+    for pos, char in enumerate(expression):
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return pos == len(expression) - 1
+    return False
+
+
+def normalized_expression(expression):
+    """ Check expression without redundant outer parentheses and spacing, e.g. consrc '((amount > 0))' is 'amount > 0' """
+    expression = re.sub(r'\s+', ' ', expression.strip())
+    expression = re.sub(r'\(\s+', '(', re.sub(r'\s+\)', ')', expression))
+    while expression.startswith('(') and wraps_whole(expression):
+        expression = expression[1:-1].strip()
+    return expression
+
+
 class YamlTableError(Exception):
     pass
 
@@ -143,6 +437,9 @@ class Column(_DBObject):
         column_default = None
         column_not_null = False
         column_description = None
+        column_backfill = None
+        column_identity = None
+        column_sequence = None
 
         if len(origin_yaml.keys()) == 1:
             column_name = origin_yaml.keys()[0]
@@ -153,10 +450,16 @@ class Column(_DBObject):
                 column_default = origin_yaml[column_name].get('default', column_default)
                 column_not_null = origin_yaml[column_name].get('not_null', column_not_null)
                 column_description = origin_yaml[column_name].get('description', column_description)
-            column = cls(column_name, column_type, column_default, column_not_null, column_description)
+                column_backfill = origin_yaml[column_name].get('backfill', column_backfill)
+                column_identity = origin_yaml[column_name].get('identity', column_identity)
+                column_sequence = origin_yaml[column_name].get('sequence', column_sequence)
+            column = cls(column_name, column_type, column_default, column_not_null, column_description,
+                         column_backfill, column_identity, column_sequence)
         else:  # - {name: col, type: text, ...}
             column = cls(**origin_yaml)
 
+        if column.sequence and not column.identity and not column.is_serial() and not column.is_sequence_default():
+            raise YamlTableError("Sequence options of column %s need an identity or serial type" % column.name)
         return column
 
     @staticmethod
@@ -171,12 +474,29 @@ class Column(_DBObject):
         else:
             return value
 
-    def __init__(self, name, type, default=None, not_null=False, description=None):
+    def __init__(self, name, type, default=None, not_null=False, description=None, backfill=None,
+                 identity=None, sequence=None):
+        """
+        identity - 'always' or 'by default' for GENERATED ... AS IDENTITY columns
+        sequence - options of the sequence of an identity or serial column: cache, increment
+        """
         self.name = name
         self.type = type
         self.default = default
         self.not_null = not_null
         self.description = description
+        self.backfill = backfill  # True or dict of backfill options, see backfill_clause
+        if identity is not None and identity.lower() not in identity_kinds.values():
+            raise YamlTableError("Identity of column %s must be 'always' or 'by default'" % name)
+        self.identity = identity.lower() if identity is not None else None
+        self.sequence = sequence_options(sequence)
+
+    def is_serial(self):
+        return self.type.strip().lower() in serial_types
+
+    def is_sequence_default(self):
+        """ Default taken from a sequence, as serial columns are introspected """
+        return self.default is not None and 'nextval(' in unicode(self.default)
 
     def __repr__(self):
         return str({
@@ -190,12 +510,32 @@ class Column(_DBObject):
         ret = 4*' ' + self.name + ' ' + self.type
         if self.default is not None:
             ret += ' DEFAULT %s' % self.adjust_value(self.default, self.type)
+        ret += self.identity_clause()
         if self.not_null:
             ret += ' NOT NULL'
 
         return ret
 
-    def alter_to(self, table_name, other):
+    def identity_clause(self):
+        if not self.identity:
+            return ''
+        ret = ' GENERATED %s AS IDENTITY' % self.identity.upper()
+        if self.sequence:
+            ret += ' (%s)' % sequence_clause(self.sequence)
+        return ret
+
+    def sequence_clause(self, table_name):
+        """ Options of the sequence of a serial column, set after the column is created """
+        if not self.sequence or not self.is_serial():
+            return ''
+        return alter_serial_sequence(table_name, self.name, self.sequence)
+
+    def alter_to(self, table_name, other, safe_not_null=False):
+        """
+        Return alter script for getting own state to other.
+        With safe_not_null NOT NULL is only prepared with a not valid check constraint,
+        to be completed by validate_not_null_clause.
+        """
 
         alter_column = "ALTER TABLE %s ALTER COLUMN %s " % (table_name, self.name)
 
@@ -211,30 +551,109 @@ class Column(_DBObject):
             else:
                 statements += alter_column + "DROP DEFAULT;\n" % other.default
         if self.not_null != other.not_null:
-            if other.not_null:
+            if other.not_null and safe_not_null:
+                statements += "ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) NOT VALID;\n" % (
+                    table_name, self.not_null_constraint(table_name), self.name)
+            elif other.not_null:
                 statements += alter_column + "SET NOT NULL;\n"
             else:
                 statements += alter_column + "DROP NOT NULL;\n"
         if self.description and self.description.encode("utf-8") != other.description:
             statements += "COMMENT ON COLUMN %s.%s IS '%s';\n" % (table_name, self.name, other.description)
+        statements += self.alter_sequence_to(table_name, other)
 
         return statements
 
+    def alter_sequence_to(self, table_name, other):
+        """ Change identity and sequence options of the column to those of other """
+        alter_column = "ALTER TABLE %s ALTER COLUMN %s " % (table_name, self.name)
+
+        if self.identity and not other.identity:
+            statements = alter_column + "DROP IDENTITY IF EXISTS;\n"
+            return statements + other.sequence_clause(table_name)
+        if other.identity and not self.identity:
+            return alter_column + "ADD%s;\n" % other.identity_clause()
+
+        statements = ''
+        if self.identity != other.identity:
+            statements += alter_column + "SET GENERATED %s;\n" % other.identity.upper()
+        if self.sequence != other.sequence:
+            if other.identity:
+                statements += alter_column + "%s;\n" % sequence_clause(other.sequence, 'SET ')
+            else:
+                statements += alter_serial_sequence(table_name, self.name, other.sequence)
+        return statements
+
+    def not_null_constraint(self, table_name):
+        """ Name of a temporary check constraint used for setting NOT NULL """
+        return ('%s_%s_not_null' % (split_name(table_name)[1], self.name))[:63]
+
+    def validate_not_null_clause(self, table_name):
+        """
+        Complete NOT NULL prepared by alter_to with safe_not_null:
+        validation of the check doesn't block writes and lets SET NOT NULL skip the table scan
+        """
+        constraint = self.not_null_constraint(table_name)
+        statements = "ALTER TABLE %s VALIDATE CONSTRAINT %s;\n" % (table_name, constraint)
+        statements += "ALTER TABLE %s ALTER COLUMN %s SET NOT NULL;\n" % (table_name, self.name)
+        statements += "ALTER TABLE %s DROP CONSTRAINT %s;\n" % (table_name, constraint)
+        return statements
+
     def drop_clause(self, table_name):
         return "ALTER TABLE %s DROP COLUMN IF EXISTS %s;\n" % (table_name, self.name)
 
     def add_clause(self, table_name):
-        statements = "ALTER TABLE %s ADD COLUMN %s %s;\n" % (table_name, self.name, self.type)
+        """ NOT NULL of a column with backfill is set by backfill_clause after populating existing rows """
+        statements = "ALTER TABLE %s ADD COLUMN %s %s%s;\n" % (table_name, self.name, self.type, self.identity_clause())
+        statements += self.sequence_clause(table_name)
         alter_column = "ALTER TABLE %s ALTER COLUMN %s " % (table_name, self.name)
         if self.default:
             statements += alter_column + "SET DEFAULT %s;\n" % self.default
-        if self.not_null:
+        if self.not_null and not self.backfill:
             statements += alter_column + "SET NOT NULL;\n"
         if self.description:
             statements += "COMMENT ON COLUMN %s.%s IS '%s';\n" % (table_name, self.name, self.description)
 
         return statements
 
+    def backfill_clause(self, table_name, primary_key):
+        """
+        Populate existing rows of the added column in batches ranged by primary key.
+
+        Backfill options:
+            value - expression to fill the column with, column default by default
+            batch_size - number of rows updated in one transaction, 10000 by default
+            sleep - pause between batches in seconds
+            max_lag - replication lag (bytes or size like 64MB) to wait for before the next batch
+
+        Progress is stored in pgbuild.backfill table, an interrupted backfill continues
+        from the last committed batch when run again. Every batch is committed, so the script
+        must run outside of a transaction block.
+        """
+        options = self.backfill if isinstance(self.backfill, dict) else {}
+        value = options.get('value', self.default)
+        if value is None:
+            raise YamlTableError("Backfill of %s.%s needs a value or a default" % (table_name, self.name))
+        if len(primary_key) != 1:
+            raise YamlTableError("Backfill of %s.%s needs a single column primary key" % (table_name, self.name))
+
+        if options.get('max_lag') is not None:
+            throttle = backfill_throttle.format(max_lag=options['max_lag'])
+        else:
+            throttle = ''
+        statements = backfill_job.format(
+            table=table_name,
+            column=self.name,
+            key=primary_key[0].name,
+            value=value,
+            batch_size=int(options.get('batch_size', 10000)),
+            sleep=float(options.get('sleep', 0)),
+            throttle=throttle
+        )
+        if self.not_null:
+            statements += "ALTER TABLE %s ALTER COLUMN %s SET NOT NULL;\n" % (table_name, self.name)
+        return statements
+
 
 class Index(_DBObject):
     """ Index on table """
@@ -247,6 +666,7 @@ class Index(_DBObject):
         index_fields = []
         index_unique = False
         index_predicate = None
+        index_options = {}
 
         if len(origin_yaml.keys()) == 1:
             index_name = origin_yaml.keys()[0]
@@ -259,20 +679,34 @@ class Index(_DBObject):
                 index_fields = origin_yaml[index_name].get('fields', index_fields)
                 index_unique = origin_yaml[index_name].get('unique', index_unique)
                 index_predicate = origin_yaml[index_name].get('predicate', index_predicate)
-            index = cls(table, index_name, index_method, index_fields, index_unique, index_predicate)
+                index_options = dict((k, v) for k, v in origin_yaml[index_name].items() if k in cls.options)
+            index = cls(table, index_name, index_method, index_fields, index_unique, index_predicate, **index_options)
         else:  # - {name: idx, method: btree, ...}
             origin_yaml['method'] = origin_yaml.get('method', origin_yaml.pop('access_method', index_method))
             index = cls(table, **origin_yaml)
 
         return index
 
-    def __init__(self, table, name, method='btree', fields=[], unique=False, predicate=None):
+    # optional keys of index definition
+    options = ['include', 'storage', 'tablespace', 'maintenance_work_mem', 'max_parallel_maintenance_workers']
+
+    # session settings applied while the index is built, they aren't a part of index definition
+    build_settings = ['maintenance_work_mem', 'max_parallel_maintenance_workers']
+
+    def __init__(self, table, name, method='btree', fields=[], unique=False, predicate=None,
+                 include=None, storage=None, tablespace=None,
+                 maintenance_work_mem=None, max_parallel_maintenance_workers=None):
         self.table = table
         self.name = name
         self.method = method
         self.fields = fields
         self.unique = unique
         self.predicate = predicate
+        self.include = include or []
+        self.storage = dict(storage or {})
+        self.tablespace = tablespace
+        self.maintenance_work_mem = maintenance_work_mem
+        self.max_parallel_maintenance_workers = max_parallel_maintenance_workers
         self.dict = {
             'table': self.table,
             'name': self.name,
@@ -285,15 +719,80 @@ class Index(_DBObject):
     def __repr__(self):
         return str(self.dict)
 
-    def create_clause(self):
+    def definition(self, with_storage=True):
+        """ Properties which make the index, build settings excluded """
+        ret = {
+            'table': self.table,
+            'name': self.name,
+            'method': self.method,
+            'fields': self.fields,
+            'unique': self.unique,
+            'predicate': self.predicate,
+            'include': self.include
+        }
+        if with_storage:
+            ret['storage'] = dict((k, storage_value(v)) for k, v in self.storage.items())
+            ret['tablespace'] = self.tablespace or 'pg_default'
+        return ret
+
+    def __eq__(self, other):
+        return unicode(self.definition()) == unicode(other.definition())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(frozenset(self.definition()))
+
+    def alter_to(self, other):
+        """
+        Return alter script for indexes differing in storage parameters or tablespace only,
+        None if the index has to be rebuilt
+        """
+        if unicode(self.definition(with_storage=False)) != unicode(other.definition(with_storage=False)):
+            return None
+
+        name = qualify_name(self.table, self.name)
+        own = self.definition()
+        new = other.definition()
+        statements = ''
+        changed = ['%s = %s' % (k, v) for k, v in sorted(new['storage'].items()) if own['storage'].get(k) != v]
+        if changed:
+            statements += "ALTER INDEX %s SET (%s);\n" % (name, ', '.join(changed))
+        removed = [k for k in sorted(own['storage']) if k not in new['storage']]
+        if removed:
+            statements += "ALTER INDEX %s RESET (%s);\n" % (name, ', '.join(removed))
+        if own['tablespace'] != new['tablespace']:
+            statements += "ALTER INDEX %s SET TABLESPACE %s;\n" % (name, new['tablespace'])
+        return statements
+
+    def create_clause(self, table=None, name=None, only=False, concurrently=False):
+        """
+        table, name - create the index on another table, e.g. on a partition
+        only - don't propagate the index to partitions of a partitioned table
+        """
         unique = ' UNIQUE ' if self.unique else ' '
         ret = 'CREATE%sINDEX ' % unique
-        ret += '%(name)s ON %(table)s USING %(method)s\n' % self.dict
+        if concurrently:
+            ret += 'CONCURRENTLY '
+        ret += '%s ON %s%s USING %s\n' % (name or self.name, 'ONLY ' if only else '', table or self.table, self.method)
         fields = ', '.join(self.fields)
         ret += '    (' + fields + ')'
+        if self.include:
+            ret += '\n    INCLUDE (%s)' % ', '.join(self.include)
+        if self.storage:
+            ret += '\n    WITH (%s)' % ', '.join('%s = %s' % (k, storage_value(v)) for k, v in sorted(self.storage.items()))
+        if self.tablespace:
+            ret += '\n    TABLESPACE %s' % self.tablespace
         if self.predicate is not None:
             ret += '\n    WHERE ' + self.predicate
         ret += ';\n'
+
+        # build settings are set for the session only while the index is built
+        settings = [(k, getattr(self, k)) for k in self.build_settings if getattr(self, k) is not None]
+        if settings:
+            ret = ''.join("SET %s = '%s';\n" % (k, v) for k, v in settings) + ret
+            ret += ''.join("RESET %s;\n" % k for k, v in settings)
         return ret
 
     def drop_clause(self):
@@ -306,6 +805,114 @@ class Index(_DBObject):
         return ret
 
 
+class Partition(_DBObject):
+    """ Partition of a partitioned table """
+
+    @classmethod
+    def load_from_yaml(cls, table, original_yaml):
+        name = original_yaml.keys()[0]
+        bound = original_yaml[name]
+
+        return cls(table, qualify_name(table, name), bound)
+
+    def __init__(self, table, name, bound):
+        self.table = table
+        self.name = name
+        self.bound = bound
+
+    def bound_clause(self):
+        if str(self.bound).upper() == 'DEFAULT':
+            return 'DEFAULT'
+        return 'FOR VALUES %s' % self.bound
+
+    def create_clause(self, storage_clause=''):
+        ret = "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s %s%s;\n" % (
+            self.name, self.table, self.bound_clause(), storage_clause)
+        return ret
+
+    def attach_clause(self, storage_clause=''):
+        """
+        Partition is created aside and then attached,
+        which takes only a SHARE UPDATE EXCLUSIVE lock on the parent table
+        """
+        ret = "CREATE TABLE IF NOT EXISTS %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)%s;\n" % (
+            self.name, self.table, storage_clause)
+        ret += "ALTER TABLE %s ATTACH PARTITION %s %s;\n" % (self.table, self.name, self.bound_clause())
+        return ret
+
+    def drop_clause(self):
+        ret = "ALTER TABLE %s DETACH PARTITION %s;\n" % (self.table, self.name)
+        ret += "DROP TABLE IF EXISTS %s;\n" % self.name
+        return ret
+
+
+def qualify_name(table, name):
+    """ Qualify name of an object with schema of the table if it isn't qualified """
+    schema = split_name(table)[0]
+    if schema and '.' not in name:
+        return '%s.%s' % (schema, name)
+    return name
+
+
+def add_interval(value, count, unit):
+    """ Add count of days, weeks, months or years to a date, or just count to a number """
+    if unit is None:
+        return value + count
+    unit = unit.lower().rstrip('s')
+    if unit == 'day':
+        return value + datetime.timedelta(days=count)
+    if unit == 'week':
+        return value + datetime.timedelta(weeks=count)
+    if unit in ('month', 'year'):
+        months = value.month - 1 + count * (12 if unit == 'year' else 1)
+        year = value.year + months // 12
+        month = months % 12 + 1
+        return value.replace(year=year, month=month, day=min(value.day, calendar.monthrange(year, month)[1]))
+    raise YamlTableError('Unknown partitions interval unit "%s"' % unit)
+
+
+def interval_partitions(table, interval):
+    """
+    Generate range partitions from interval definition:
+        start, end - bounds of the whole range, dates or numbers
+        step - size of a partition, e.g. "1 month", "7 days" or a number
+        name - format of partition name, with table, start and end arguments
+    """
+    start = interval['start']
+    end = interval['end']
+    if isinstance(start, str):
+        start = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+        end = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+    step = str(interval.get('step', '1 month')).split()
+    count = int(step[0])
+    unit = step[1] if len(step) > 1 else None
+    if isinstance(start, datetime.date):
+        name_format = interval.get('name', '{table}_p{start:%Y%m%d}')
+        literal = "'%s'"
+    else:
+        name_format = interval.get('name', '{table}_p{start}')
+        literal = "%s"
+
+    ret = []
+    while start < end:
+        next_start = add_interval(start, count, unit)
+        name = name_format.format(table=split_name(table)[1], start=start, end=next_start)
+        bound = "FROM (%s) TO (%s)" % (literal % start, literal % next_start)
+        ret.append(Partition(table, qualify_name(table, name), bound))
+        start = next_start
+    return ret
+
+
+def hash_partitions(table, modulus):
+    """ Generate all partitions of hash partitioned table """
+    ret = []
+    for remainder in range(modulus):
+        name = '%s_p%s' % (split_name(table)[1], remainder)
+        bound = 'WITH (MODULUS %s, REMAINDER %s)' % (modulus, remainder)
+        ret.append(Partition(table, qualify_name(table, name), bound))
+    return ret
+
+
 class Check(_DBObject):
     """ Check constraint """
 
@@ -322,22 +929,32 @@ class Check(_DBObject):
         self.expression = expression
 
     def create_clause(self):
-        ret = "ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s);\n" % (self.table, self.name, self.expression)
+        """ Constraint is added without checking existing rows, see validate_clause """
+        ret = "ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s) NOT VALID;\n" % (self.table, self.name, self.expression)
+        return ret
+
+    def validate_clause(self):
+        ret = "ALTER TABLE %s VALIDATE CONSTRAINT %s;\n" % (self.table, self.name)
         return ret
 
     def drop_clause(self):
         ret = "ALTER TABLE %s DROP CONSTRAINT %s;\n" % (self.table, self.name)
         return ret
 
+    def same_expression(self, other):
+        return normalized_expression(self.expression) == normalized_expression(other.expression)
+
 
 class ColumnsList(list):
 
+    def iter_create_clause(self):
+        for idx, c in enumerate(self):
+            if idx > 0:
+                yield ',\n'
+            yield c.create_clause()
+
     def create_clause(self):
-        ret = ''
-        for c in self:
-            ret += c.create_clause() + ',\n'
-        ret = ret[0:-2]
-        return ret
+        return ''.join(self.iter_create_clause())
 
     def comments_clause(self, table_name):
         ret = ''
@@ -380,17 +997,19 @@ class ColumnsList(list):
 
 class IndexesList(list):
 
-    def create_clause(self):
-        ret = ''
+    def iter_create_clause(self):
         for i in self:
-            ret += i.create_clause()
-        return ret
+            yield i.create_clause()
 
-    def drop_clause(self):
-        ret = ''
+    def iter_drop_clause(self):
         for i in self:
-            ret += i.drop_clause()
-        return ret
+            yield i.drop_clause()
+
+    def create_clause(self):
+        return ''.join(self.iter_create_clause())
+
+    def drop_clause(self):
+        return ''.join(self.iter_drop_clause())
 
     def has_index(self, index):
 
@@ -402,14 +1021,96 @@ class IndexesList(list):
 
         return len(ret) > 0
 
+    def get_index(self, index):
+
+        if isinstance(index, Index):
+            search_name = index.name
+        if isinstance(index, str):
+            search_name = index
+        ret = [c for c in self if c.name == search_name]
+
+        if len(ret) > 0:
+            return ret[0]
+        else:
+            return None
+
 
 class ConstraintsList(list):
 
-    def create_clause(self):
-        ret = ''
+    def iter_create_clause(self):
         for c in self:
-            ret += c.create_clause()
-        return ret
+            yield c.create_clause()
+
+    def iter_validate_clause(self):
+        for c in self:
+            yield c.validate_clause()
+
+    def create_clause(self):
+        return ''.join(self.iter_create_clause())
+
+    def validate_clause(self):
+        return ''.join(self.iter_validate_clause())
+
+    def get_constraint(self, name):
+        ret = [c for c in self if c.name == name]
+        if len(ret) > 0:
+            return ret[0]
+        else:
+            return None
+
+
+class Introspector(object):
+    """
+    Catalog queries of table introspection executed on a single cursor.
+    With prepare they are prepared on the server once per introspector and only executed
+    for every table, so introspection of many tables isn't dominated by parse and plan.
+    """
+
+    queries = {
+        'table_info': query_table_info,
+        'columns_info': query_columns_info,
+        'pk_info': query_pk_info,
+        'check_info': query_check_info,
+        'indexes_info': query_indexes_info,
+        'storage_info': query_storage_info,
+        'partitioning_info': query_partitioning_info,
+        'partitions_info': query_partitions_info
+    }
+
+    counter = itertools.count(1)
+
+    def __init__(self, connection, prepare=True):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.prepare = prepare
+        # names of statements are unique per introspector, several of them may share a connection
+        self.prefix = 'pgbuild_%s_' % next(self.counter)
+        self.prepared = set()
+
+    def execute(self, kind, table_name):
+        if not self.prepare:
+            self.cursor.execute(self.queries[kind], (table_name,))
+            return
+        if kind not in self.prepared:
+            query = self.queries[kind].strip().rstrip(';').replace('%s', '$1')
+            self.cursor.execute('PREPARE %s%s(text) AS %s;' % (self.prefix, kind, query))
+            self.prepared.add(kind)
+        self.cursor.execute('EXECUTE %s%s(%%s);' % (self.prefix, kind), (table_name,))
+
+    def fetchone(self, kind, table_name):
+        self.execute(kind, table_name)
+        return self.cursor.fetchone()
+
+    def fetchall(self, kind, table_name):
+        self.execute(kind, table_name)
+        return self.cursor.fetchall()
+
+    def close(self):
+        """ Deallocate prepared statements and close the cursor """
+        for kind in self.prepared:
+            self.cursor.execute('DEALLOCATE %s%s;' % (self.prefix, kind))
+        self.prepared.clear()
+        self.cursor.close()
 
 
 class Table(object):
@@ -421,10 +1122,11 @@ class Table(object):
         return cls(table)
 
     @classmethod
-    def load_from_connection(cls, connection, table_name):
+    def load_from_connection(cls, connection, table_name, introspector=None):
         """
         connection - open DBAPI2 connection
         table_name - name of a table to make instance of
+        introspector - Introspector reused for introspection of many tables on the connection
         """
         split = table_name.split(".")
         if len(split) == 2:
@@ -432,25 +1134,24 @@ class Table(object):
         else:
             schema = "public"
 
-        cur = connection.cursor()
-        cur.execute(query_table_info, (table_name,))
-        table_info = cur.fetchone()
-
-        cur = connection.cursor()
-        cur.execute(query_columns_info, (table_name,))
-        columns_info = cur.fetchall()
-
-        cur = connection.cursor()
-        cur.execute(query_pk_info, (table_name,))
-        pk_info = cur.fetchone()
-
-        cur = connection.cursor()
-        cur.execute(query_check_info, (table_name,))
-        check_info = cur.fetchall()
-
-        cur = connection.cursor()
-        cur.execute(query_indexes_info, (table_name,))
-        indexes_info = cur.fetchall()
+        own_introspector = introspector is None
+        if own_introspector:
+            introspector = Introspector(connection, prepare=False)
+
+        try:
+            table_info = introspector.fetchone('table_info', table_name)
+            columns_info = introspector.fetchall('columns_info', table_name)
+            pk_info = introspector.fetchone('pk_info', table_name)
+            check_info = introspector.fetchall('check_info', table_name)
+            indexes_info = introspector.fetchall('indexes_info', table_name)
+            storage_info = introspector.fetchone('storage_info', table_name)
+            partitioning_info = introspector.fetchone('partitioning_info', table_name)
+            partitions_info = []
+            if partitioning_info is not None:
+                partitions_info = introspector.fetchall('partitions_info', table_name)
+        finally:
+            if own_introspector:
+                introspector.close()
 
         columns = []
         for c in columns_info:
@@ -461,6 +1162,8 @@ class Table(object):
             col_has_default = c[4]
             col_default_value = c[5]
             col_description = c[6]
+            col_identity = identity_kinds.get(c[7])
+            col_sequence = {'cache': c[8], 'increment': c[9]} if c[8] is not None else None
 
             if col_max_length != -1:
                 col_type = "{}({})".format(col_type, col_max_length - 4)
@@ -469,7 +1172,9 @@ class Table(object):
                 'name': col_name,
                 'type': col_type,
                 'not_null': col_not_null,
-                'description': col_description
+                'description': col_description,
+                'identity': col_identity,
+                'sequence': col_sequence
             }
             if col_has_default:
                 col_dict['default'] = col_default_value
@@ -481,7 +1186,10 @@ class Table(object):
                 'name': i[0].replace("{}.".format(schema), ""),
                 'unique': i[1],
                 'method': i[2],
-                'fields': i[3]
+                'fields': i[3],
+                'include': i[4] or [],
+                'storage': parse_reloptions(i[7]),
+                'tablespace': i[8]
             }
             indexes.append(ind_dict)
 
@@ -496,14 +1204,29 @@ class Table(object):
             'columns': columns,
             'indexes': indexes,
             'primary_key': pk_info,
-            'check': [{c[0]:c[1]} for c in check_info]
+            'check': [{c[0]:c[1]} for c in check_info],
+            'unlogged': storage_info[0],
+            'tablespace': storage_info[1],
+            'storage': parse_reloptions(storage_info[2], storage_info[3])
         }
 
+        if partitioning_info is not None:
+            method = {'r': 'range', 'l': 'list', 'h': 'hash'}[partitioning_info[0]]
+            key = partitioning_info[1][len(method):].strip()[1:-1]  # RANGE (key) -> key
+            if len(split) != 2:
+                partitions_info = [(p[0].replace('public.', '', 1), p[1]) for p in partitions_info]
+            table['partition_by'] = {
+                'method': method,
+                'key': key,
+                'partitions': [{p[0]: p[1].replace('FOR VALUES ', '', 1)} for p in partitions_info]
+            }
+
         return cls(table)
 
     @classmethod
     def load_from_location(cls, location):
         if location.startswith('postgresql://'):
+            import psycopg2  # imported only when needed, local commands start faster without it
             connstr, table_name = location.rsplit('/', 1)
             conn = psycopg2.connect(connstr)
             table = cls.load_from_connection(conn, table_name)
@@ -511,15 +1234,15 @@ class Table(object):
             table = cls.load_from_yaml_file(location)
         return table
 
-    def create_on_connection(self, connection):
-        cur = connection.cursor()
-        cur.execute(self.create_clause())
-        cur.close()
+    def create_on_connection(self, connection, lock_timeout=None, retries=0):
+        """ Create the table in its own transaction, retried if a lock isn't acquired within lock_timeout """
+        import executor
+        executor.Executor(connection, lock_timeout=lock_timeout, retries=retries).execute(self.create_clause())
 
-    def drop_on_connection(self, connection):
-        cur = connection.cursor()
-        cur.execute(self.drop_clause())
-        cur.close()
+    def drop_on_connection(self, connection, lock_timeout=None, retries=0):
+        """ Drop the table in its own transaction, retried if a lock isn't acquired within lock_timeout """
+        import executor
+        executor.Executor(connection, lock_timeout=lock_timeout, retries=retries).execute(self.drop_clause())
 
     def load_from_pgdump(cls, dumppath, table_name):
         # TODO: implement
@@ -539,7 +1262,11 @@ class Table(object):
             indexes,
             check,
             inherits,
-            mode
+            mode,
+            unlogged,
+            tablespace,
+            storage,
+            partition_by
         """
 
         self.name = None
@@ -550,6 +1277,12 @@ class Table(object):
         self.indexes = []
         self.check = []
         self.mode = ''
+        self.unlogged = False
+        self.tablespace = None
+        self.storage = {}
+        self.partition_method = None
+        self.partition_key = None
+        self.partitions = []
 
         self._load(table)
 
@@ -562,6 +1295,7 @@ class Table(object):
         else:
             raise YamlTableError("Unknown table representation type, dict or str expected")
 
+        self.yaml_definition = copy.deepcopy(origin_yaml)
 
         _inherits = origin_yaml.get('inherits', [])
         if isinstance(_inherits, str):
@@ -571,6 +1305,24 @@ class Table(object):
         self.name = origin_yaml['table']
         self.description = origin_yaml.get('description')
 
+        # persistence and storage parameters
+        self.mode = origin_yaml.get('mode', self.mode) or ''
+        self.unlogged = bool(origin_yaml.get('unlogged', self.mode.upper() == 'UNLOGGED'))
+        self.tablespace = origin_yaml.get('tablespace', self.tablespace)
+        self.storage = dict(origin_yaml.get('storage') or {})
+
+        # declarative partitioning
+        partition_by = origin_yaml.get('partition_by')
+        if partition_by:
+            self.partition_method = partition_by.get('method', 'range').lower()
+            key = partition_by['key']
+            self.partition_key = ', '.join(key) if isinstance(key, list) else key
+            self.partitions = [Partition.load_from_yaml(self.name, p) for p in partition_by.get('partitions', [])]
+            if 'interval' in partition_by:
+                self.partitions.extend(interval_partitions(self.name, partition_by['interval']))
+            if 'modulus' in partition_by:
+                self.partitions.extend(hash_partitions(self.name, int(partition_by['modulus'])))
+
         # load columns
         cols = [Column.load_from_yaml(c) for c in origin_yaml.get('columns', self.columns)]
         self.columns = ColumnsList(cols)
@@ -597,44 +1349,95 @@ class Table(object):
             'check': self.check
         })
 
-    def create_clause(self):
+    def create_clause(self, validate=True):
+        """
+        Return DDL of the table.
+        Check constraints are added as NOT VALID, their validation is appended
+        if validate is True, otherwise it's left for validate_clause.
+        """
+        return u''.join(self.iter_create_clause(validate))
+
+    def iter_create_clause(self, validate=True, create_indexes=True):
+        """
+        Generate DDL of the table statement by statement, see create_clause.
+        Without create_indexes existing indexes are dropped but not created, e.g. before a bulk load
+        """
 
         if self.inherits:
             inherits_clause = ' INHERITS (%s) ' % ', '.join(self.inherits)
         else:
             inherits_clause = ''
 
-        columns_list = self.columns.create_clause()
-        if self.primary_key:
-            pk_clause = ",\n    PRIMARY KEY (%s)" % (', '.join(c.name for c in self.primary_key),)
+        if self.partition_method:
+            # storage parameters apply to partitions, partitioned table itself has no storage
+            partition_clause = '\nPARTITION BY %s (%s)' % (self.partition_method.upper(), self.partition_key)
+            storage_clause = self.storage_clause(with_options=False)
         else:
-            pk_clause = ""
-        columns_list = columns_list + pk_clause
-
-        create_clause = u"CREATE %s TABLE IF NOT EXISTS %s (\n%s\n)%s;\n" % (self.mode, self.name, columns_list, inherits_clause)
+            partition_clause = ''
+            storage_clause = self.storage_clause()
 
+        mode = 'UNLOGGED' if self.unlogged else self.mode
+        yield u"CREATE %s TABLE IF NOT EXISTS %s (\n" % (mode, self.name)
+        for chunk in self.columns.iter_create_clause():
+            yield chunk
+        if self.primary_key:
+            yield ",\n    PRIMARY KEY (%s)" % (', '.join(c.name for c in self.primary_key),)
+        yield "\n)%s%s%s;\n" % (inherits_clause, partition_clause, storage_clause)
+        for column in self.columns:
+            yield column.sequence_clause(self.name)
+        for partition in self.partitions:
+            yield partition.create_clause(self.storage_clause())
 
-        comments_clause = ''
         if self.description is not None:
-            comments_clause += "COMMENT ON TABLE %s IS '%s';\n" % (self.name, self.description)
+            yield "COMMENT ON TABLE %s IS '%s';\n" % (self.name, self.description)
 
-        comments_clause += self.columns.comments_clause(self.name)
+        yield self.columns.comments_clause(self.name)
 
-        indexes_clause = self.indexes.drop_clause() + self.indexes.create_clause()
+        for chunk in self.indexes.iter_drop_clause():
+            yield chunk
+        if create_indexes:
+            for chunk in self.indexes.iter_create_clause():
+                yield chunk
 
-        check_clause = self.check.create_clause()
+        for chunk in self.check.iter_create_clause():
+            yield chunk
+        if validate:
+            for chunk in self.check.iter_validate_clause():
+                yield chunk
 
-        return create_clause + comments_clause + indexes_clause + check_clause
+    def storage_clause(self, with_options=True):
+        """ WITH and TABLESPACE clauses of CREATE TABLE """
+        ret = ''
+        if self.storage and with_options:
+            ret += '\nWITH (%s)' % ', '.join('%s = %s' % (k, storage_value(v)) for k, v in sorted(self.storage.items()))
+        if self.tablespace:
+            ret += '\nTABLESPACE %s' % self.tablespace
+        return ret
 
-    def alter_to(self, other):
-        """ Return alter script for getting own state to other """
+    def storage_options(self):
+        """ Storage parameters normalized for comparison """
+        return dict((k, storage_value(v)) for k, v in self.storage.items())
+
+    def validate_clause(self):
+        """ Validation of check constraints, which can be scheduled separately from creation """
+        return self.check.validate_clause()
+
+    def alter_to(self, other, validate=True, safe_not_null=False, backfill=False, partition_indexes=True):
+        """
+        Return alter script for getting own state to other.
+        Validation of new constraints is appended if validate is True,
+        otherwise it's left for validate_to.
+        Backfill of added columns is appended if backfill is True, otherwise it's left for backfill_to.
+        Indexes of partitions are built concurrently if partition_indexes is True, otherwise they are
+        left for partition_indexes_to. Both can't run in a transaction block, see diff_to.
+        """
 
         statements = ''
         for column in self.columns:
             if column in other.columns:  # column is the same
                 pass
             elif other.columns.has_column(column):  # column differs
-                statements += column.alter_to(self.name, other.columns.get_column(column))
+                statements += column.alter_to(self.name, other.columns.get_column(column), safe_not_null)
             else:  # column doesn't exist
                 statements += column.drop_clause(self.name)
 
@@ -642,30 +1445,190 @@ class Table(object):
             if not self.columns.has_column(other_column):  # column to be added
                 statements += other_column.add_clause(self.name)
 
+        if bool(self.partition_method) != bool(other.partition_method) or (
+                self.partition_method and self.partition_method != other.partition_method):
+            raise YamlTableError("Partitioning of %s can't be changed by ALTER TABLE" % self.name)
+
+        partitions = dict((p.name, p) for p in self.partitions)
+        other_partitions = dict((p.name, p) for p in other.partitions)
+        for partition in other.partitions:  # attach new partitions
+            if partition.name not in partitions:
+                statements += partition.attach_clause(other.storage_clause())
+
         for index in self.indexes:  # drop or recreate existing indexes
             if index in other.indexes:
                 pass
             elif other.indexes.has_index(index):
-                statements += index.drop_clause()
-                statements += index.create_clause()
+                other_index = other.indexes.get_index(index)
+                alter = index.alter_to(other_index)
+                if alter is not None:
+                    statements += alter
+                else:
+                    statements += index.drop_clause()
+                    statements += other.index_create_clause(other_index, partition_indexes)
             else:
                 statements += index.drop_clause()
 
         for other_index in other.indexes:  # create new indexes
             if not self.indexes.has_index(other_index):
-                statements += other_index.create_clause()
+                statements += other.index_create_clause(other_index, partition_indexes)
 
         # primary key
         if self.primary_key != other.primary_key:
             statements += "ALTER TABLE %s DROP %s_pkey;\n" % (self.name, split_name(self.name)[1])
             statements += "ALTER TABLE %s ADD PRIMARY KEY (%s);\n" % (self.name, ', '.join(c.name for c in other.primary_key))
 
+        for partition in self.partitions:  # detach and drop partitions out of definition
+            if partition.name not in other_partitions:
+                statements += partition.drop_clause()
+
+        # check constraints
+        for check in self.check:
+            other_check = other.check.get_constraint(check.name)
+            if other_check is None or not other_check.same_expression(check):
+                statements += check.drop_clause()
+        for other_check in other.check:
+            check = self.check.get_constraint(other_check.name)
+            if check is None or not other_check.same_expression(check):
+                statements += other_check.create_clause()
+
         # description
         if self.description and self.description.encode("utf-8") != other.description:
             statements += "COMMENT ON TABLE %s IS '%s';\n" % (self.name, other.description)
 
+        # persistence and storage
+        if self.unlogged != other.unlogged:
+            statements += "ALTER TABLE %s SET %s;\n" % (self.name, 'UNLOGGED' if other.unlogged else 'LOGGED')
+        if (self.tablespace or 'pg_default') != (other.tablespace or 'pg_default'):
+            statements += "ALTER TABLE %s SET TABLESPACE %s;\n" % (self.name, other.tablespace or 'pg_default')
+        own_storage = self.storage_options()
+        other_storage = other.storage_options()
+        changed = ['%s = %s' % (k, v) for k, v in sorted(other_storage.items()) if own_storage.get(k) != v]
+        if changed:
+            statements += "ALTER TABLE %s SET (%s);\n" % (self.name, ', '.join(changed))
+        removed = [k for k in sorted(own_storage) if k not in other_storage]
+        if removed:
+            statements += "ALTER TABLE %s RESET (%s);\n" % (self.name, ', '.join(removed))
+
+        if backfill:
+            statements += self.backfill_to(other)
+
+        if validate:
+            statements += self.validate_to(other, safe_not_null)
+
+        return statements
+
+    def index_create_clause(self, index, partition_indexes=True):
+        """
+        Create index of the table. An index of a partitioned table is created on the table only
+        and then concurrently on every partition, so writes are never blocked on all partitions.
+        partition_indexes - include the concurrent builds on partitions, see partition_indexes_clause
+        """
+        if not self.partition_method:
+            return index.create_clause()
+
+        ret = index.create_clause(only=True)
+        if partition_indexes:
+            ret += self.partition_indexes_clause(index)
+        return ret
+
+    def partition_indexes_clause(self, index):
+        """ Build the index concurrently on every partition and attach it, runs outside of a transaction block """
+        ret = ''
+        for partition in self.partitions:
+            partition_index = ('%s_%s' % (split_name(partition.name)[1], index.name))[:63]
+            ret += index.create_clause(table=partition.name, name=partition_index, concurrently=True)
+            ret += "ALTER INDEX %s ATTACH PARTITION %s;\n" % (
+                qualify_name(self.name, index.name), qualify_name(self.name, partition_index))
+        return ret
+
+    def created_indexes(self, other):
+        """ Indexes of other created by alter_to, new ones and ones recreated with another definition """
+        ret = []
+        for index in self.indexes:
+            if index not in other.indexes and other.indexes.has_index(index):
+                other_index = other.indexes.get_index(index)
+                if index.alter_to(other_index) is None:
+                    ret.append(other_index)
+        ret += [i for i in other.indexes if not self.indexes.has_index(i)]
+        return ret
+
+    def partition_indexes_to(self, other):
+        """ Return concurrent builds on partitions of indexes created by alter_to, see index_create_clause """
+        if not other.partition_method:
+            return ''
+        return ''.join(other.partition_indexes_clause(index) for index in self.created_indexes(other))
+
+    def diff_to(self, other, safe_not_null=False):
+        """
+        Return alter script followed by indexes of partitions and the backfill as separate scripts
+        to run outside of a transaction block
+        """
+        statements = self.alter_to(other, safe_not_null=safe_not_null, partition_indexes=False)
+        partition_indexes = self.partition_indexes_to(other)
+        if partition_indexes:
+            statements += '-- indexes of partitions, run outside of a transaction block\n' + partition_indexes
+        backfill = self.backfill_to(other)
+        if backfill:
+            statements += '-- backfill, runs outside of a transaction block\n' + backfill
+        return statements
+
+    def backfill_to(self, other):
+        """ Return batched backfill of columns added by alter_to, runs outside of a transaction block """
+
+        statements = ''
+        for other_column in other.columns:
+            if other_column.backfill and not self.columns.has_column(other_column):
+                statements += other_column.backfill_clause(self.name, other.primary_key)
         return statements
 
+    def validate_to(self, other, safe_not_null=False):
+        """ Return validation of constraints added by alter_to, doesn't block writes """
+
+        statements = ''
+        for other_check in other.check:
+            check = self.check.get_constraint(other_check.name)
+            if check is None or not other_check.same_expression(check):
+                statements += other_check.validate_clause()
+
+        if safe_not_null:
+            for column in self.columns:
+                other_column = other.columns.get_column(column)
+                if other_column is not None and other_column.not_null and not column.not_null:
+                    statements += column.validate_not_null_clause(self.name)
+
+        return statements
+
+    def fingerprint(self):
+        """
+        md5 of the canonical definition of the table: columns, primary key, indexes, names of checks
+        and descriptions. Equal to the fingerprint computed by query_tables_fingerprints for a table
+        in the same state, default values and check expressions are left out.
+        """
+        pk = [c.name for c in self.primary_key]
+
+        columns = []
+        for column in sorted(self.columns, key=lambda c: c.name):
+            serial = column.is_serial()
+            not_null = bool(column.not_null) or serial or bool(column.identity) or column.name in pk
+            has_default = column.default is not None or serial
+            columns.append(u'%s %s %s %s %s' % (column.name, normalized_type(column.type), str(not_null).lower(),
+                                               str(has_default).lower(), column.description or ''))
+
+        indexes = []
+        for index in sorted(self.indexes, key=lambda i: i.name):
+            indexes.append(u'%s %s %s %s' % (index.name, str(bool(index.unique)).lower(), index.method,
+                                            ','.join(f.strip() for f in index.fields)))
+
+        content = u'|'.join([
+            u','.join(columns),
+            u','.join(pk),
+            u','.join(indexes),
+            u','.join(sorted(c.name for c in self.check)),
+            u'%s' % (self.description or '')
+        ])
+        return hashlib.md5(content.encode('utf-8')).hexdigest()
+
     def drop_clause(self):
         return "DROP TABLE IF EXISTS %s CASCADE;\n" % self.name
 
@@ -679,14 +1642,18 @@ if __name__ == '__main__':
         table1 = Table.load_from_location(sys.argv[1])
         table2 = Table.load_from_location(sys.argv[2])
         print table1.alter_to(table2)
-    if len(sys.argv) == 4:  # 1st arg is a command and next are table file and connection URL
+    if len(sys.argv) in (4, 5, 6):  # 1st arg is a command, next are table file, connection URL, lock_timeout, retries
         if sys.argv[1] == 'deploy':
             conn_uri = sys.argv[3].rstrip('/')
             table = Table.load_from_location(sys.argv[2])
+            lock_timeout = sys.argv[4] if len(sys.argv) > 4 else '5s'
+            retries = int(sys.argv[5]) if len(sys.argv) > 5 else 3
+            import psycopg2
+            import executor
             conn = psycopg2.connect(conn_uri)
-            table.drop_on_connection(conn)
-            table.create_on_connection(conn)
-            conn.commit()
+            # the table is replaced in one transaction, never queued behind other sessions longer than lock_timeout
+            executor.Executor(conn, lock_timeout=lock_timeout, retries=retries).execute(
+                table.drop_clause() + table.create_clause())
             print 'deployed at %s' % conn_uri + '/' + table.name
         else:
             print 'unknown command %s' % sys.argv[1]
@@ -0,0 +1,76 @@
+import drift
+import tables
+from conftest import FakeConnection
+
+str_table = """
+table: my.accounts
+columns:
+    - id: bigint
+    - name: text
+indexes:
+    - accounts_name: name
+"""
+
+
+def test_1():
+    assert drift.shard_dsns('host=shard{shard}', '0-2,5') == [
+        ('0', 'host=shard0'), ('1', 'host=shard1'), ('2', 'host=shard2'), ('5', 'host=shard5')]
+
+
+def test_2():
+    table = tables.Table(str_table)
+    existing = tables.Table(str_table)
+    assert drift.drifted_indexes(existing, table) == []
+
+    existing.indexes[0].unique = True
+    existing.indexes.append(tables.Index('my.accounts', 'accounts_id', fields=['id']))
+    assert drift.drifted_indexes(existing, table) == ['accounts_id', 'accounts_name']
+
+
+def test_3():
+    table = tables.Table(str_table)
+    results = [
+        ({}, None),
+        ({('my.accounts', None): 'X', ('my.accounts', 'accounts_name'): 'X'}, None),
+        ({('my.accounts', None): 'M'}, None),
+        (None, 'connection refused')
+    ]
+    expected = [
+        '                0 1 2 3',
+        'my.accounts     . X M E',
+        '  accounts_name . X . E'
+    ]
+    assert drift.format_matrix([table], ['0', '1', '2', '3'], results) == expected
+    assert drift.format_matrix([table], ['0'], [({}, None)]) == []
+
+
+def test_4():
+    """ failure of a table is its own cell, failure of the connection is the database error """
+    import psycopg2
+    table = tables.Table(str_table)
+    missing = tables.Table(str_table.replace('my.accounts', 'my.users'))
+    connect = psycopg2.connect
+    try:
+        psycopg2.connect = lambda dsn: FakeConnection(
+            {tables.query_tables_fingerprints: [('my.accounts', 'other'), ('my.users', None)]},
+            {'PREPARE': ValueError('unexpected catalog')})
+        assert drift.database_drift('', [table, missing]) == (
+            {('my.accounts', None): drift.FAILED, ('my.users', None): drift.MISSING}, None)
+        psycopg2.connect = lambda dsn: FakeConnection(errors={'': ValueError('connection lost')})
+        assert drift.database_drift('', [table])[0] is None
+    finally:
+        psycopg2.connect = connect
+
+
+def test_5():
+    """ prepared statements are deallocated after a failed introspection """
+    conn = FakeConnection({tables.query_tables_fingerprints: [('my.accounts', 'other')]},
+                          {'EXECUTE pgbuild_': ValueError('unexpected catalog')})
+    try:
+        drift.drift(conn, [tables.Table(str_table)])
+        assert False
+    except ValueError:
+        pass
+    rollback, deallocate, end = conn.executed[-3:]
+    assert (rollback, end) == ('ROLLBACK', 'ROLLBACK')
+    assert deallocate.startswith('DEALLOCATE pgbuild_') and deallocate.endswith('_table_info;')
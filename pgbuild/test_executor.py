@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import executor
+import roles
+import tables
+from conftest import FakeConnection, FakeRole, LockNotAvailable
+
+
+def test_1():
+    assert executor.is_non_blocking("COMMENT ON COLUMN my.t.a IS 'a';")
+    assert executor.is_non_blocking("-- defaults\nALTER TABLE my.t ALTER COLUMN a SET DEFAULT 0;")
+    assert executor.is_non_blocking("CREATE OR REPLACE FUNCTION f() RETURNS int AS $$ SELECT 1 $$ LANGUAGE sql;")
+    assert not executor.is_non_blocking("ALTER TABLE my.t ALTER COLUMN a SET NOT NULL;")
+    assert executor.is_non_blocking("ALTER TABLE my.t ALTER a SET DEFAULT coalesce(current_setting('a', true), ',');")
+    assert not executor.is_non_blocking("ALTER TABLE my.t ALTER a SET DEFAULT 0, ADD COLUMN b int NOT NULL DEFAULT 0;")
+    assert not executor.is_non_blocking("ALTER TABLE my.t ALTER a DROP DEFAULT, ALTER b TYPE bigint;")
+    assert not executor.is_non_blocking("CREATE INDEX t_a ON my.t (a);")
+
+    tasks = [
+        roles.SQLTask(1, 'schema', 'CREATE SCHEMA IF NOT EXISTS my;\n'),
+        roles.SQLTask(2, 'sql', "COMMENT ON SCHEMA my IS 'mine';\n"),
+        roles.SQLTask(3, 'sql', 'CREATE TABLE my.t (a int);\n'),
+        roles.SQLTask(4, 'sql', "COMMENT ON TABLE my.t IS 't';\n")]
+    conn = FakeConnection()
+    executor.Executor(conn).deploy_role(FakeRole(tasks))
+    assert conn.executed == [
+        "CREATE SCHEMA IF NOT EXISTS my;\nCOMMENT ON SCHEMA my IS 'mine';\n", 'COMMIT',
+        'CREATE TABLE my.t (a int);\n', 'COMMIT',
+        "COMMENT ON TABLE my.t IS 't';\n", 'COMMIT']
+
+
+def test_2():
+    tasks = [
+        roles.SQLTask(1, 'sql', "COMMENT ON SCHEMA my IS 'mine';\n"),
+        roles.SQLTask(2, 'sql', "COMMENT ON TABLE my.t IS 't';\nCOMMENT ON COLUMN my.t.a IS broken;\n")]
+    conn = FakeConnection(errors={'broken': Exception('syntax error at or near "broken"')})
+    try:
+        executor.Executor(conn).deploy_role(FakeRole(tasks))
+        assert False
+    except executor.ExecutorError, e:
+        assert str(e) == ('sql task 2 failed at statement COMMENT ON COLUMN my.t.a IS broken;: '
+                          'syntax error at or near "broken"')
+    # the first task is committed on its own after the batch failed
+    assert conn.executed[2:4] == ["COMMENT ON SCHEMA my IS 'mine';\n", 'COMMIT']
+
+
+def test_3():
+    table = tables.Table("""
+table: my.t
+columns:
+    - a: int
+indexes:
+    - t_a: [a]
+""")
+    directory = tempfile.mkdtemp()
+    copies = []
+    for number, rows in [(2, 1), (3, 3)]:
+        path = os.path.join(directory, '%s.csv' % number)
+        with open(path, 'w') as f:
+            f.write('1\n' * rows)
+        copies.append(roles.CSVTask(number, 'copy', 'my.t', ['a'], path, 'csv', ',', None))
+    tasks = [roles.SQLTask(1, 'table', None, definition=table, render=lambda: table.iter_create_clause())]
+
+    messages = []
+    conn = FakeConnection()
+    executor.Executor(conn, log=messages.append).deploy_role(FakeRole(tasks + copies))
+    assert conn.executed[:2] == [executor.query_existing_tables, 'ROLLBACK']
+    assert 'CREATE INDEX' not in conn.executed[2]
+    # largest file first, indexes after the load
+    assert conn.executed[4:8] == ['COPY my.t', 'COMMIT', 'COPY my.t', 'COMMIT']
+    assert messages[1] == 'myrole: copy task 3 done, 3 rows'
+    assert messages[3].startswith('myrole: 4 rows loaded from 2 files in ')
+    assert conn.executed[8].startswith('CREATE INDEX t_a ON my.t')
+    shutil.rmtree(directory)
+    assert executor.deferred_indexes(tasks + copies) == {'my.t': table}
+    # the table task of a table loaded before it is created doesn't skip its indexes
+    assert executor.deferred_indexes(copies + tasks) == {}
+    assert executor.deferred_indexes(copies[:1] + tasks + copies[1:]) == {}
+
+
+def test_4():
+    """ only statements which can't run in a transaction block are run out of it, retried one by one """
+    assert executor.is_non_transactional('CREATE UNIQUE INDEX CONCURRENTLY t_a ON my.t (a);')
+    assert executor.is_non_transactional('-- rebuild\nREINDEX (VERBOSE) INDEX CONCURRENTLY my.t_a;')
+    assert executor.is_non_transactional('ALTER TABLE my.t DETACH PARTITION my.t_1 CONCURRENTLY;')
+    assert not executor.is_non_transactional("COMMENT ON TABLE my.t IS 'updated concurrently';")
+
+    table = tables.Table("""
+table: my.t
+description: rows are updated concurrently by workers
+columns:
+    - a: int
+indexes:
+    - t_a: [a]
+""")
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 't.csv')
+    open(path, 'w').write('1\n')
+    tasks = [roles.SQLTask(1, 'table', None, definition=table, render=lambda: table.iter_create_clause()),
+             roles.CSVTask(2, 'copy', 'my.t', ['a'], path, 'csv', ',', None)]
+    conn = FakeConnection()
+    executor.Executor(conn, log=lambda message: None).deploy_role(FakeRole(tasks))
+    assert len([sql for sql in conn.executed if 'CREATE INDEX t_a' in sql]) == 1
+    assert conn.executed[-2].startswith('CREATE INDEX t_a')
+    shutil.rmtree(directory)
+
+    index = 'CREATE INDEX CONCURRENTLY t_b ON my.t (b);'
+    conn = FakeConnection(errors={index: [LockNotAvailable('canceling statement due to lock timeout')]})
+    messages = []
+    executor.Executor(conn, log=messages.append, lock_timeout='1s', retries=1, retry_delay=0).run_task(
+        roles.SQLTask(3, 'sql', "COMMENT ON TABLE my.t IS 't';\n" + index))
+    assert conn.executed == ['SET lock_timeout = %s', "COMMENT ON TABLE my.t IS 't';", index, index, 'RESET lock_timeout']
+    assert messages[0].startswith('sql task 3: lock not acquired within 1s, retry 1 of 1')
+
+
+def test_5():
+    """ indexes are created after a failed load too, indexes of existing tables aren't deferred """
+    table = tables.Table("""
+table: my.t
+columns:
+    - a: int
+indexes:
+    - t_a: [a]
+""")
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'broken.csv')
+    open(path, 'w').write('x\n')
+    tasks = [roles.SQLTask(1, 'table', None, definition=table, render=lambda: table.iter_create_clause()),
+             roles.CSVTask(2, 'copy', 'my.t', ['a'], path, 'csv', ',', None)]
+    errors = {'COPY my.t': Exception('invalid input syntax for type integer')}
+    conn = FakeConnection(errors=errors)
+    try:
+        executor.Executor(conn).deploy_role(FakeRole(tasks))
+        assert False
+    except executor.ExecutorError, e:
+        assert 'copy task 2 failed' in str(e)
+    assert conn.executed[-2].startswith('CREATE INDEX t_a')
+
+    conn = FakeConnection({executor.query_existing_tables: [('my.t',)]}, errors)
+    try:
+        executor.Executor(conn).deploy_role(FakeRole(tasks))
+        assert False
+    except executor.ExecutorError:
+        pass
+    assert [sql for sql in conn.executed if 'CREATE INDEX t_a' in sql and 'CREATE  TABLE' in sql]
+    shutil.rmtree(directory)
@@ -0,0 +1,40 @@
+import hashlib
+import functions
+
+script = """
+CREATE OR REPLACE FUNCTION myschema.myfunction(a int, b text)
+RETURNS void AS
+$$
+BEGIN
+    RETURN;
+END;
+$$
+LANGUAGE plpgsql SECURITY DEFINER;
+"""
+
+
+def test_1():
+
+    function = functions.Function(script)
+
+    assert function.name == 'myschema.myfunction'
+    assert function.arguments == 'a int, b text'
+    assert function.result == 'void'
+    assert function.fingerprint() is not None
+    assert function.fingerprint() != functions.Function(script.replace('SECURITY DEFINER', '')).fingerprint()
+    assert functions.Function(script.replace('plpgsql', 'plpgsql COST 10')).fingerprint() is None
+
+
+def test_2():
+    """ local fingerprint equals the one computed from pg_get_function_arguments and pg_get_function_result """
+    function = functions.Function(script.replace('a int, b text', 'a int, VARIADIC b varchar(10)[]').replace(
+        'RETURNS void', 'RETURNS SETOF bool'))
+    server = hashlib.md5('|'.join([
+        'a integer, variadic b character varying(10)[]',
+        'setof boolean',
+        'plpgsql', 'v', 'f', 't',
+        function.body
+    ])).hexdigest()
+    assert function.fingerprint() == server
+    assert functions.canonical_arguments('int, double precision') == 'integer, double precision'
+    assert functions.canonical_result('TABLE (id int, name text)') == 'table(id integer, name text)'
@@ -0,0 +1,33 @@
+import indexes
+import tables
+
+str_table = """
+table: my.table
+columns:
+    - col1: int
+    - col2: text
+    - col3: text
+primary_key: [col1]
+indexes:
+    - idx1: [col1]
+    - idx2: [col2]
+    - idx3: [col2, col3]
+    - idx4:
+        fields: [col2]
+        method: gin
+    - idx5:
+        fields: [col2, col3]
+        unique: true
+"""
+
+
+def test_1():
+
+    table = tables.Table(str_table)
+    found = [(i.name, o.name, r) for i, o, r in indexes.redundant_indexes(table)]
+
+    assert found == [
+        ('idx1', 'table_pkey', 'duplicate'),
+        ('idx2', 'idx3', 'prefix'),
+        ('idx3', 'idx5', 'duplicate'),
+    ]
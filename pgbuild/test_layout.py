@@ -0,0 +1,23 @@
+import layout
+import tables
+
+str_table = """
+table: my.table
+columns:
+    - a: boolean
+    - b: bigint
+    - c: boolean
+    - d: timestamptz
+    - e: text
+    - f: int
+"""
+
+
+def test_1():
+
+    table = tables.Table(str_table)
+    current, optimal, order = layout.analyze(table)
+
+    assert current == 19.5
+    assert optimal == 0
+    assert [c.name for c in order] == ['b', 'd', 'f', 'a', 'c', 'e']
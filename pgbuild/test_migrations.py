@@ -0,0 +1,103 @@
+import os
+import tempfile
+import migrations
+import roles
+from conftest import FakeRole
+
+descriptor = """
+app:
+  - schema: my
+  - table: t.yaml
+  - sql: CREATE INDEX IF NOT EXISTS t_name ON my.t (name)
+  - copy:
+      table: my.t
+      columns: [id, name]
+      from: t.csv
+"""
+
+str_table = """
+table: my.t
+columns:
+    - id: int
+    - name: text
+check:
+    - t_id_check: id > 0
+"""
+
+
+def make_app():
+    directory = tempfile.mkdtemp()
+    open(os.path.join(directory, 'app.yaml'), 'w').write(descriptor)
+    open(os.path.join(directory, 't.yaml'), 'w').write(str_table)
+    open(os.path.join(directory, 't.csv'), 'w').write('1,a\n')
+    return directory
+
+
+def load_role(directory):
+    return roles.load_from_file(os.path.join(directory, 'app.yaml'))[0]
+
+
+def test_1():
+    """ snapshot written by a build loads back the same """
+    directory = make_app()
+    snapshot = migrations.Snapshot.from_role(load_role(directory))
+    os.mkdir(os.path.join(directory, 'app'))
+    path = os.path.join(directory, 'app', migrations.SNAPSHOT_FILE)
+    snapshot.write(path)
+    loaded = migrations.Snapshot.load_from_file(path)
+    assert loaded.tables.keys() == ['my.t']
+    assert loaded.tables['my.t'].alter_to(snapshot.tables['my.t']) == ''
+    assert loaded.task_hashes == snapshot.task_hashes
+    assert len(loaded.task_hashes) == 3
+    assert migrations.load_snapshots(directory).keys() == ['app']
+
+
+def test_2():
+    """ since a build of the same state nothing is migrated, a changed table is altered """
+    directory = make_app()
+    snapshots = migrations.load_snapshots(os.path.join(directory, 'app.yaml'))
+    assert migrations.migration_tasks(load_role(directory), snapshots['app']) == []
+
+    open(os.path.join(directory, 't.yaml'), 'a').write('    - t_name_check: length(name) > 0\n')
+    tasks = migrations.migration_tasks(load_role(directory), snapshots['app'])
+    assert [t.task_type for t in tasks] == ['table', 'validate']
+    assert 'ADD CONSTRAINT t_name_check' in tasks[0].sql_content
+    assert 't_id_check' not in tasks[0].sql_content
+    assert 'VALIDATE CONSTRAINT t_name_check' in tasks[1].sql_content
+
+    assert len(migrations.migration_tasks(load_role(directory), None)) == 5
+
+
+def test_3():
+    """ copy task is kept when its data file changes """
+    directory = make_app()
+    snapshot = migrations.Snapshot.from_role(load_role(directory))
+    open(os.path.join(directory, 't.csv'), 'a').write('2,b\n')
+    tasks = migrations.migration_tasks(load_role(directory), snapshot)
+    assert [t.task_type for t in tasks] == ['copy']
+
+
+def test_4():
+    """ indexes of partitions are built by a task of their own, not in a single transaction """
+    import tables
+    str_events = """
+table: my.events
+columns:
+    - created: date
+partition_by:
+    method: range
+    key: [created]
+    interval: {start: 2020-01-01, end: 2020-02-01, step: 1 month}
+"""
+    previous = tables.Table(str_events)
+    table = tables.Table(str_events + 'indexes:\n    - events_created: created\n')
+    task = roles.SQLTask(1, 'table', None, definition=table, render=table.iter_create_clause)
+    task.retries = 3
+    snapshot = migrations.Snapshot()
+    snapshot.tables['my.events'] = previous
+    tasks = migrations.migration_tasks(FakeRole([task]), snapshot)
+    assert [(t.number, t.task_type) for t in tasks] == [(1, 'table'), ('1_indexes', 'indexes')]
+    assert 'CONCURRENTLY' not in tasks[0].sql_content
+    assert tasks[0].psql_options == ' --single-transaction'
+    assert 'CREATE INDEX CONCURRENTLY' in tasks[1].sql_content
+    assert tasks[1].psql_options == ''
@@ -0,0 +1,55 @@
+import monitor
+from conftest import FakeConnection
+
+
+def test_1():
+    assert monitor.format_duration(5.5) == '5s'
+    assert monitor.format_duration(125) == '2m05s'
+    assert monitor.format_duration(3720) == '1h02m'
+
+    estimate = monitor.Estimate()
+    assert estimate.update('scan', 0.1, 100.0) is None
+    assert estimate.update('scan', 0.3, 110.0) == 35.0
+    assert estimate.update('sort', 0.5, 120.0) is None  # next phase restarts the estimate
+    assert monitor.progress_message('scanning table', 0.45, 80) == 'scanning table 45% ETA 1m20s'
+    assert monitor.fraction(10, 0) is None
+
+
+def test_2():
+    messages = []
+    m = monitor.Monitor('', 42, messages.append, interval=5.0, cancel_after=4.0)
+    m.begin('myrole: table task 3')
+    m.connection = FakeConnection({
+        monitor.query_activity: [('active', 'Lock', 'start', 7.0, 'ALTER TABLE my.table ...')],
+        monitor.query_lock_wait: [('my.table', 'AccessExclusiveLock', 12)],
+        monitor.query_blockers: [(4242, 'report', 'idle in transaction', 312.0, 'SELECT 1')],
+        monitor.query_cancel: [(True,)]})
+    m.poll()
+    assert messages == [
+        'myrole: table task 3: waiting 5s for AccessExclusiveLock on my.table, 12 sessions queued behind',
+        '    blocked by pid 4242 (report, idle in transaction 5m12s): SELECT 1',
+        'myrole: table task 3: cancelled after waiting 5s for a lock']
+    assert monitor.query_cancel in m.connection.executed
+
+
+def test_3():
+    """ a wait interrupted by other work restarts, the cancel is skipped once the wait ended """
+    messages = []
+    m = monitor.Monitor('', 42, messages.append, interval=5.0, cancel_after=8.0)
+    m.has_index_progress = m.has_copy_progress = False
+    results = {
+        monitor.query_activity: [('active', 'Lock', 'start', 7.0, 'ALTER TABLE my.table ...')],
+        monitor.query_lock_wait: [('my.table', 'AccessExclusiveLock', 0)]}
+    m.connection = FakeConnection(results)
+    m.poll()
+    assert m.wait_key == 'start'
+    results[monitor.query_activity] = [('active', 'IO', 'start', 12.0, 'ALTER TABLE my.table ...')]
+    m.poll()
+    assert m.wait_key is None
+    results[monitor.query_activity] = [('active', 'Lock', 'start', 17.0, 'ALTER TABLE my.table ...')]
+    m.poll()
+    assert monitor.query_cancel not in m.connection.executed
+    m.wait_start -= 5.0
+    m.poll()
+    assert monitor.query_cancel in m.connection.executed
+    assert not [message for message in messages if 'cancelled' in message]
@@ -18,3 +18,75 @@ def test_1():
     for rname in d.keys():
         role = roles.Role(rname, d[rname])
         print role.build()
+
+
+def test_2():
+    """ only tasks of changed files are rebuilt """
+    import os
+    import tempfile
+    directory = tempfile.mkdtemp()
+    table_path = os.path.join(directory, 'table.yaml')
+    open(table_path, 'w').write('table: myschema.t\ncolumns:\n    - id: int\n')
+
+    role = roles.Role('role1', yaml.load("[{schema: myschema}, {table: table.yaml}]"), directory)
+    schema_task, table_task = role.tasks
+    assert role.sources == [roles.full_path(table_path)]
+
+    assert role.rebuild(set(['/nonexistent'])) == []
+
+    open(table_path, 'w').write('table: myschema.t\ncolumns:\n    - id: bigint\ncheck:\n    - c: id > 0\n')
+    rebuilt = role.rebuild(set([roles.full_path(table_path)]))
+    assert [t.number for t in rebuilt] == [1, '1_validate']
+    assert role.tasks[0] is schema_task
+    assert role.tasks[1] is not table_task
+    assert 'bigint' in role.tasks[1].sql_content
+    assert role.tasks[2].task_type == 'validate'
+
+
+def test_3():
+    """ only selected roles and item types are loaded, item numbers are kept """
+    import os
+    import tempfile
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'app.yaml')
+    open(path, 'w').write('role1:\n  - schema: s\n  - sql: SELECT 1\nrole2:\n  - function: missing.sql\n')
+
+    loaded = roles.load_from_file(path, only_roles=['role1'], only_types=['sql'])
+    assert [r.name for r in loaded] == ['role1']
+    assert [(t.number, t.task_type) for t in loaded[0].tasks] == [(1, 'sql')]
+
+
+def test_4():
+    """ a table referenced by several roles is loaded once """
+    import os
+    import tempfile
+    directory = tempfile.mkdtemp()
+    open(os.path.join(directory, 'table.yaml'), 'w').write('table: s.t\ncolumns:\n    - id: int\n')
+    path = os.path.join(directory, 'app.yaml')
+    open(path, 'w').write('role1:\n  - table: table.yaml\nrole2:\n  - table: table.yaml\n')
+
+    role1, role2 = roles.load_from_file(path)
+    assert role1.registry is role2.registry
+    assert role1.tasks[0].definition is role2.tasks[0].definition
+
+    optimized = roles.load_from_file(path, optimize_layout=True, registry=role1.registry)
+    assert optimized[0].tasks[0].definition is not role1.tasks[0].definition
+
+
+def test_5():
+    """ files referenced by a descriptor whose roles can't be loaded """
+    import os
+    import tempfile
+    directory = roles.full_path(tempfile.mkdtemp())
+    descriptor = os.path.join(directory, 'app.yaml')
+    open(descriptor, 'w').write(
+        'role1:\n  - table: missing.yaml\n  - copy: {table: t, columns: [id], from: data/t.csv}\n  - sql: SELECT 1\n')
+    try:
+        roles.load_from_file(descriptor)
+        assert False
+    except IOError:
+        pass
+    assert roles.referenced_paths(descriptor) == [
+        descriptor, os.path.join(directory, 'missing.yaml'), os.path.join(directory, 'data', 't.csv')]
+    open(descriptor, 'w').write('role1: [')
+    assert roles.referenced_paths(descriptor) == [descriptor]
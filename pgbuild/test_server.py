@@ -0,0 +1,73 @@
+import os
+import tempfile
+import server
+from conftest import FakeConnection
+
+str_table = """
+table: my.t
+columns:
+    - id: int
+"""
+
+
+def test_1():
+    """ cached table is reloaded only after its file changes """
+    path = tempfile.mktemp(suffix='.yaml')
+    open(path, 'w').write(str_table)
+    s = server.Server()
+
+    table = s.table(path)
+    assert s.table(path) is table
+
+    open(path, 'a').write('    - name: text\n')
+    os.utime(path, (0, 0))
+    changed = s.table(path)
+    assert changed is not table
+    assert [c.name for c in changed.columns] == ['id', 'name']
+    os.remove(path)
+
+
+def test_2():
+    response = server.Server().respond('{"command": "drop", "args": []}')
+    assert response == {'ok': False, 'error': 'unknown command drop'}
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.returned = []
+
+    def getconn(self):
+        return FakeConnection(errors={'': ValueError('no catalog')})
+
+    def putconn(self, conn, close=False):
+        self.returned.append(close)
+
+
+def test_3():
+    """ connection of a failed introspection is closed instead of leaking """
+    s = server.Server()
+    pool = s.pools['dbname=app'] = FakePool()
+    try:
+        s.existing_table('dbname=app', 'my.t')
+        assert False
+    except ValueError:
+        pass
+    assert pool.returned == [True]
+
+
+def test_4():
+    """ files of a build aren't hard links to files of a previous build of cached roles """
+    directory = tempfile.mkdtemp()
+    descriptor = os.path.join(directory, 'app.yaml')
+    open(descriptor, 'w').write('app:\n  - sql: SELECT 1\n  - sql: SELECT 1\n')
+    s = server.Server()
+    s.build(descriptor, os.path.join(directory, 'build1'))
+    s.build(descriptor, os.path.join(directory, 'build2'))
+    files = []
+    for build in ['build1', 'build2']:
+        for root, dirs, names in os.walk(os.path.join(directory, build)):
+            files.extend(os.path.join(root, n) for n in names if os.path.basename(root) == 'files')
+    inodes = set(os.stat(f).st_ino for f in files)
+    assert len(files) == 4
+    assert len(inodes) == 2
@@ -0,0 +1,76 @@
+"""
+Local commands must not load the database driver.
+Their startup time is measured by running the module: python test_startup.py
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+str_table = """
+table: my.t
+columns:
+    - id: int
+"""
+
+run_command = """
+import sys
+sys.path.insert(0, %r)
+sys.argv = ['pgbuild.py'] + %r
+if sys.argv[1:]:
+    execfile(%r, {'__name__': '__main__'})
+else:
+    import pgbuild
+print sorted(m for m in sys.modules if m.split('.')[0] in ('psycopg2', 'pgbuild'))
+"""
+
+
+def run(args):
+    script = run_command % (ROOT, args, os.path.join(ROOT, 'pgbuild.py'))
+    started = time.time()
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', script])
+    return time.time() - started, output
+
+
+def table_file():
+    path = tempfile.mktemp(suffix='.yaml')
+    open(path, 'w').write(str_table)
+    return path
+
+
+def test_1():
+    path = table_file()
+    elapsed, output = run(['ddl', path])
+    os.remove(path)
+    modules = eval(output.strip().splitlines()[-1])
+    assert 'CREATE  TABLE IF NOT EXISTS my.t' in output
+    assert not [m for m in modules if m.startswith('psycopg2')]
+    assert 'pgbuild.server' not in modules
+    assert 'pgbuild.executor' not in modules
+
+
+def test_2():
+    elapsed, output = run([])
+    modules = eval(output.strip().splitlines()[-1])
+    assert 'pgbuild' in modules
+    assert not [m for m in modules if m.startswith('psycopg2')]
+
+
+def test_3():
+    """ a table in a database is a table source of commands, it isn't opened as a file """
+    import imp
+    cli = imp.load_source('pgbuild_cli', os.path.join(ROOT, 'pgbuild.py'))
+    assert cli.is_table_file('postgresql://user@host:5432/dbname/myschema.mytable')
+    path = table_file()
+    assert cli.is_table_file(path)
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    path = table_file()
+    timings = sorted(run(['ddl', path])[0] for i in range(5))
+    os.remove(path)
+    print 'ddl startup: min %.3fs, median %.3fs' % (timings[0], timings[2])
@@ -0,0 +1,103 @@
+import swap
+import tables
+from conftest import FakeConnection
+
+str_existing = """
+table: my.accounts
+columns:
+    - id: bigint
+    - name: text
+primary_key: [id]
+"""
+
+str_table = """
+table: my.accounts
+columns:
+    - id: bigint
+    - name: varchar(100)
+    - active:
+        type: boolean
+        default: true
+        not_null: true
+primary_key: [id]
+indexes:
+    - accounts_name: name
+"""
+
+
+def test_1():
+    s = swap.Swap(None, tables.Table(str_existing), tables.Table(str_table))
+    assert s.shadow_name == 'my.accounts__pgbuild_new'
+    assert s.columns == ['id', 'name']
+    setup = s.setup_clause()
+    assert 'CREATE TRIGGER pgbuild_swap AFTER INSERT OR UPDATE OR DELETE ON my.accounts' in setup
+    assert 'INSERT INTO my.accounts__pgbuild_log (id) VALUES (OLD.id);' in setup
+    assert 'TABLE IF NOT EXISTS my.accounts__pgbuild_new (' in setup
+    assert 'accounts_name' not in setup
+    assert s.indexes_clause().startswith('CREATE INDEX accounts_name__pgbuild ON my.accounts__pgbuild_new')
+
+    conn = FakeConnection({'SELECT id FROM': [(42,)]})
+    assert s.copy_chunk(conn.cursor(), (10,)) == (42,)
+    assert (conn.executed[1], conn.params[1]) == (
+        'INSERT INTO my.accounts__pgbuild_new (id, name) SELECT id, name FROM my.accounts '
+        'WHERE (id) > %(last)s AND (id) <= %(next)s', {'last': (10,), 'next': (42,)})
+
+
+def test_2():
+    table = tables.Table(str_table)
+    existing = tables.Table(str_existing)
+    existing.primary_key = []
+    try:
+        swap.Swap(None, existing, table)
+        assert False
+    except swap.SwapError:
+        pass
+
+    table = tables.Table(str_table)
+    table.columns[2].default = None
+    try:
+        swap.Swap(None, tables.Table(str_existing), table)
+        assert False
+    except swap.SwapError, e:
+        assert 'active' in str(e)
+
+
+def test_3():
+    assert swap.suffixed_name('accounts', '__pgbuild_log') == 'accounts__pgbuild_log'
+    assert swap.suffixed_name('my.' + 'a' * 60, '__pgbuild_new') == 'my.' + 'a' * 50 + '__pgbuild_new'
+
+
+def test_4():
+    """ checks are created on the shadow table, privileges and comments are moved to it """
+    table = tables.Table(str_table + """check:
+    - name_not_empty: name <> ''
+""")
+    s = swap.Swap(None, tables.Table(str_existing), table)
+    setup = s.setup_clause()
+    assert 'ALTER TABLE my.accounts__pgbuild_new ADD CONSTRAINT name_not_empty' in setup
+    assert 'ALTER TABLE my.accounts ADD CONSTRAINT' not in setup
+
+    conn = FakeConnection({
+        swap.query_owner: [('owner',)],
+        swap.query_privileges: [('SELECT', 'app', False)],
+        swap.query_comments: [(None, 'accounts'), ('name', 'name'), ('id', None)]})
+    s.move_attributes(conn.cursor())
+    assert conn.executed[1::2] == [
+        'ALTER TABLE my.accounts__pgbuild_new OWNER TO owner',
+        'GRANT SELECT ON my.accounts__pgbuild_new TO app',
+        'COMMENT ON TABLE my.accounts__pgbuild_new IS %s']
+    assert (conn.executed[-1], conn.params[-1]) == (
+        'COMMENT ON COLUMN my.accounts__pgbuild_new.name IS %s', ('name',))
+
+
+def test_5():
+    """ values of GENERATED ALWAYS identity columns are copied """
+    table = tables.Table(str_table.replace('    - id: bigint', """    - id:
+        type: bigint
+        identity: always"""))
+    s = swap.Swap(None, tables.Table(str_existing), table)
+    conn = FakeConnection({'SELECT id FROM': [(42,)]})
+    s.copy_chunk(conn.cursor(), None)
+    assert conn.executed[1] == (
+        'INSERT INTO my.accounts__pgbuild_new (id, name) OVERRIDING SYSTEM VALUE SELECT id, name FROM my.accounts '
+        ' WHERE (id) <= %(next)s')
@@ -72,7 +72,8 @@ CREATE UNIQUE INDEX CONCURRENTLY idx3 ON myschema.mytable USING btree
     WHERE blabla;
 CREATE INDEX CONCURRENTLY idx4 ON myschema.mytable USING gin
     (col1, col2);
-ALTER TABLE myschema.mytable ADD CONSTRAINT col1_check CHECK (col1 > 0 and col1 < 100);
+ALTER TABLE myschema.mytable ADD CONSTRAINT col1_check CHECK (col1 > 0 and col1 < 100) NOT VALID;
+ALTER TABLE myschema.mytable VALIDATE CONSTRAINT col1_check;
 """
 
 
@@ -143,3 +144,381 @@ ALTER TABLE my.table ADD PRIMARY KEY (col1, col2);
     assert expected == t1.alter_to(t2)
 
 
+
+
+def test_5():
+
+    st1 = """
+table: my.table
+columns:
+    - col1: int
+    - col2: text
+check:
+    - col1_check: col1 > 0
+"""
+
+    st2 = """
+table: my.table
+columns:
+    - col1: int
+    - col2:
+        type: text
+        not_null: true
+check:
+    - col1_check: col1 > 1
+"""
+
+    expected = """ALTER TABLE my.table ADD CONSTRAINT table_col2_not_null CHECK (col2 IS NOT NULL) NOT VALID;
+ALTER TABLE my.table DROP CONSTRAINT col1_check;
+ALTER TABLE my.table ADD CONSTRAINT col1_check CHECK (col1 > 1) NOT VALID;
+"""
+    expected_validate = """ALTER TABLE my.table VALIDATE CONSTRAINT col1_check;
+ALTER TABLE my.table VALIDATE CONSTRAINT table_col2_not_null;
+ALTER TABLE my.table ALTER COLUMN col2 SET NOT NULL;
+ALTER TABLE my.table DROP CONSTRAINT table_col2_not_null;
+"""
+    t1 = tables.Table(st1)
+    t2 = tables.Table(st2)
+    assert expected == t1.alter_to(t2, validate=False, safe_not_null=True)
+    assert expected_validate == t1.validate_to(t2, safe_not_null=True)
+
+
+def test_6():
+
+    st1 = """
+table: my.table
+columns:
+    - id: int
+primary_key: [id]
+"""
+
+    st2 = """
+table: my.table
+columns:
+    - id: int
+    - col2:
+        type: int
+        default: 0
+        not_null: true
+        backfill:
+            batch_size: 100
+            max_lag: 64MB
+primary_key: [id]
+"""
+
+    t1 = tables.Table(st1)
+    t2 = tables.Table(st2)
+    alter = t1.alter_to(t2, backfill=False)
+    backfill = t1.backfill_to(t2)
+
+    assert 'SET NOT NULL' not in alter
+    assert 'LIMIT 100' in backfill
+    assert "pg_size_bytes('64MB')" in backfill
+    assert backfill.endswith("ALTER TABLE my.table ALTER COLUMN col2 SET NOT NULL;\n")
+    assert t1.alter_to(t2) == alter
+    assert t1.alter_to(t2, backfill=True) == alter + backfill
+    assert t1.diff_to(t2) == alter + '-- backfill, runs outside of a transaction block\n' + backfill
+
+
+def test_7():
+
+    st1 = """
+table: my.table
+columns:
+    - id: int
+storage:
+    fillfactor: 90
+    autovacuum_enabled: true
+"""
+
+    st2 = """
+table: my.table
+columns:
+    - id: int
+unlogged: true
+tablespace: fast
+storage:
+    fillfactor: 70
+"""
+
+    expected = """ALTER TABLE my.table SET UNLOGGED;
+ALTER TABLE my.table SET TABLESPACE fast;
+ALTER TABLE my.table SET (fillfactor = 70);
+ALTER TABLE my.table RESET (autovacuum_enabled);
+"""
+    t1 = tables.Table(st1)
+    t2 = tables.Table(st2)
+    assert expected == t1.alter_to(t2)
+    assert t2.create_clause().startswith("""CREATE UNLOGGED TABLE IF NOT EXISTS my.table (
+    id int
+)
+WITH (fillfactor = 70)
+TABLESPACE fast;
+""")
+
+
+def test_8():
+
+    st1 = """
+table: my.events
+columns:
+    - id: bigint
+    - created: date
+indexes:
+    - events_created: created
+partition_by:
+    method: range
+    key: [created]
+    interval:
+        start: 2020-01-01
+        end: 2020-03-01
+        step: 1 month
+"""
+
+    st2 = """
+table: my.events
+columns:
+    - id: bigint
+    - created: date
+indexes:
+    - events_created: created
+    - events_id: id
+partition_by:
+    method: range
+    key: [created]
+    interval:
+        start: 2020-02-01
+        end: 2020-04-01
+        step: 1 month
+"""
+
+    t1 = tables.Table(st1)
+    t2 = tables.Table(st2)
+
+    assert [p.name for p in t1.partitions] == ['my.events_p20200101', 'my.events_p20200201']
+    assert """CREATE TABLE IF NOT EXISTS my.events_p20200201 PARTITION OF my.events FOR VALUES FROM ('2020-02-01') TO ('2020-03-01');""" in t1.create_clause()
+
+    expected = """CREATE TABLE IF NOT EXISTS my.events_p20200301 (LIKE my.events INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE);
+ALTER TABLE my.events ATTACH PARTITION my.events_p20200301 FOR VALUES FROM ('2020-03-01') TO ('2020-04-01');
+CREATE INDEX events_id ON ONLY my.events USING btree
+    (id);
+CREATE INDEX CONCURRENTLY events_p20200201_events_id ON my.events_p20200201 USING btree
+    (id);
+ALTER INDEX my.events_id ATTACH PARTITION my.events_p20200201_events_id;
+CREATE INDEX CONCURRENTLY events_p20200301_events_id ON my.events_p20200301 USING btree
+    (id);
+ALTER INDEX my.events_id ATTACH PARTITION my.events_p20200301_events_id;
+ALTER TABLE my.events DETACH PARTITION my.events_p20200101;
+DROP TABLE IF EXISTS my.events_p20200101;
+"""
+    assert expected == t1.alter_to(t2)
+
+    # concurrent builds on partitions are a separate script running out of a transaction block
+    alter = t1.alter_to(t2, partition_indexes=False)
+    partition_indexes = t1.partition_indexes_to(t2)
+    assert 'CONCURRENTLY' not in alter
+    assert 'CREATE INDEX events_id ON ONLY my.events' in alter
+    assert partition_indexes.startswith('CREATE INDEX CONCURRENTLY events_p20200201_events_id')
+    assert partition_indexes.endswith('ALTER INDEX my.events_id ATTACH PARTITION my.events_p20200301_events_id;\n')
+
+
+def test_9():
+    """ index storage, covering columns and build settings """
+
+    st1 = """
+table: my.orders
+columns:
+    - id: bigint
+    - customer: bigint
+    - total: numeric
+indexes:
+    - orders_customer:
+        fields: [customer]
+        include: [total]
+        storage:
+            fillfactor: 90
+        maintenance_work_mem: 1GB
+        max_parallel_maintenance_workers: 4
+"""
+
+    st2 = """
+table: my.orders
+columns:
+    - id: bigint
+    - customer: bigint
+    - total: numeric
+indexes:
+    - orders_customer:
+        fields: [customer]
+        include: [total]
+        storage:
+            fillfactor: 70
+        tablespace: fast
+"""
+
+    t1 = tables.Table(st1)
+    t2 = tables.Table(st2)
+
+    expected = """SET maintenance_work_mem = '1GB';
+SET max_parallel_maintenance_workers = '4';
+CREATE INDEX orders_customer ON my.orders USING btree
+    (customer)
+    INCLUDE (total)
+    WITH (fillfactor = 90);
+RESET maintenance_work_mem;
+RESET max_parallel_maintenance_workers;
+"""
+    assert expected == t1.indexes[0].create_clause()
+
+    expected = """ALTER INDEX my.orders_customer SET (fillfactor = 70);
+ALTER INDEX my.orders_customer SET TABLESPACE fast;
+"""
+    assert expected == t1.alter_to(t2)
+
+
+def test_10():
+    """ fingerprint doesn't depend on type aliases, columns order and implicit not null """
+
+    st1 = """
+table: my.accounts
+columns:
+    - id: serial
+    - name: varchar(64)
+    - created: timestamptz
+primary_key: [id]
+indexes:
+    - accounts_name: name
+"""
+
+    st2 = """
+table: my.accounts
+columns:
+    - created: timestamp with time zone
+    - name: character varying(64)
+    - id:
+        type: integer
+        not_null: true
+        default: nextval('my.accounts_id_seq'::regclass)
+primary_key: [id]
+indexes:
+    - accounts_name: [name]
+"""
+
+    t1 = tables.Table(st1)
+    t2 = tables.Table(st2)
+    assert t1.fingerprint() == t2.fingerprint()
+
+    t2.indexes[0].unique = True
+    assert t1.fingerprint() != t2.fingerprint()
+
+
+def test_11():
+    """ introspection queries are prepared once and executed for every table """
+
+    class Cursor(object):
+        def __init__(self):
+            self.statements = []
+
+        def execute(self, sql, params=None):
+            self.statements.append(sql.split('(')[0])
+
+    class Connection(object):
+        def __init__(self):
+            self.cur = Cursor()
+
+        def cursor(self):
+            return self.cur
+
+    conn = Connection()
+    introspector = tables.Introspector(conn)
+    introspector.execute('columns_info', 'my.t1')
+    introspector.execute('columns_info', 'my.t2')
+    prefix = introspector.prefix
+    assert conn.cur.statements == [
+        'PREPARE %scolumns_info' % prefix,
+        'EXECUTE %scolumns_info' % prefix,
+        'EXECUTE %scolumns_info' % prefix
+    ]
+    assert tables.Introspector(conn).prefix != prefix
+
+
+def test_12():
+    """ DDL is generated statement by statement """
+    t1 = tables.Table(str_table1)
+    chunks = list(t1.iter_create_clause())
+    assert len(chunks) > 5
+    assert u''.join(chunks) == t1.create_clause()
+    assert u''.join(t1.iter_create_clause(validate=False)) == t1.create_clause(validate=False)
+
+
+def test_13():
+    """ identity and sequence options of columns """
+    t1 = tables.Table("""
+table: my.events
+columns:
+    - id:
+        type: bigint
+        identity: by default
+    - seq:
+        type: bigserial
+        sequence:
+            cache: 50
+""")
+    t2 = tables.Table("""
+table: my.events
+columns:
+    - id:
+        type: bigint
+        identity: always
+        sequence:
+            cache: 100
+    - seq: bigserial
+""")
+    ddl = t1.create_clause()
+    assert '    id bigint GENERATED BY DEFAULT AS IDENTITY' in ddl
+    assert ("EXECUTE format('ALTER SEQUENCE %s CACHE 50 INCREMENT BY 1', "
+            "pg_get_serial_sequence('my.events', 'seq'));") in ddl
+    assert t1.alter_to(t2) == (
+        "ALTER TABLE my.events ALTER COLUMN id SET GENERATED ALWAYS;\n"
+        "ALTER TABLE my.events ALTER COLUMN id SET CACHE 100 SET INCREMENT BY 1;\n"
+        "DO $pgbuild$\nBEGIN\n"
+        "    EXECUTE format('ALTER SEQUENCE %s CACHE 1 INCREMENT BY 1', pg_get_serial_sequence('my.events', 'seq'));\n"
+        "END\n$pgbuild$;\n")
+    assert t2.alter_to(tables.Table(t2.yaml_definition)) == ''
+    try:
+        tables.sequence_options({'cache': 'lots'})
+        assert False
+    except tables.YamlTableError, e:
+        assert 'cache' in str(e)
+
+
+def test_14():
+    """ sequence options of an introspected serial column, reported as integer with nextval default """
+    column = tables.Column.load_from_yaml({
+        'name': 'id', 'type': 'integer', 'default': "nextval('my.events_id_seq'::regclass)",
+        'not_null': True, 'sequence': {'cache': 100}})
+    assert column.sequence == {'cache': 100}
+    try:
+        tables.Column.load_from_yaml({'name': 'id', 'type': 'integer', 'sequence': {'cache': 100}})
+        assert False
+    except tables.YamlTableError:
+        pass
+
+
+def test_15():
+    """ check expression introspected from consrc matches the yaml one """
+    table = tables.Table(str_table1)
+    other = tables.Table(str_table1.replace('col1 > 0 and col1 < 100', '((col1 > 0 and col1 < 100))'))
+    assert 'col1_check' not in table.alter_to(other)
+    assert 'col1_check' not in table.validate_to(other)
+    assert tables.normalized_expression('( (a > 0) AND (b > 0) )') == '(a > 0) AND (b > 0)'
+    assert tables.normalized_expression("(a > 0) AND (b <> ')')") == "(a > 0) AND (b <> ')')"
+
+
+def test_16():
+    """ DDL on a connection runs with lock_timeout in its own transaction """
+    from conftest import FakeConnection
+    conn = FakeConnection()
+    tables.Table(str_table1).drop_on_connection(conn, lock_timeout='2s')
+    assert conn.executed == ['SET LOCAL lock_timeout = %s', 'DROP TABLE IF EXISTS myschema.mytable CASCADE;\n', 'COMMIT']
+    assert conn.params[0] == ('2s',)
@@ -0,0 +1,49 @@
+import types
+
+str_type1 = """
+type: myschema.mytype
+attributes:
+    - attr1: int
+    - attr2: text
+    - attr3: date
+"""
+
+str_type2 = """
+type: myschema.mytype
+attributes:
+    - attr1: bigint
+    - attr3: date
+    - attr4: text
+"""
+
+
+def test_1():
+
+    type1 = types.Type(str_type1)
+    type2 = types.Type(str_type2)
+
+    expected = """ALTER TYPE myschema.mytype
+    ALTER ATTRIBUTE attr1 TYPE bigint,
+    DROP ATTRIBUTE IF EXISTS attr2,
+    ADD ATTRIBUTE attr4 text;
+"""
+    assert type1.alter_to(type2) == expected
+    assert type1.alter_to(type1) == ''
+
+
+def test_2():
+    """ aliases of attribute types match the types reported by format_type """
+    type1 = types.Type(str_type1)
+    existing = types.Type({'type': 'myschema.mytype', 'attributes': [
+        {'attr1': 'integer'}, {'attr2': 'text'}, {'attr3': 'date'}]})
+    assert existing.alter_to(type1) == ''
+
+
+def test_3():
+    """ build script of a type alters an existing type to the definition """
+    sql = types.Type(str_type2).create_or_alter_clause()
+    assert "IF to_regtype('myschema.mytype') IS NULL THEN\n        CREATE TYPE myschema.mytype AS (" in sql
+    assert "a.attname NOT IN ('attr1', 'attr3', 'attr4')" in sql
+    assert "ELSIF _type <> 'bigint' THEN\n        ALTER TYPE myschema.mytype ALTER ATTRIBUTE attr1 TYPE bigint;" in sql
+    assert "IF _type IS NULL THEN\n        ALTER TYPE myschema.mytype ADD ATTRIBUTE attr4 text;" in sql
+    assert types.catalog_name('Attr') == 'attr' and types.catalog_name('"Attr"') == 'Attr'
@@ -0,0 +1,64 @@
+import validate
+
+
+def test_1():
+
+    assert validate.check_value(u'42', 'int') is None
+    assert validate.check_value(u'4x', 'int') is not None
+    assert validate.check_value(u'99999999999', 'integer') is not None
+    assert validate.check_value(u'2016-02-30', 'date') is not None
+    assert validate.check_value(u'2016-02-01 10:00:00+03', 'timestamptz') is None
+    assert validate.check_value(u'abcd', 'varchar(3)') is not None
+    assert validate.check_value(u'anything', 'hstore') is None
+
+
+def test_2():
+
+    rows = [
+        (1, ['1', 'abc', 't']),
+        (2, ['2', 'abc']),
+        (3, ['x', '\xff', 'maybe']),
+        (4, ['', 'abc', '']),
+    ]
+    errors = validate.check_batch(('f.csv', 'utf-8', ['int', 'text', 'boolean'], '', rows))
+
+    assert [e[0] for e in errors] == [2, 3, 3, 3]
+
+
+def test_3():
+
+    lines = [
+        '1\ta\\tb\t\\N\n',
+        '2\tsplit\\\n',
+        'line\tx\\\\\n',
+        '3\t\\101\\x42\tc\\\\\\\n',
+        'd\n',
+        '\\.\n',
+        '4\tnot read\n',
+    ]
+    rows = list(validate.text_rows(iter(lines), '\t'))
+
+    assert rows == [
+        (1, ['1', 'a\tb', None]),
+        (2, ['2', 'split\nline', 'x\\']),
+        (4, ['3', 'AB', 'c\\\nd']),
+    ]
+    errors = validate.check_batch(('f.txt', 'utf-8', ['int', 'text', 'int'], None, rows))
+
+    assert errors[0][0] == 2 and errors[1][0] == 4 and len(errors) == 2
+
+
+def test_4():
+
+    class Task(object):
+        task_type = 'sql'
+
+    class Role(object):
+        tasks = [Task()]
+
+    pool = validate.multiprocessing.Pool
+    validate.multiprocessing.Pool = None
+    try:
+        assert validate.validate_roles([Role()]) == []
+    finally:
+        validate.multiprocessing.Pool = pool
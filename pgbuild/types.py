@@ -1,5 +1,56 @@
 import os
+import copy
 import yaml
+import tables
+
+query_type_exists = """
+SELECT to_regtype(%s) IS NOT NULL;
+"""
+
+query_type_attributes = """
+SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+FROM pg_type t
+JOIN pg_attribute a ON a.attrelid = t.typrelid
+WHERE t.oid = %s::regtype
+    AND a.attnum > 0
+    AND NOT a.attisdropped
+ORDER BY a.attnum;
+"""
+
+# attributes of an existing type out of the definition are dropped, others are added or altered
+create_or_alter_head = """DO $pgbuild$
+DECLARE
+    _name name;
+    _type text;
+BEGIN
+    IF to_regtype('{name}') IS NULL THEN
+        {create}        RETURN;
+    END IF;
+    FOR _name IN
+        SELECT a.attname FROM pg_attribute a JOIN pg_type t ON a.attrelid = t.typrelid
+        WHERE t.oid = '{name}'::regtype AND a.attnum > 0 AND NOT a.attisdropped AND a.attname NOT IN ({names})
+    LOOP
+        EXECUTE format('ALTER TYPE {name} DROP ATTRIBUTE %I', _name);
+    END LOOP;
+"""
+
+create_or_alter_attribute = """    SELECT format_type(a.atttypid, a.atttypmod) INTO _type
+    FROM pg_attribute a JOIN pg_type t ON a.attrelid = t.typrelid
+    WHERE t.oid = '{name}'::regtype AND a.attname = '{attname}' AND NOT a.attisdropped;
+    IF _type IS NULL THEN
+        ALTER TYPE {name} ADD ATTRIBUTE {attribute} {type};
+    ELSIF _type <> '{normalized_type}' THEN
+        ALTER TYPE {name} ALTER ATTRIBUTE {attribute} TYPE {type};
+    END IF;
+"""
+
+
+def catalog_name(name):
+    """ Name of an attribute as stored in pg_attribute, unquoted names are folded to lower case """
+    if name.startswith('"') and name.endswith('"'):
+        return name[1:-1]
+    return name.lower()
+
 
 class Type(object):
     """ Definition of custom database type """
@@ -10,14 +61,37 @@ class Type(object):
         type_yaml = ''.join(lines)
         return cls(type_yaml)
 
+    @classmethod
+    def load_from_connection(cls, connection, type_name):
+        """
+        connection - open DBAPI2 connection
+        type_name - name of a composite type to make instance of
+        Return None if the type doesn't exist
+        """
+        cur = connection.cursor()
+        cur.execute(query_type_exists, (type_name,))
+        if not cur.fetchone()[0]:
+            cur.close()
+            return None
+
+        cur.execute(query_type_attributes, (type_name,))
+        attributes = [{name: attr_type} for name, attr_type in cur.fetchall()]
+        cur.close()
+
+        return cls({'type': type_name, 'attributes': attributes})
 
     def __init__(self, typedef):
 
         if isinstance(typedef, str):
             typedef = yaml.load(typedef)
+        self.yaml_definition = copy.deepcopy(typedef)
         self.name = typedef['type']
         self.attributes = typedef['attributes']
 
+    def attributes_list(self):
+        """ Return list of (name, type) tuples in definition order """
+        return [(attr.keys()[0], attr.values()[0]) for attr in self.attributes]
+
     def create_clause(self):
 
         ret = 'CREATE TYPE %s AS (%s);\n'
@@ -32,5 +106,42 @@ class Type(object):
         ret = ret % (self.name, attrs)
         return ret
 
+    def create_or_alter_clause(self):
+        """
+        Create the type if it doesn't exist yet, otherwise alter its attributes to the definition in place.
+        Attributes are compared with the catalog when the script runs, like alter_to does with an introspected type.
+        """
+        attributes = self.attributes_list()
+        ret = create_or_alter_head.format(
+            name=self.name, create=self.create_clause(),
+            names=', '.join("'%s'" % catalog_name(name) for name, attr_type in attributes))
+        for name, attr_type in attributes:
+            ret += create_or_alter_attribute.format(
+                name=self.name, attribute=name, attname=catalog_name(name), type=attr_type,
+                normalized_type=tables.normalized_type(attr_type))
+        return ret + 'END\n$pgbuild$;\n'
+
+    def alter_to(self, other):
+        """ Return alter script for getting own state to other without dropping the type """
+
+        own = dict(self.attributes_list())
+        other_attrs = dict(other.attributes_list())
+
+        actions = []
+        for name, attr_type in self.attributes_list():
+            if name not in other_attrs:
+                actions.append('DROP ATTRIBUTE IF EXISTS %s' % name)
+            # spelling of a type differs between definitions and format_type, e.g. int and integer
+            elif tables.normalized_type(attr_type) != tables.normalized_type(other_attrs[name]):
+                actions.append('ALTER ATTRIBUTE %s TYPE %s' % (name, other_attrs[name]))
+
+        for name, attr_type in other.attributes_list():
+            if name not in own:
+                actions.append('ADD ATTRIBUTE %s %s' % (name, attr_type))
+
+        if not actions:
+            return ''
+        return 'ALTER TYPE %s\n    %s;\n' % (self.name, ',\n    '.join(actions))
+
     def drop_clause(self):
         return 'DROP TYPE IF EXISTS %s CASCADE;\n' % self.name
@@ -0,0 +1,316 @@
+"""
+Streaming pre-validation of CSV files loaded by ``copy`` role items.
+
+Every file is read once in batches of rows, so memory usage doesn't depend
+on the file size. Parsing (delimiters, quotes, text format escapes) happens in the
+reading process, while encoding and type checks of the batches are spread
+over a pool of worker processes.
+
+Checks performed for every row:
+
+    - number of fields matches the ``columns`` of the copy item
+    - every field is valid in the encoding of the file
+    - values conform to the column types of the referenced table,
+      if the table is defined in the same role
+"""
+import csv
+import collections
+import datetime
+import json
+import multiprocessing
+import re
+
+BATCH_ROWS = 10000
+MAX_ERRORS = 100
+
+integer_ranges = {
+    'smallint': (-2**15, 2**15 - 1),
+    'int2': (-2**15, 2**15 - 1),
+    'smallserial': (1, 2**15 - 1),
+    'integer': (-2**31, 2**31 - 1),
+    'int': (-2**31, 2**31 - 1),
+    'int4': (-2**31, 2**31 - 1),
+    'serial': (1, 2**31 - 1),
+    'bigint': (-2**63, 2**63 - 1),
+    'int8': (-2**63, 2**63 - 1),
+    'bigserial': (1, 2**63 - 1),
+}
+
+float_types = ['numeric', 'decimal', 'real', 'float4', 'double precision', 'float8', 'float']
+
+bool_values = ['t', 'f', 'true', 'false', 'y', 'n', 'yes', 'no', 'on', 'off', '1', '0']
+
+text_types = ['character varying', 'varchar', 'character', 'char', 'text']
+
+re_integer = re.compile(r'^\s*[+-]?\d+\s*$')
+re_uuid = re.compile(r'^\{?[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}\}?$', re.I)
+re_timestamp = re.compile(
+    r'^\d{4}-\d{2}-\d{2}'
+    r'([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?'
+    r'\s*([+-]\d{2}(:?\d{2})?|Z|[A-Za-z][A-Za-z0-9/_+-]*)?$'
+)
+
+
+class CSVValidationError(Exception):
+    pass
+
+
+def split_type(dtype):
+    """ Split column type into lower case base type and length modifier """
+    dtype = dtype.strip().lower()
+    length = None
+    if dtype.find('(') > 0:
+        spec = dtype[dtype.find('(') + 1:dtype.find(')')]
+        dtype = dtype[0:dtype.find('(')].rstrip()
+        if spec.isdigit():
+            length = int(spec)
+    return dtype, length
+
+
+def check_value(value, dtype):
+    """
+    Check unicode value against column type.
+    Return error message or None if the value conforms to the type.
+    Types without known representation rules are accepted as is.
+    """
+    base, length = split_type(dtype)
+
+    if base in integer_ranges:
+        if not re_integer.match(value):
+            return 'invalid %s value "%s"' % (base, value)
+        low, high = integer_ranges[base]
+        if not low <= int(value) <= high:
+            return '%s value %s out of range' % (base, value)
+
+    elif base in float_types:
+        try:
+            float(value)
+        except ValueError:
+            return 'invalid %s value "%s"' % (base, value)
+
+    elif base in ('boolean', 'bool'):
+        if value.strip().lower() not in bool_values:
+            return 'invalid boolean value "%s"' % value
+
+    elif base == 'date':
+        if value.strip().lower() not in ('infinity', '-infinity'):
+            try:
+                datetime.datetime.strptime(value.strip(), '%Y-%m-%d')
+            except ValueError:
+                return 'invalid date value "%s"' % value
+
+    elif base.startswith('timestamp') or base == 'timestamptz':
+        if value.strip().lower() not in ('infinity', '-infinity') and not re_timestamp.match(value.strip()):
+            return 'invalid timestamp value "%s"' % value
+
+    elif base == 'uuid':
+        if not re_uuid.match(value.strip()):
+            return 'invalid uuid value "%s"' % value
+
+    elif base in ('json', 'jsonb'):
+        try:
+            json.loads(value)
+        except ValueError:
+            return 'invalid %s value' % base
+
+    elif base in text_types and length is not None:
+        if len(value) > length:
+            return 'value too long for type %s' % dtype
+
+    return None
+
+
+def check_batch(args):
+    """
+    Check a batch of parsed rows.
+    args is a tuple of (path, encoding, column types, null marker, rows)
+    where every row is a tuple of a line number and a list of raw fields.
+    Return a list of (line number, message) tuples.
+    """
+    path, encoding, types, null, rows = args
+    errors = []
+    for line, fields in rows:
+        if len(fields) != len(types):
+            errors.append((line, 'expected %s fields, got %s' % (len(types), len(fields))))
+            continue
+        for idx, raw in enumerate(fields):
+            if raw is None:  # NULL of the text format
+                continue
+            try:
+                value = raw.decode(encoding)
+            except UnicodeDecodeError, e:
+                errors.append((line, 'field %s is not valid %s: %s' % (idx + 1, encoding, e.reason)))
+                continue
+            if types[idx] is None or raw == null:
+                continue
+            message = check_value(value, types[idx])
+            if message:
+                errors.append((line, 'field %s: %s' % (idx + 1, message)))
+    return errors
+
+
+def reader_options(task):
+    """ Return csv reader keyword arguments and NULL marker for the COPY options of a task """
+    copy_format = (task.copy_format or 'text').lower()
+    if copy_format == 'csv':
+        options = {
+            'delimiter': str(task.delimiter or ','),
+            'quotechar': str(task.quote or '"'),
+            'doublequote': True,
+            'strict': True,
+        }
+        null = ''
+    elif copy_format == 'text':
+        # fields are split and unescaped by text_rows, \N fields are None
+        options = {
+            'delimiter': str(task.delimiter or '\t'),
+        }
+        null = None
+    else:
+        raise CSVValidationError('Format "%s" of %s is not supported by validation' % (copy_format, task.copy_from))
+    if len(options['delimiter']) != 1:
+        raise CSVValidationError('Delimiter of %s must be a single character' % task.copy_from)
+    return options, null
+
+
+text_escapes = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+re_text_escape = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)', re.S)
+
+
+def unescape_text(field):
+    """ Value of a field of COPY text format: \\t, \\n, octal \\123, hex \\x41, any other escaped character as is """
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] == 'x' and len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        if escape[0] in '01234567':
+            return chr(int(escape, 8) & 0xff)
+        return text_escapes.get(escape, escape)
+    return re_text_escape.sub(replace, field)
+
+
+def split_text_row(row, delimiter):
+    """ Split a row of COPY text format by delimiters which aren't escaped, \\N fields are None """
+    if '\\' not in row:
+        return row.split(delimiter)
+    fields = []
+    start = 0
+    pos = 0
+    while pos < len(row):
+        if row[pos] == '\\':
+            pos += 2
+            continue
+        if row[pos] == delimiter:
+            fields.append(row[start:pos])
+            start = pos + 1
+        pos += 1
+    fields.append(row[start:])
+    return [None if field == '\\N' else unescape_text(field) for field in fields]
+
+
+def text_rows(f, delimiter):
+    """
+    Generate (line number, fields) of a file in COPY text format.
+    A line ending with an escaped newline continues on the next one, \\. ends the data.
+    """
+    line = 0
+    row = None
+    start = None
+    for text in f:
+        line += 1
+        if row is None:
+            row, start = '', line
+        row += text
+        content = row.rstrip('\r\n') if row.endswith('\n') else row
+        trailing = len(content) - len(content.rstrip('\\'))
+        if trailing % 2 and row.endswith('\n'):  # escaped newline is a part of the value
+            continue
+        if content == '\\.':
+            return
+        yield start, split_text_row(content, delimiter)
+        row = None
+    if row is not None:
+        yield start, split_text_row(row, delimiter)
+
+
+def csv_rows(f, options, path):
+    """ Generate (line number, fields) of a CSV file, malformed quoting is reported as CSVValidationError """
+    reader = csv.reader(f, **options)
+    line = 1
+    try:
+        for fields in reader:
+            yield line, fields
+            line = reader.line_num + 1
+    except csv.Error, e:
+        raise CSVValidationError('%s:%s: %s' % (path, line, e))
+
+
+def read_batches(task, types, batch_rows=BATCH_ROWS):
+    """
+    Stream the file of a copy task as batches ready for check_batch.
+    Malformed quoting is reported as CSVValidationError.
+    """
+    options, null = reader_options(task)
+    with open(task.copy_from, 'rb') as f:
+        if (task.copy_format or 'text').lower() == 'text':
+            rows_iter = text_rows(f, options['delimiter'])
+        else:
+            rows_iter = csv_rows(f, options, task.copy_from)
+        rows = []
+        for row in rows_iter:
+            rows.append(row)
+            if len(rows) == batch_rows:
+                yield (task.copy_from, task.encoding, types, null, rows)
+                rows = []
+        if rows:
+            yield (task.copy_from, task.encoding, types, null, rows)
+
+
+def column_types(role, task):
+    """ Return list of column types for a copy task, None for unknown columns """
+    table = role.get_table(task.table)
+    types = []
+    for name in task.columns:
+        column = table.columns.get_column(name) if table is not None else None
+        types.append(column.type if column is not None else None)
+    return types
+
+
+def validate_roles(roles, jobs=None, max_errors=MAX_ERRORS):
+    """
+    Validate files of all copy tasks of the roles.
+    Return list of error messages in "path:line: message" form.
+    """
+    errors = []
+    pool = None  # started by the first batch, roles without copy items don't need it
+    window = (jobs or multiprocessing.cpu_count()) * 2
+    try:
+        for role in roles:
+            for task in role.tasks:
+                if task.task_type != 'copy':
+                    continue
+                types = column_types(role, task)
+                pending = collections.deque()
+                try:
+                    for batch in read_batches(task, types):
+                        if pool is None:
+                            pool = multiprocessing.Pool(jobs)
+                        pending.append(pool.apply_async(check_batch, (batch,)))
+                        while len(pending) >= window:
+                            errors.extend(format_errors(task, pending.popleft().get()))
+                        if len(errors) >= max_errors:
+                            break
+                except CSVValidationError, e:
+                    errors.append(str(e))
+                while pending:
+                    errors.extend(format_errors(task, pending.popleft().get()))
+                if len(errors) >= max_errors:
+                    return errors[:max_errors]
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return errors
+
+
+def format_errors(task, errors):
+    return ['%s:%s: %s' % (task.copy_from, line, message) for line, message in errors]
@@ -0,0 +1,135 @@
+"""
+Watching files of an application for changes.
+
+On Linux directories of the files are watched with inotify, so files
+replaced by editors (written to a temporary file and renamed) are noticed
+as well. Elsewhere modification times of the files are polled.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+
+EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = 'iIII'  # wd, mask, cookie, len of struct inotify_event
+
+# events following the first one within the delay are reported together, e.g. write of several files
+SETTLE_DELAY = 0.1
+
+
+def load_libc():
+    """ libc with inotify functions or None """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class PollingWatcher(object):
+    """ Watcher comparing modification times of files """
+
+    def __init__(self, paths, interval=0.5):
+        self.interval = interval
+        self.watch(paths)
+
+    def mtimes(self):
+        ret = {}
+        for path in self.paths:
+            try:
+                ret[path] = os.stat(path).st_mtime
+            except OSError:
+                ret[path] = None
+        return ret
+
+    def watch(self, paths):
+        self.paths = set(paths)
+        self.times = self.mtimes()
+
+    def wait(self):
+        """ Block until any of the files changes, return set of changed paths """
+        while True:
+            time.sleep(self.interval)
+            times = self.mtimes()
+            changed = set(p for p in self.paths if times[p] != self.times[p])
+            if changed:
+                time.sleep(SETTLE_DELAY)
+                self.times = self.mtimes()
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """ Watcher of directories of files with inotify """
+
+    def __init__(self, paths, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}  # watch descriptor to directory
+        self.watch(paths)
+
+    def watch(self, paths):
+        self.paths = set(paths)
+        watched = set(self.directories.values())
+        for directory in set(os.path.dirname(p) for p in self.paths) - watched:
+            wd = self.libc.inotify_add_watch(self.fd, directory, EVENTS)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for %s' % directory)
+            self.directories[wd] = directory
+
+    def read_events(self):
+        """ Return set of paths of the events read """
+        ret = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return ret
+                raise
+            offset = 0
+            header_size = struct.calcsize(EVENT_HEADER)
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from(EVENT_HEADER, data, offset)
+                name = data[offset + header_size:offset + header_size + length].rstrip('\0')
+                offset += header_size + length
+                if wd in self.directories:
+                    ret.add(os.path.join(self.directories[wd], name))
+
+    def wait(self):
+        """ Block until any of the files changes, return set of changed paths """
+        while True:
+            select.select([self.fd], [], [])
+            time.sleep(SETTLE_DELAY)
+            changed = self.read_events() & self.paths
+            if changed:
+                return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(paths):
+    """ Watcher of the files, inotify based if available """
+    libc = load_libc()
+    if libc is not None:
+        try:
+            return InotifyWatcher(paths, libc)
+        except OSError:
+            pass
+    return PollingWatcher(paths)